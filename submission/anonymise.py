@@ -0,0 +1,168 @@
+# This module contains the anonymisation functions used by the scripts
+# submitted for the City of Cape Town - Data Science Unit Code Challenge
+# https://github.com/cityofcapetown/ds_code_challenge
+#
+# The timestamps of the service requests are shifted by a random offset of
+# up to +/-ANONYMISE_TIME_OFFSET_HOURS. All offsets are drawn in a single call
+# of a numpy.random.Generator (seeded with ANONYMISE_SEED) and added as
+# timedelta64 arrays, so null timestamps (NaT) stay NaT without a Python loop.
+#
+# The locations are displaced by a SpatialAnonymiser, in chunks of
+# ANONYMISE_CHUNK_SIZE rows, with one of the ANONYMISE_SPATIAL_MODE modes:
+# - "geodesic": a random azimuth and distance of up to ANONYMISE_DISTANCE_M,
+#               applied with pyproj.Geod.fwd() on the WGS84 ellipsoid
+# - "planar":   the same random displacement applied as a local flat-earth
+#               offset in degrees (error well under 1% at 500 m)
+# - "h3":       each location is snapped to the centre of its H3 cell at
+#               ANONYMISE_H3_RESOLUTION (res 8 cells are ~460 m across)
+# The throughput and the distribution of the achieved displacement are
+# logged, so the location accuracy of the output can be audited.
+
+from support_library import(SERVICE_REQUEST_TIMESTAMP_COLUMNS,
+                            ANONYMISE_TIME_OFFSET_HOURS,
+                            ANONYMISE_SEED,
+                            ANONYMISE_DISTANCE_M,
+                            ANONYMISE_SPATIAL_MODE,
+                            ANONYMISE_H3_RESOLUTION,
+                            ANONYMISE_CHUNK_SIZE,
+                            )
+from h3_indexer import calculate_h3_index_int
+from spatial_filter import haversine_distance_m, METRES_PER_DEGREE
+
+from loguru import logger
+import timeit
+
+import numpy as np
+import pandas as pd
+import pyproj
+import h3
+
+NANOSECONDS_PER_HOUR = 3600*10**9
+SPATIAL_ANONYMISE_MODES = ("geodesic", "planar", "h3")
+DISPLACEMENT_PERCENTILES = (0, 50, 90, 99, 100)
+
+
+def random_time_offsets(shape, hours, rng):
+#   return a timedelta64[ns] array of shape with offsets drawn uniformly from [-hours, +hours)
+    return (rng.uniform(-hours, hours, shape)*NANOSECONDS_PER_HOUR).astype(np.int64).view("timedelta64[ns]")
+
+def anonymise_timestamps(service_requests, columns=SERVICE_REQUEST_TIMESTAMP_COLUMNS,
+                         hours=ANONYMISE_TIME_OFFSET_HOURS, seed=ANONYMISE_SEED):
+#   shifts each timestamp of columns by an independent random offset of up to
+#   +/-hours and writes the result back to the service_requests dataframe
+#   - seed is passed to numpy.random.default_rng(): an int gives a reproducible
+#     result, None a fresh one
+#   - columns that are not datetime64 are parsed with pd.to_datetime()
+#   returns service_requests
+    process_start_time = timeit.default_timer()
+    rng = np.random.default_rng(seed)
+    offsets = random_time_offsets((len(service_requests), len(columns)), hours, rng)
+    for number, name in enumerate(columns):
+        timestamps = pd.to_datetime(service_requests[name])
+        service_requests[name] = timestamps + pd.to_timedelta(offsets[:, number])
+    time_elapsed = timeit.default_timer() - process_start_time
+    logger.debug(f"Timestamps anonymised to within {hours} hours: {len(service_requests)} rows. Time Taken: {time_elapsed}s")
+    return service_requests
+
+
+class SpatialAnonymiser:
+#   Displaces latitude/longitude arrays to a location accuracy of distance_m
+#   (modes "geodesic" and "planar") or to the centre of their H3 cell at
+#   resolution (mode "h3").
+#   - one pyproj.Geod is created per anonymiser and reused for every chunk
+#   - rows with a null (NaN) coordinate are left null
+#   - seed is as for anonymise_timestamps(); the spatial offsets are drawn
+#     from a different stream than the temporal offsets of the same seed
+#   anonymise(latitude, longitude) returns the new (latitude, longitude) and
+#   sets stats: rows, rows per second and the displacement percentiles in metres
+    def __init__(self, mode=ANONYMISE_SPATIAL_MODE, distance_m=ANONYMISE_DISTANCE_M,
+                 resolution=ANONYMISE_H3_RESOLUTION, chunk_size=ANONYMISE_CHUNK_SIZE, seed=ANONYMISE_SEED):
+        if mode not in SPATIAL_ANONYMISE_MODES:
+            raise ValueError(f"Unknown spatial anonymisation mode: '{mode}'. Expected one of {SPATIAL_ANONYMISE_MODES}")
+        self.mode = mode
+        self.distance_m = distance_m
+        self.resolution = resolution
+        self.chunk_size = chunk_size
+        self.rng = np.random.default_rng(None if seed is None else [seed, 1])
+        self.geod = pyproj.Geod(ellps="WGS84")
+        self.stats = {}
+
+    def _random_offsets(self, length):
+#       return (azimuth in degrees, distance in metres) for length rows
+        azimuth  = self.rng.uniform(-180, 180, length)
+        distance = self.rng.uniform(0, self.distance_m, length)
+        return azimuth, distance
+
+    def _displace(self, latitude, longitude):
+#       return the displaced (latitude, longitude) of one chunk of located rows
+        if self.mode == "h3":
+            h3_index = calculate_h3_index_int(latitude, longitude, self.resolution)
+            cells, inverse = np.unique(h3_index, return_inverse=True)
+            centres = np.array([h3.h3_to_geo(format(int(cell), "x")) for cell in cells], dtype=np.float64).reshape(-1, 2)
+            inverse = inverse.reshape(-1)
+            return centres[inverse, 0], centres[inverse, 1]
+
+        azimuth, distance = self._random_offsets(len(latitude))
+        if self.mode == "geodesic":
+            new_longitude, new_latitude, _ = self.geod.fwd(longitude, latitude, azimuth, distance)
+            return np.asarray(new_latitude), np.asarray(new_longitude)
+
+        # planar: metres to degrees on the sphere, at the latitude of each point
+        azimuth = np.radians(azimuth)
+        new_latitude  = latitude + distance*np.cos(azimuth)/METRES_PER_DEGREE
+        new_longitude = longitude + distance*np.sin(azimuth)/(METRES_PER_DEGREE*np.cos(np.radians(latitude)))
+        return new_latitude, new_longitude
+
+    def anonymise(self, latitude, longitude):
+        process_start_time = timeit.default_timer()
+        latitude  = np.asarray(latitude, dtype=np.float64)
+        longitude = np.asarray(longitude, dtype=np.float64)
+        new_latitude  = latitude.copy()
+        new_longitude = longitude.copy()
+        # (0, 0) is not a location in challenge_2 either, see calculate_h3_index_int()
+        located = np.flatnonzero(~(np.isnan(latitude) | np.isnan(longitude) | (latitude == 0) | (longitude == 0)))
+
+        displacement = np.empty(len(located), dtype=np.float64)
+        for start in range(0, len(located), self.chunk_size):
+            rows = located[start:start + self.chunk_size]
+            new_latitude[rows], new_longitude[rows] = self._displace(latitude[rows], longitude[rows])
+            displacement[start:start + len(rows)] = haversine_distance_m(
+                new_latitude[rows], new_longitude[rows], latitude[rows], longitude[rows])
+
+        time_elapsed = timeit.default_timer() - process_start_time
+        self.stats = {
+            "mode": self.mode,
+            "rows": len(latitude),
+            "rows_displaced": len(located),
+            "rows_per_second": len(latitude)/max(time_elapsed, 1e-9),
+            }
+        if len(located):
+            for percentile, value in zip(DISPLACEMENT_PERCENTILES, np.percentile(displacement, DISPLACEMENT_PERCENTILES)):
+                self.stats[f"displacement_p{percentile}_m"] = float(value)
+            self.stats["displacement_mean_m"] = float(displacement.mean())
+        return new_latitude, new_longitude
+
+    def report(self):
+#       logs the throughput and displacement distribution of the last anonymise()
+        if not self.stats:
+            return
+        logger.info(f"Locations anonymised ({self.stats['mode']}): {self.stats['rows_displaced']} of {self.stats['rows']} rows "
+                    f"at {self.stats['rows_per_second']:.0f} rows/s")
+        if self.stats["rows_displaced"]:
+            distribution = ", ".join(f"p{p}={self.stats[f'displacement_p{p}_m']:.1f}" for p in DISPLACEMENT_PERCENTILES)
+            logger.info(f"Displacement [m]: {distribution}, mean={self.stats['displacement_mean_m']:.1f}")
+
+def anonymise_locations(service_requests, mode=ANONYMISE_SPATIAL_MODE, distance_m=ANONYMISE_DISTANCE_M,
+                        resolution=ANONYMISE_H3_RESOLUTION, chunk_size=ANONYMISE_CHUNK_SIZE, seed=ANONYMISE_SEED):
+#   displaces the 'latitude' and 'longitude' of the service_requests dataframe
+#   with a SpatialAnonymiser and writes the result back to the dataframe
+#   returns the stats of the anonymiser
+    anonymiser = SpatialAnonymiser(mode, distance_m, resolution, chunk_size, seed)
+    latitude, longitude = anonymiser.anonymise(
+        service_requests["latitude"].to_numpy(),
+        service_requests["longitude"].to_numpy(),
+        )
+    service_requests["latitude"]  = latitude
+    service_requests["longitude"] = longitude
+    anonymiser.report()
+    return anonymiser.stats
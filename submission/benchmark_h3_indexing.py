@@ -0,0 +1,69 @@
+# This script benchmarks the H3 indexing of service requests
+# for the City of Cape Town - Data Science Unit Code Challenge
+# https://github.com/cityofcapetown/ds_code_challenge
+#
+# Step 1.  Load SERVICE_REQUEST_SOURCE (downloaded by challenge_2.py)
+# Step 2.  Time the row-wise .apply(calculate_h3_level8_index) path
+# Step 3.  Time the vectorised h3_indexer.calculate_h3_index() path
+# Step 4.  Confirm both paths return the same h3_level8_index column
+
+from support_library import(SERVICE_REQUEST_SOURCE,
+                            H3_INDEX_CHUNK_SIZE,
+                            )
+from challenge_2 import calculate_h3_level8_index
+from h3_indexer import calculate_h3_index
+
+from loguru import logger
+import timeit
+import sys
+import argparse
+
+import gzip
+import pandas as pd
+
+
+def main(source, num_rows, chunk_size):
+    # Step 1.  Load SERVICE_REQUEST_SOURCE
+    try:
+        with gzip.open(source) as f_:
+            service_requests = pd.read_csv(f_, nrows=num_rows)
+    except FileNotFoundError:
+        logger.exception(f"Cannot open: '{source}'. Run challenge_2.py to download it.")
+        return
+    logger.info(f"Number of service requests benchmarked: {len(service_requests)}")
+
+    # Step 2.  Time the row-wise .apply() path
+    process_start_time = timeit.default_timer()
+    apply_index = service_requests.apply(calculate_h3_level8_index, axis=1)
+    apply_time = timeit.default_timer() - process_start_time
+    logger.info(f"apply() H3 index. Time Taken: {apply_time}s")
+
+    # Step 3.  Time the vectorised path
+    process_start_time = timeit.default_timer()
+    vector_index = calculate_h3_index(
+      service_requests['latitude'].to_numpy(),
+      service_requests['longitude'].to_numpy(),
+      8,
+      chunk_size,
+      )
+    vector_time = timeit.default_timer() - process_start_time
+    logger.info(f"Vectorised H3 index. Time Taken: {vector_time}s")
+    logger.info(f"Speed-up: {apply_time/max(vector_time, 1e-9):.1f}x")
+
+    # Step 4.  Confirm both paths agree
+    num_mismatches = int((apply_index.astype(str).to_numpy() != vector_index.astype(str)).sum())
+    if num_mismatches == 0:
+        logger.info("Vectorised H3 index matches the apply() H3 index.")
+    else:
+        logger.error(f"Vectorised H3 index differs from the apply() H3 index in {num_mismatches} rows.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark apply() against vectorised H3 indexing.")
+    parser.add_argument("--source", default=SERVICE_REQUEST_SOURCE)
+    parser.add_argument("--rows", type=int, default=None, help="number of rows to read (default: all)")
+    parser.add_argument("--chunk-size", type=int, default=H3_INDEX_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level="INFO")
+    main(args.source, args.rows, args.chunk_size)
@@ -0,0 +1,222 @@
+# This script benchmarks the stages of the scripts submitted for the
+# City of Cape Town - Data Science Unit Code Challenge on synthetic data,
+# offline (no S3, ArcGIS or capetown.gov.za requests)
+# https://github.com/cityofcapetown/ds_code_challenge
+#
+# Step 1.  Generate, write and parse a synthetic wind spreadsheet, and ingest it
+#          into a wind data store
+# For each number of rows in BENCHMARK_ROWS (100k, 1M, 10M):
+# Step 2.  Generate synthetic service requests and time the sr.csv.gz write and read
+# Step 3.  Time the H3 indexing, and the GeoJSON write, read and polygon join
+#          of a synthetic hex layer
+# Step 4.  Time the parquet write and read
+# Step 5.  Time the subsample around BENCHMARK_CENTROID, with and without the
+#          H3 prefilter
+# Step 6.  Time the as-of join of all the service requests to the wind data
+# Step 7.  Time the anonymisation of the timestamps and locations
+#
+# The wall time, CPU time, peak RSS, rows and bytes of each stage are saved as
+# a run report (support_library.RunReport) to BENCHMARK_RESULTS_DIR/<git commit>.json
+# and appended to BENCHMARK_RESULTS_DIR/history.jsonl. Each stage is compared with
+# the previous run in the history, or with --compare.
+
+from support_library import(BENCHMARK_DATA_DIR,
+                            BENCHMARK_RESULTS_DIR,
+                            BENCHMARK_ROWS,
+                            BENCHMARK_CENTROID,
+                            SYNTHETIC_SEED,
+                            SYNTHETIC_NULL_FRACTION,
+                            SYNTHETIC_START,
+                            SYNTHETIC_END,
+                            SERVICE_REQUEST_HEX_COLUMN_NAME,
+                            H3_INDEX_NUM_WORKERS,
+                            ANONYMISE_SPATIAL_MODE,
+                            delete_file,
+                            delete_directory,
+                            get_git_commit,
+                            run_stage,
+                            start_run_report,
+                            finish_run_report,
+                            )
+from synthetic_data import(generate_service_requests,
+                           write_service_requests_csv,
+                           generate_hex_layer,
+                           write_hex_layer,
+                           generate_wind_data,
+                           write_wind_ods,
+                           )
+from h3_indexer import calculate_h3_index_parallel
+from spatial_join import HexPolygonJoin, read_polygon_layer
+from spatial_filter import SpatialFilter
+from columnar_io import write_service_requests_parquet, read_service_requests_parquet
+from wind_data import read_wind_data
+from wind_store import WindDataStore
+from anonymise import anonymise_timestamps, anonymise_locations
+
+from loguru import logger
+import os
+import sys
+import json
+import argparse
+
+import pandas as pd
+
+BENCHMARK_HISTORY = "history.jsonl"
+BENCHMARK_WIND_STATION = "Bellville South"
+
+
+def benchmark_wind_data(data_dir, start, end, seed):
+    # Step 1.  Generate, write and parse a synthetic wind spreadsheet, and
+    # ingest it into a wind data store
+    wind_file = os.path.join(data_dir, "wind.ods")
+    with run_stage("generate_wind") as stage_:
+        wind_data, columns = generate_wind_data(start, end, seed=seed)
+        write_wind_ods(wind_data, columns, wind_file, seed=seed)
+        stage_.rows_out = len(wind_data)
+    with run_stage("parse_wind_ods") as stage_:
+        stage_.rows_out = len(read_wind_data(wind_file, columns[BENCHMARK_WIND_STATION], cache_dir=None))
+
+    store_dir = os.path.join(data_dir, "wind_data_store")
+    delete_directory(store_dir)
+    wind_store = WindDataStore(store_dir)
+    with run_stage("ingest_wind"):
+        wind_store.ingest(wind_file, columns)
+    return wind_store
+
+def benchmark_rows(num_rows, data_dir, wind_store, num_workers, null_fraction, start, end, seed):
+    # Step 2.  Generate synthetic service requests and time the sr.csv.gz write and read
+    csv_file = os.path.join(data_dir, f"sr-{num_rows}.csv.gz")
+    with run_stage("generate") as stage_:
+        service_requests = generate_service_requests(num_rows, null_fraction, start, end, seed=seed)
+        stage_.rows_out = len(service_requests)
+    with run_stage("write_csv_gz", rows_in=num_rows):
+        write_service_requests_csv(service_requests, csv_file)
+    with run_stage("read_csv_gz") as stage_:
+        stage_.rows_out = len(pd.read_csv(csv_file))
+    delete_file(csv_file)
+
+    # Step 3.  Time the H3 indexing, and the GeoJSON write, read and polygon join
+    latitude  = service_requests["latitude"].to_numpy()
+    longitude = service_requests["longitude"].to_numpy()
+    with run_stage("h3_index", rows_in=num_rows):
+        h3_index = calculate_h3_index_parallel(latitude, longitude, 8, num_workers)
+    service_requests[SERVICE_REQUEST_HEX_COLUMN_NAME] = h3_index
+
+    hex_file = os.path.join(data_dir, f"hex-{num_rows}.geojson")
+    with run_stage("write_geojson") as stage_:
+        features = generate_hex_layer(latitude, longitude)
+        write_hex_layer(features, hex_file)
+        stage_.rows_out = len(features)
+    with run_stage("read_geojson") as stage_:
+        features = read_polygon_layer(hex_file)
+        stage_.rows_out = len(features)
+    with run_stage("hex_join", rows_in=num_rows):
+        HexPolygonJoin(features).assign(latitude, longitude)
+    delete_file(hex_file)
+
+    # Step 4.  Time the parquet write and read
+    parquet_file = os.path.join(data_dir, f"sr-{num_rows}.parquet")
+    with run_stage("write_parquet", rows_in=num_rows):
+        write_service_requests_parquet(service_requests, parquet_file)
+    with run_stage("read_parquet") as stage_:
+        stage_.rows_out = len(read_service_requests_parquet(parquet_file))
+    delete_file(parquet_file)
+
+    # Step 5.  Time the subsample around BENCHMARK_CENTROID
+    spatial_filter = SpatialFilter(*BENCHMARK_CENTROID)
+    with run_stage("subsample", rows_in=num_rows) as stage_:
+        stage_.rows_out = int(spatial_filter.mask(latitude, longitude, h3_index).sum())
+    with run_stage("subsample_exact", rows_in=num_rows) as stage_:
+        stage_.rows_out = int(spatial_filter.mask(latitude, longitude).sum())
+
+    # Step 6.  Time the as-of join of all the service requests to the wind data
+    with run_stage("asof_join", rows_in=num_rows):
+        wind_store.asof_join(service_requests, BENCHMARK_WIND_STATION, on="creation_timestamp")
+
+    # Step 7.  Time the anonymisation of the timestamps and locations
+    with run_stage("anonymise_timestamps", rows_in=num_rows):
+        anonymise_timestamps(service_requests, seed=seed)
+    with run_stage("anonymise_locations", rows_in=num_rows):
+        anonymise_locations(service_requests, seed=seed)
+
+def read_history(results_dir):
+#   return the run reports of the earlier benchmark runs, oldest first
+    history = []
+    history_file = os.path.join(results_dir, BENCHMARK_HISTORY)
+    if os.path.exists(history_file):
+        with open(history_file) as f_:
+            history = [json.loads(line) for line in f_ if line.strip()]
+    return history
+
+def read_result(results_dir, name):
+#   return the run report of the file name, or of the git commit name in results_dir
+    file_name = name if os.path.exists(name) else os.path.join(results_dir, f"{name}.json")
+    with open(file_name) as f_:
+        return json.load(f_)
+
+def compare_results(result, baseline):
+#   logs the wall time of each stage of result against the same stage of baseline
+    baseline_stages = {stage["name"]: stage for stage in baseline["stages"]}
+    logger.info(f"Compared with commit {baseline.get('git_commit')} of {baseline.get('started')}")
+    for stage in result["stages"]:
+        if stage["name"] not in baseline_stages:
+            continue
+        before = baseline_stages[stage["name"]]["wall_time_s"]
+        after  = stage["wall_time_s"]
+        change = (after - before)/before*100 if before > 0 else 0.0
+        level = "WARNING" if change > 10 and after - before > 0.05 else "INFO"
+        logger.log(level, f"{stage['name']}: {before:.3f}s -> {after:.3f}s ({change:+.1f}%)")
+
+def main(rows, data_dir, results_dir, num_workers, null_fraction, start, end, seed, compare=None):
+    os.makedirs(data_dir, exist_ok=True)
+    os.makedirs(results_dir, exist_ok=True)
+    history = read_history(results_dir)
+    commit = get_git_commit() or "no-commit"
+
+    start_run_report("benchmark_pipeline", os.path.join(results_dir, f"{commit}.json"),
+                     history_file=os.path.join(results_dir, BENCHMARK_HISTORY),
+                     parameters={
+                         "rows": rows,
+                         "h3_index_num_workers": num_workers,
+                         "null_fraction": null_fraction,
+                         "start": start,
+                         "end": end,
+                         "seed": seed,
+                         "anonymise_spatial_mode": ANONYMISE_SPATIAL_MODE,
+                         })
+    try:
+        with run_stage("wind"):
+            wind_store = benchmark_wind_data(data_dir, start, end, seed)
+        for num_rows in rows:
+            logger.info(f"Benchmarking {num_rows} rows")
+            with run_stage(f"rows_{num_rows}"):
+                benchmark_rows(num_rows, data_dir, wind_store, num_workers, null_fraction, start, end, seed)
+    finally:
+        result = finish_run_report()
+
+    for stage in result["stages"]:
+        logger.info(f"{stage['name']}: {stage['wall_time_s']:.3f}s wall, {stage['cpu_time_s']:.3f}s CPU, "
+                    f"peak RSS {stage['peak_rss_mb']} MB")
+    if compare is not None:
+        compare_results(result, read_result(results_dir, compare))
+    elif history:
+        compare_results(result, history[-1])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic data.")
+    parser.add_argument("--rows", type=int, nargs="+", default=BENCHMARK_ROWS)
+    parser.add_argument("--data-dir", default=BENCHMARK_DATA_DIR)
+    parser.add_argument("--results-dir", default=BENCHMARK_RESULTS_DIR)
+    parser.add_argument("--workers", type=int, default=H3_INDEX_NUM_WORKERS, help="H3 indexing processes")
+    parser.add_argument("--null-fraction", type=float, default=SYNTHETIC_NULL_FRACTION)
+    parser.add_argument("--start", default=SYNTHETIC_START, help="first creation_timestamp")
+    parser.add_argument("--end", default=SYNTHETIC_END, help="end of the creation_timestamp range")
+    parser.add_argument("--seed", type=int, default=SYNTHETIC_SEED)
+    parser.add_argument("--compare", default=None, help="result file or git commit to compare with "
+                                                        "(default: the previous run)")
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level="INFO")
+    main(args.rows, args.data_dir, args.results_dir, args.workers, args.null_fraction,
+         args.start, args.end, args.seed, args.compare)
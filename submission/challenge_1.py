@@ -7,17 +7,37 @@
 # Step 4.  Download CITY_HEX_POLYGONS_8_SOURCE
 # Step 5.  Validate extracted H3 resolution 8 data against CITY_HEX_POLYGONS_8_SOURCE
 # Step 6.  Save extracted H3 resolution 8 data to CHALLENGE_1_OUTPUT
+#
+# Set CHALLENGE_1_RESOLUTIONS = [8, 9, 10] to extract all resolutions in the same 
+# S3 SELECT scan; resolutions 9 and 10 are saved to CHALLENGE_1_RESOLUTION_OUTPUT.
+#
+# Steps 5 and 6 consume the S3 SELECT response as a stream: each feature is 
+# parsed, validated and written as its event arrives, without a temporary file
 
 from support_library import(set_s3_client, 
+                            log_s3_client_stats,
+                            iter_select_records,
                             download_file_from_s3_client,
                             delete_file,
+                            Prefetcher,
+                            instrument,
+                            run_stage,
+                            start_run_report,
+                            finish_run_report,
                             BUCKET_NAME, 
                             CITY_HEX_POLYGONS_8_10_SOURCE,
                             CITY_HEX_POLYGONS_8_SOURCE,
-                            CHALLENGE_1_TMP_OUTPUT,
                             CHALLENGE_1_OUTPUT,
+                            CHALLENGE_1_RESOLUTIONS,
+                            CHALLENGE_1_RESOLUTION_OUTPUT,
+                            CHALLENGE_1_SCAN_RANGE_SELECT,
+                            SCAN_RANGE_STAGING_BUCKET,
+                            CITY_HEX_POLYGONS_8_10_LINES,
                             CHALLENGE_1_LOG,
+                            CHALLENGE_1_RUN_REPORT,
                             )
+from hex_validation import HexFeatureValidator
+from scan_range_select import stage_json_lines_copy, scan_range_select
 
 from loguru import logger
 import timeit
@@ -27,54 +47,10 @@ import sys
 import botocore.exceptions
 import json
 
-def main():
-    # Step 1.  Retrieves credentials from CREDENTIALS_URL  
-    # Step 2.  Create S3 Client for REGION with retrieved credentials
-    s3_client = set_s3_client()
-
-    # Step 3.  Use AWS S3 SELECT command to extract in the H3 resolution 8 data from CITY_HEX_POLYGONS_8_10_SOURCE
-    # - extract features.properties.resolution = 8
-    is_data_extracted = False
-    try:
-        process_start_time = timeit.default_timer()   # start timer for process
-        # uses SQL query to select records where features.properties.resolution == 8
-        response = s3_client.select_object_content(
-            Bucket=BUCKET_NAME,
-            Key=CITY_HEX_POLYGONS_8_10_SOURCE,
-            ExpressionType='SQL',
-            Expression="SELECT * from S3Object[*].features[*] s where s.properties.resolution = 8", 
-            InputSerialization={"JSON": {"Type": "DOCUMENT"}, "CompressionType": "NONE"},
-            OutputSerialization={'JSON': {}},
-        )
-        time_elapsed = timeit.default_timer() - process_start_time    # elapsed time for process
-        logger.info(f"AWS S3 SELECT command completed. Time Taken: {time_elapsed}s")
-        
-        # extract payload data from query response and write to a temporary file: CHALLENGE_1_TMP_OUTPUT
-        process_start_time = timeit.default_timer()
-        f_ = open(CHALLENGE_1_TMP_OUTPUT, "w") 
-        for event in response['Payload']:
-            if 'Records' in event:
-                records = (event['Records']['Payload'])
-                f_.write(records.decode('utf-8'))        
-            elif "Stats" in event:
-                stats = event["Stats"]["Details"]
-                logger.debug(f"AWS S3 SELECT response statistics: {stats}")
-        f_.close()
-        time_elapsed = timeit.default_timer() - process_start_time
-        logger.info(f"JSON response written to local disk: '{CHALLENGE_1_TMP_OUTPUT}'. Time Taken: {time_elapsed}s")
-        is_data_extracted = True
-        
-    except botocore.exceptions.EndpointConnectionError:
-        logger.exception("AWS S3 Connection Failure.")
-        
-    except botocore.exceptions.ClientError:
-        logger.exception("S3 Client Error.")
-     
-    except FileNotFoundError:
-        logger.exception(f"Cannot write: '{CHALLENGE_1_TMP_OUTPUT}'")
-     
-            
-    # Step 4.  Download CITY_HEX_POLYGONS_8_SOURCE
+@instrument("download_validation")
+def download_validation_file(s3_client):
+#   downloads CITY_HEX_POLYGONS_8_SOURCE unless a cached copy is found
+#   return is_validation_downloded==True if the file is available on disk
     if os.path.exists(CITY_HEX_POLYGONS_8_SOURCE):
         # this will use cached files to save time required to download.
         logger.info(f"Validation data file found: '{CITY_HEX_POLYGONS_8_SOURCE}'")
@@ -92,79 +68,183 @@ def main():
           logger.info(f"Validation data file downloaded: '{CITY_HEX_POLYGONS_8_SOURCE}'. Time Taken: {time_elapsed}s")
         else:
           logger.error(f"Validation data file download failed: '{CITY_HEX_POLYGONS_8_SOURCE}'")
-        
-    # Step 5.  Validate extracted H3 resolution 8 data against CITY_HEX_POLYGONS_8_SOURCE
-    is_data_valid = False
-    if is_data_extracted and is_validation_downloded:
-        process_start_time = timeit.default_timer()
-        extracted_features = []
+    return is_validation_downloded
+
+def build_select_expression(resolutions, source="S3Object[*].features[*]"):
+#   return the S3 SELECT expression for the hex features of the given H3 resolutions
+#   all resolutions are selected in a single scan of the object
+#   source is "S3Object[*].features[*]" for the GeoJSON document and 
+#   "S3Object" for the staged JSON Lines copy
+    if len(resolutions) == 1:
+        return f"SELECT * from {source} s where s.properties.resolution = {resolutions[0]}"
+    resolution_list = ", ".join(str(resolution) for resolution in resolutions)
+    return f"SELECT * from {source} s where s.properties.resolution IN ({resolution_list})"
+
+def resolution_output(resolution):
+#   return the output file name for the hex features of an H3 resolution
+    if resolution == 8:
+        return CHALLENGE_1_OUTPUT
+    return CHALLENGE_1_RESOLUTION_OUTPUT.format(resolution=resolution)
+
+def select_hex_features(s3_client, resolutions, use_scan_range, staging_bucket=SCAN_RANGE_STAGING_BUCKET):
+#   return the S3 SELECT response for the hex features of the given resolutions
+#   - use_scan_range==True stages a JSON Lines copy of CITY_HEX_POLYGONS_8_10_SOURCE
+#     once in staging_bucket and selects its byte ranges with concurrent 
+#     ScanRange requests. BUCKET_NAME is read only, so without a writable
+#     staging_bucket, or if the copy cannot be staged, a single request over
+#     the document is used.
+#   Exceptions are raised to the caller.
+    if use_scan_range and staging_bucket is None:
+        logger.warning("ScanRange S3 SELECT needs a writable SCAN_RANGE_STAGING_BUCKET. Using a single S3 SELECT request.")
+    elif use_scan_range:
+        try:
+            staged_size = stage_json_lines_copy(
+                s3_client, 
+                BUCKET_NAME, 
+                CITY_HEX_POLYGONS_8_10_SOURCE, 
+                CITY_HEX_POLYGONS_8_10_LINES,
+                staging_bucket,
+                )
+            return {'Payload': scan_range_select(
+                s3_client, 
+                staging_bucket, 
+                CITY_HEX_POLYGONS_8_10_LINES, 
+                build_select_expression(resolutions, "S3Object"), 
+                staged_size,
+                )}
+        except botocore.exceptions.ClientError:
+            logger.exception(f"Cannot stage: '{CITY_HEX_POLYGONS_8_10_LINES}'. Using a single S3 SELECT request.")
+
+    # uses SQL query to select records where features.properties.resolution is in resolutions
+    return s3_client.select_object_content(
+        Bucket=BUCKET_NAME,
+        Key=CITY_HEX_POLYGONS_8_10_SOURCE,
+        ExpressionType='SQL',
+        Expression=build_select_expression(resolutions), 
+        InputSerialization={"JSON": {"Type": "DOCUMENT"}, "CompressionType": "NONE"},
+        OutputSerialization={'JSON': {}},
+    )
+
+def main(resolutions=CHALLENGE_1_RESOLUTIONS, use_scan_range=CHALLENGE_1_SCAN_RANGE_SELECT):
+    # Step 1.  Retrieves credentials from CREDENTIALS_URL  
+    # Step 2.  Create S3 Client for REGION with retrieved credentials
+    s3_client = set_s3_client()
+    resolutions = sorted(set(resolutions))
+
+    # Step 4 does not depend on Step 3: start downloading CITY_HEX_POLYGONS_8_SOURCE
+    # in the background while the S3 SELECT command starts
+    # Only the resolution 8 features can be validated
+    with Prefetcher() as prefetcher:
+        is_validated = 8 in resolutions
+        if is_validated:
+            prefetcher.submit(CITY_HEX_POLYGONS_8_SOURCE, download_validation_file, s3_client)
 
-        # open json query response temporary file: CHALLENGE_1_TMP_OUTPUT
+        # Step 3.  Use AWS S3 SELECT command to extract in the H3 resolution 8 data from CITY_HEX_POLYGONS_8_10_SOURCE
+        # - extract features.properties.resolution in resolutions, in one scan of the object
+        response = None
         try:
-            with open(CHALLENGE_1_TMP_OUTPUT, 'r') as f_:
-                for line in f_:
-                    json_line = json.loads(line)
-                    del json_line['properties']['resolution']       #delete the resolution field
-                    extracted_features.append(json_line)
-            f_.close()
+            with run_stage("select") as stage_:
+                response = select_hex_features(s3_client, resolutions, use_scan_range)
+            logger.info(f"AWS S3 SELECT command started for resolutions {resolutions}. Time Taken: {stage_.time_elapsed}s")
         
-        except FileNotFoundError:
-            logger.exception(f"Cannot open: '{CHALLENGE_1_TMP_OUTPUT}'")
-            
+        except botocore.exceptions.EndpointConnectionError:
+            logger.exception("AWS S3 Connection Failure.")
+        
+        except botocore.exceptions.ClientError:
+            logger.exception("S3 Client Error.")
             
+        # Step 4.  Download CITY_HEX_POLYGONS_8_SOURCE
+        # wait for the prefetched download
+        is_validation_downloded = True
+        if is_validated:
+            is_validation_downloded = prefetcher.result(CITY_HEX_POLYGONS_8_SOURCE)
+            prefetcher.report()
+        
+    # Step 5.  Validate extracted H3 resolution 8 data against CITY_HEX_POLYGONS_8_SOURCE
+    # Step 6.  Save extracted H3 resolution 8 data to CHALLENGE_1_OUTPUT
+    # Each feature is validated and written, to the output for its resolution,
+    # as its record arrives from the S3 SELECT event stream, so the extracted 
+    # features are never all held in memory. They are written to partial files
+    # that only replace the outputs once the stream has completed and every 
+    # resolution 8 feature has been validated.
+    if response is not None and is_validation_downloded:
+        process_start_time = timeit.default_timer()
+        partial_outputs = {resolution: resolution_output(resolution) + ".partial" for resolution in resolutions}
+        num_extracted = {resolution: 0 for resolution in resolutions}
+        select_stats = {}
+        is_stream_complete = False
         is_feature_invalid = False
-        # open downloaded CITY_HEX_POLYGONS_8_SOURCE
+        writers = {}
         try:
-            with open(CITY_HEX_POLYGONS_8_SOURCE) as f_:
-                valid_hex = json.loads(f_.read())
-                
-                # validate each feature in extracted_features against each feature in valid_hex['features']
-                for ef, vf in zip(extracted_features, valid_hex['features']):
-                    if ef != vf:
-                        is_feature_invalid = True
-                        logger.error(f"Failed to verify: \nExtracted: {ef} \nWith: {vf}")
-                f_.close()
-            
+            # stream downloaded CITY_HEX_POLYGONS_8_SOURCE and index the digest of 
+            # each feature by H3 index, without loading the whole collection
+            validator = None
+            if is_validated:
+                validator = HexFeatureValidator.from_geojson(CITY_HEX_POLYGONS_8_SOURCE)
+
+            writers = {resolution: open(partial_outputs[resolution], "w") for resolution in resolutions}
+            with run_stage("extract") as stage_:
+                for ef in iter_select_records(response['Payload'], select_stats):
+                    resolution = ef['properties'].pop('resolution')       #delete the resolution field
+
+                    # validate each extracted feature against the feature with the same H3 index
+                    if resolution == 8 and not validator.validate(ef):
+                        logger.debug(f"Failed to verify: \nExtracted: {ef}")
+                    writers[resolution].write(json.dumps(ef) + "\n")
+                    num_extracted[resolution] += 1
+                stage_.rows_out = sum(num_extracted.values())
+            is_stream_complete = True
+
+            # report missing, extra and changed hex features
+            if validator is not None:
+                validator.report()
+                is_feature_invalid = not validator.is_valid()
+        
+        except botocore.exceptions.EndpointConnectionError:
+            logger.exception("AWS S3 Connection Failure.")
+        
+        except botocore.exceptions.ClientError:
+            logger.exception("S3 Client Error.")
+
         except FileNotFoundError:
-            logger.exception(f"Cannot open: '{CITY_HEX_POLYGONS_8_SOURCE}'")
+            logger.exception(f"Cannot open: '{CITY_HEX_POLYGONS_8_SOURCE}' or write: {list(partial_outputs.values())}")
+
+        except Exception:
+            # e.g. a malformed record or a broken event stream: the partial
+            # outputs are deleted before the error is raised
+            for f_ in writers.values():
+                f_.close()
+            for partial_output in partial_outputs.values():
+                delete_file(partial_output)
+            raise
+
+        finally:
+            for f_ in writers.values():
+                f_.close()
             
         time_elapsed = timeit.default_timer() - process_start_time    
-        if is_feature_invalid==False:
-           # no features are invalid
-           is_data_valid = True
-           logger.info(f"Extracted JSON validated. Time Taken: {time_elapsed}s")
-        else:
-           logger.info(f"Extracted JSON not validated. Time Taken: {time_elapsed}s")
+        logger.info(f"AWS S3 SELECT bytes scanned: {select_stats.get('BytesScanned')}, "
+                    f"processed: {select_stats.get('BytesProcessed')}, returned: {select_stats.get('BytesReturned')}")
+        for resolution in resolutions:
+            if is_stream_complete and not (resolution == 8 and is_feature_invalid):
+                os.replace(partial_outputs[resolution], resolution_output(resolution))
+                logger.info(f"Extracted JSON for resolution {resolution} written to local disk: '{resolution_output(resolution)}', {num_extracted[resolution]} features.")
+            else:
+                delete_file(partial_outputs[resolution])
+                logger.info(f"Extracted JSON for resolution {resolution} not validated.")
+        logger.info(f"Extracted JSON processed. Time Taken: {time_elapsed}s")
 
-    # Step 6.  Save extracted H3 resolution 8 data to CHALLENGE_1_OUTPUT
-    if is_data_valid:
-      try:
-          process_start_time = timeit.default_timer()
-          f_ = open(CHALLENGE_1_OUTPUT, "w") 
-          for ef in extracted_features:
-              f_.write(json.dumps(ef) + "\n")        
-          f_.close()
-          time_elapsed = timeit.default_timer() - process_start_time
-          logger.info(f"Validated JSON written to local disk. Time Taken: {time_elapsed}s")
-          is_data_extracted = True
-          
-      except botocore.exceptions.EndpointConnectionError:
-          logger.exception("AWS S3 Connection Failure.")
-      
-      except botocore.exceptions.ClientError:
-          logger.exception("S3 Client Error.")
-       
-      except FileNotFoundError:
-          logger.exception(f"Cannot write: '{CHALLENGE_1_OUTPUT}'")  
+    log_s3_client_stats()
                    
 if __name__ == "__main__":
     # This will delete all cached files and force all downloads
-    delete_cached_files = True    # set to False if cached downloads are used.  
+    # pipeline.py runs the script with --keep-cached-files to reuse them
+    delete_cached_files = "--keep-cached-files" not in sys.argv[1:]
     is_success = True    
     if delete_cached_files:
         is_success = delete_file(CITY_HEX_POLYGONS_8_SOURCE)
-        is_success = is_success and delete_file(CHALLENGE_1_TMP_OUTPUT)
-        is_success = is_success and delete_file(CHALLENGE_1_OUTPUT)
+        for resolution in CHALLENGE_1_RESOLUTIONS:
+            is_success = is_success and delete_file(resolution_output(resolution))
         logger.stop()
         is_success = is_success and delete_file(CHALLENGE_1_LOG)
         
@@ -178,10 +258,20 @@ if __name__ == "__main__":
         sys.tracebacklimit = 0
         logger.add(CHALLENGE_1_LOG, level="DEBUG", rotation="12:00")
 
+        # machine readable report of the time, memory and I/O of each stage
+        start_run_report("challenge_1", CHALLENGE_1_RUN_REPORT, parameters={
+            "resolutions": CHALLENGE_1_RESOLUTIONS,
+            "scan_range_select": CHALLENGE_1_SCAN_RANGE_SELECT,
+            })
+
         logger.info("Starting Challenge #1")
-        main()
-        time_elapsed = timeit.default_timer() - start_time
-        logger.info(f"Challenge #1 Completed. Total Time Taken: {time_elapsed}s")
+        try:
+            main()
+            time_elapsed = timeit.default_timer() - start_time
+            logger.info(f"Challenge #1 Completed. Total Time Taken: {time_elapsed}s")
+        finally:
+            # the report of a failed run is saved too, with the errors of its stages
+            finish_run_report()
         logger.stop()
     else:
         logger.error("Please close cached files and rerun.")
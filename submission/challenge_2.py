@@ -9,8 +9,17 @@
 # Step 6.  Insert h3_level8_index to dataframe
 # Step 7.  Download SERVICE_REQUEST_HEX_SOURCE
 # Step 8.  Validate against SERVICE_REQUEST_HEX_SOURCE dataframe and save output
+#
+# main_streaming() performs Steps 3 to 8 in chunks of STREAMING_CHUNK_SIZE rows
+# so that peak memory does not grow with the size of SERVICE_REQUEST_SOURCE;
+# the chunk size is halved while a chunk exceeds STREAMING_MEMORY_TARGET_MB
+#
+# main_incremental() (CHALLENGE_2_INCREMENTAL = True) indexes only the requests
+# that are new or changed since the last run, and appends them to 
+# CHALLENGE_2_PARTITIONED_OUTPUT (see incremental_ingest.py)
 
 from support_library import(set_s3_client, 
+                            log_s3_client_stats,
                             BUCKET_NAME, 
                             download_file_from_s3_client,
                             delete_file,
@@ -20,7 +29,43 @@ from support_library import(set_s3_client,
                             CHALLENGE_2_OUTPUT,
                             CHALLENGE_2_LOG,
                             ERROR_THRESHOLD,
+                            H3_INDEX_NUM_WORKERS,
+                            STREAMING_CHUNK_SIZE,
+                            STREAMING_MIN_CHUNK_SIZE,
+                            STREAMING_MEMORY_TARGET_MB,
+                            log_peak_rss,
+                            MemoryMonitor,
+                            Prefetcher,
+                            CHALLENGE_2_PARQUET_OUTPUT,
+                            CHALLENGE_2_WRITE_PARQUET,
+                            CHALLENGE_2_POLYGON_JOIN,
+                            CITY_HEX_POLYGONS_8_SOURCE,
+                            CHALLENGE_2_PARTITIONED_OUTPUT,
+                            CHALLENGE_2_WRITE_PARTITIONS,
+                            CHALLENGE_2_VERIFY_PARTITIONS,
+                            delete_directory,
+                            instrument,
+                            run_stage,
+                            start_run_report,
+                            finish_run_report,
+                            CHALLENGE_2_RUN_REPORT,
+                            CHALLENGE_2_INCREMENTAL,
+                            INCREMENTAL_KEY_COLUMN,
+                            INCREMENTAL_LOOKBACK_DAYS,
+                            INCREMENTAL_FULL_PASS_DAYS,
                             )
+from columnar_io import(write_service_requests_parquet,
+                        ServiceRequestsParquetWriter,
+                        read_service_requests_parquet,
+                        write_partitioned_service_requests,
+                        partitioned_output_files,
+                        PartitionedServiceRequestsWriter,
+                        partition_file_name,
+                        )
+from incremental_ingest import ServiceRequestDelta, has_incremental_state
+from frame_diff import diff_frames, FrameDiffReport, FrameDigest
+from spatial_join import join_hex_polygons
+from h3_indexer import calculate_h3_index_parallel, h3_index_executor
 
 from loguru import logger
 import timeit
@@ -33,6 +78,7 @@ import h3
 
 def calculate_h3_level8_index(x):
 # Function is applied to each row in the dataframe using .apply()
+# Retained as the reference implementation for benchmark_h3_indexing.py
 # The last column         x[-1] is 'longitude'
 # The second last column  x[-2] is 'latitude' 
 
@@ -42,145 +88,536 @@ def calculate_h3_level8_index(x):
      # h3.geo_to_h3(lat, lon, resolution) returns the h3_level8_index for the lat/lon coordinates
      return h3.geo_to_h3(x[-2], x[-1], 8)
  
+@instrument("download")
+def download_service_file(s3_client, file_name, description):
+#   downloads file_name from BUCKET_NAME unless a cached copy is found
+#   return is_downloaded==True if the file is available on disk
+    if os.path.exists(file_name):
+        # this will use cached files to save time required to download.
+        logger.info(f"{description} file found: '{file_name}'")
+        return True
+
+    process_start_time = timeit.default_timer()
+    is_downloaded = download_file_from_s3_client(
+      s3_client, 
+      BUCKET_NAME, 
+      file_name
+      )
+    time_elapsed = timeit.default_timer() - process_start_time      
+    if is_downloaded:
+      logger.info(f"{description} file downloaded: '{file_name}'. Time Taken: {time_elapsed}s")
+    else:
+      logger.error(f"{description} file download failed: '{file_name}'")
+    return is_downloaded
+
 def main():
     # -------------------------------------------------------------------------
     # Step 1.  Retrieves credentials from CREDENTIALS_URL  
     # Step 2.  Create S3 Client for REGION with retrieved credentials
     s3_client = set_s3_client()
 
-    # -------------------------------------------------------------------------
-    # Step 3.  Download SERVICE_REQUEST_SOURCE
-    if os.path.exists(SERVICE_REQUEST_SOURCE):
-        # this will use cached files to save time required to download.
-        logger.info(f"Service data file found: '{SERVICE_REQUEST_SOURCE}'")
-        is_service_data_downloded = True
-    else:
-        # this will download SERVICE_REQUEST_SOURCE
-        process_start_time = timeit.default_timer()
-        is_service_data_downloded = download_file_from_s3_client(
-          s3_client, 
-          BUCKET_NAME, 
-          SERVICE_REQUEST_SOURCE
-          )
-        time_elapsed = timeit.default_timer() - process_start_time      
-        if is_service_data_downloded:
-          logger.info(f"Service data file downloaded: '{SERVICE_REQUEST_SOURCE}'. Time Taken: {time_elapsed}s")
-        else:
-          logger.error(f"Service data file download failed: '{SERVICE_REQUEST_SOURCE}'")
+    # start both downloads now, so SERVICE_REQUEST_HEX_SOURCE (Step 7) 
+    # downloads in the background while Steps 4 to 6 run
+    with Prefetcher() as prefetcher:
+        prefetcher.submit(SERVICE_REQUEST_SOURCE, download_service_file, s3_client, SERVICE_REQUEST_SOURCE, "Service data")
+        prefetcher.submit(SERVICE_REQUEST_HEX_SOURCE, download_service_file, s3_client, SERVICE_REQUEST_HEX_SOURCE, "Validation data")
+        if CHALLENGE_2_POLYGON_JOIN:
+            prefetcher.submit(CITY_HEX_POLYGONS_8_SOURCE, download_service_file, s3_client, CITY_HEX_POLYGONS_8_SOURCE, "Hex polygon")
 
-    # -------------------------------------------------------------------------
-    # Step 4.  Anaylse SERVICE_REQUEST_SOURCE
-    error_threshold_exceeded = True
-    try:
-        with gzip.open(SERVICE_REQUEST_SOURCE) as f_:
-            service_requests = pd.read_csv(f_)
+        # -------------------------------------------------------------------------
+        # Step 3.  Download SERVICE_REQUEST_SOURCE
+        is_service_data_downloded = prefetcher.result(SERVICE_REQUEST_SOURCE)
+
+        # -------------------------------------------------------------------------
+        # Step 4.  Anaylse SERVICE_REQUEST_SOURCE
+        error_threshold_exceeded = True
+        try:
+            with run_stage("read") as stage_:
+                with gzip.open(SERVICE_REQUEST_SOURCE) as f_:
+                    service_requests = pd.read_csv(f_)
+                stage_.rows_out = len(service_requests)
             
-        # analyse dataframe for errors
-        num_requests = len(service_requests)
-        # invalid data (null) in 'latitude' or 'longitude'
-        num_lat_errors  = service_requests['latitude'].isnull().sum()
-        num_lon_errors  = service_requests['longitude'].isnull().sum()
-        # num_diff_errors==0 indicate that when 'latitude', 'longitude' is also null
-        num_diff_errors =  len(service_requests['latitude'].isnull().compare(service_requests['longitude'].isnull()))
-        total_errors = max(num_lat_errors,num_lon_errors) + num_diff_errors
+            # analyse dataframe for errors
+            num_requests = len(service_requests)
+            # invalid data (null) in 'latitude' or 'longitude'
+            num_lat_errors  = service_requests['latitude'].isnull().sum()
+            num_lon_errors  = service_requests['longitude'].isnull().sum()
+            # num_diff_errors==0 indicate that when 'latitude', 'longitude' is also null
+            num_diff_errors =  len(service_requests['latitude'].isnull().compare(service_requests['longitude'].isnull()))
+            total_errors = max(num_lat_errors,num_lon_errors) + num_diff_errors
         
-        logger.info(f"Number of service requests: {num_requests}")
-        logger.info(f"Number of service requests with invalid 'latitude': {num_lat_errors}")
-        logger.info(f"Number of service requests with invalid 'longitude': {num_lon_errors}")
-        logger.info(f"Number of service requests with invalid 'latitude' or 'longitude': {total_errors}")
-
-        if total_errors/num_requests > ERROR_THRESHOLD:
-            logger.error(f"The error percentage is too high: '{total_errors/num_requests}'")
-            error_threshold_exceeded = True
-        else:
-            error_threshold_exceeded = False
+            logger.info(f"Number of service requests: {num_requests}")
+            logger.info(f"Number of service requests with invalid 'latitude': {num_lat_errors}")
+            logger.info(f"Number of service requests with invalid 'longitude': {num_lon_errors}")
+            logger.info(f"Number of service requests with invalid 'latitude' or 'longitude': {total_errors}")
+
+            if total_errors/num_requests > ERROR_THRESHOLD:
+                logger.error(f"The error percentage is too high: '{total_errors/num_requests}'")
+                error_threshold_exceeded = True
+            else:
+                error_threshold_exceeded = False
    
-    except FileNotFoundError:
-        logger.exception(f"Cannot open: '{SERVICE_REQUEST_SOURCE}'")
+        except FileNotFoundError:
+            logger.exception(f"Cannot open: '{SERVICE_REQUEST_SOURCE}'")
         
-    # -------------------------------------------------------------------------
-    # Step 5. Determine H3 resolution level 8 hexagon for each service request
-    if error_threshold_exceeded==False:
-        # processing one row at a time takes very long  
-        test_single_row_processing = False
-        if test_single_row_processing:
-            process_start_time = timeit.default_timer()
-            error_count = 0
-            processed_count = 0
-            for x in range(0,1000):
-              if service_requests.loc[[x]]["latitude"].isna()[x] or service_requests.loc[[x]]["longitude"].isna()[x]:
-                error_count = error_count + 1
-              else:
-                h3.geo_to_h3(service_requests.loc[[x]]["latitude"][x], 
-                             service_requests.loc[[x]]["longitude"][x], 8)
-                processed_count = processed_count +  1
-            time_elapsed = timeit.default_timer() - process_start_time
-            logger.info(f"Invalid service requests = {error_count}.")
-            logger.info(f"Processed {processed_count} service requests. Time Taken: {time_elapsed}s")
-            logger.info(f"Estimated Required Time = {num_requests/1000*time_elapsed}s")
-
-        # rather use the panda apply() function to each row
-        process_start_time = timeit.default_timer()
-        h3_level8_index = service_requests.apply(calculate_h3_level8_index, axis=1)
-        time_elapsed = timeit.default_timer() - process_start_time
-        logger.info(f"Computed H3 index for each service request. Time Taken: {time_elapsed}s")
-
         # -------------------------------------------------------------------------
-        # Step 6. Insert h3_level8_index to dataframe
-        service_requests[SERVICE_REQUEST_HEX_COLUMN_NAME] = h3_level8_index
-        # remove the first column to match SERVICE_REQUEST_HEX_SOURCE
-        service_requests = service_requests.iloc[:, 1:]
+        # Step 5. Determine H3 resolution level 8 hexagon for each service request
+        if error_threshold_exceeded==False:
+            # processing one row at a time takes very long  
+            test_single_row_processing = False
+            if test_single_row_processing:
+                process_start_time = timeit.default_timer()
+                error_count = 0
+                processed_count = 0
+                for x in range(0,1000):
+                  if service_requests.loc[[x]]["latitude"].isna()[x] or service_requests.loc[[x]]["longitude"].isna()[x]:
+                    error_count = error_count + 1
+                  else:
+                    h3.geo_to_h3(service_requests.loc[[x]]["latitude"][x], 
+                                 service_requests.loc[[x]]["longitude"][x], 8)
+                    processed_count = processed_count +  1
+                time_elapsed = timeit.default_timer() - process_start_time
+                logger.info(f"Invalid service requests = {error_count}.")
+                logger.info(f"Processed {processed_count} service requests. Time Taken: {time_elapsed}s")
+                logger.info(f"Estimated Required Time = {num_requests/1000*time_elapsed}s")
+
+            # the panda apply() function makes one python call per row, rather
+            # index the latitude/longitude arrays in a single vectorised pass.
+            # The row ranges are indexed on H3_INDEX_NUM_WORKERS processes; 
+            # set H3_INDEX_NUM_WORKERS = 1 to index serially
+            with run_stage("h3_index", rows_in=len(service_requests)) as stage_:
+                if CHALLENGE_2_POLYGON_JOIN and prefetcher.result(CITY_HEX_POLYGONS_8_SOURCE):
+                    # join the service requests to the polygons of CITY_HEX_POLYGONS_8_SOURCE:
+                    # requests outside the city hexes keep the H3 cell of their location
+                    h3_level8_index = join_hex_polygons(
+                      service_requests['latitude'].to_numpy(),
+                      service_requests['longitude'].to_numpy(),
+                      CITY_HEX_POLYGONS_8_SOURCE,
+                      8,
+                      )
+                else:
+                    h3_level8_index = calculate_h3_index_parallel(
+                      service_requests['latitude'].to_numpy(),
+                      service_requests['longitude'].to_numpy(),
+                      8,
+                      H3_INDEX_NUM_WORKERS,
+                      )
+            logger.info(f"Computed H3 index for each service request using {H3_INDEX_NUM_WORKERS} worker(s). Time Taken: {stage_.time_elapsed}s")
+
+            # -------------------------------------------------------------------------
+            # Step 6. Insert h3_level8_index to dataframe
+            service_requests[SERVICE_REQUEST_HEX_COLUMN_NAME] = h3_level8_index
+            # remove the first column to match SERVICE_REQUEST_HEX_SOURCE
+            service_requests = service_requests.iloc[:, 1:]
     
-        # -------------------------------------------------------------------------
-        # Step 7.  Download SERVICE_REQUEST_HEX_SOURCE
-        if os.path.exists(SERVICE_REQUEST_HEX_SOURCE):
-            logger.info(f"Validation data file found: '{SERVICE_REQUEST_HEX_SOURCE}'")
-            is_service_data_downloded = True
-        else:
-            process_start_time = timeit.default_timer()
-            is_service_data_downloded = download_file_from_s3_client(
-              s3_client, 
-              BUCKET_NAME, 
-              SERVICE_REQUEST_HEX_SOURCE
-              )
-            time_elapsed = timeit.default_timer() - process_start_time
-            if is_service_data_downloded:
-              logger.info(f"Validation data file downloaded: '{SERVICE_REQUEST_HEX_SOURCE}'. Time Taken: {time_elapsed}s")
-            else:
-              logger.error(f"Validation data file download failed: '{SERVICE_REQUEST_HEX_SOURCE}'")
+            # -------------------------------------------------------------------------
+            # Step 7.  Download SERVICE_REQUEST_HEX_SOURCE
+            # wait for the prefetched download
+            is_service_data_downloded = prefetcher.result(SERVICE_REQUEST_HEX_SOURCE)
+            prefetcher.report()
 
-        # -------------------------------------------------------------------------
-        # Step 8.   Validate against SERVICE_REQUEST_HEX_SOURCE and save output
-        try:
-            with gzip.open(SERVICE_REQUEST_HEX_SOURCE) as f_:
-                valid_requests = pd.read_csv(f_)
+            # -------------------------------------------------------------------------
+            # Step 8.   Validate against SERVICE_REQUEST_HEX_SOURCE and save output
+            try:
+                with run_stage("read_validation") as stage_:
+                    with gzip.open(SERVICE_REQUEST_HEX_SOURCE) as f_:
+                        valid_requests = pd.read_csv(f_)
+                    stage_.rows_out = len(valid_requests)
           
-            # compare dataframes
-            process_start_time = timeit.default_timer()
-            diff_dataframe = service_requests.compare(valid_requests)        
-            time_elapsed = timeit.default_timer() - process_start_time
+                # compare dataframes column by column
+                with run_stage("validate", rows_in=len(service_requests)) as stage_:
+                    diff_report = diff_frames(service_requests, valid_requests)
+                diff_report.log("computed dataframe")
       
-            if diff_dataframe.empty:
-                logger.info(f"Validated computed dataframe against '{SERVICE_REQUEST_HEX_SOURCE}'. Time Taken: {time_elapsed}s")
-                process_start_time = timeit.default_timer()
-                service_requests.to_csv(CHALLENGE_2_OUTPUT, index=False)
-                time_elapsed = timeit.default_timer() - process_start_time
-                logger.info(f"Output saved to '{CHALLENGE_2_OUTPUT}'. Time Taken: {time_elapsed}s")
+                if diff_report.is_equal:
+                    logger.info(f"Validated computed dataframe against '{SERVICE_REQUEST_HEX_SOURCE}'. Time Taken: {stage_.time_elapsed}s")
+                    with run_stage("write_csv", rows_in=len(service_requests)) as stage_:
+                        service_requests.to_csv(CHALLENGE_2_OUTPUT, index=False)
+                    logger.info(f"Output saved to '{CHALLENGE_2_OUTPUT}'. Time Taken: {stage_.time_elapsed}s")
+
+                    if CHALLENGE_2_WRITE_PARQUET:
+                        # typed columnar copy of the output for downstream scripts
+                        with run_stage("write_parquet", rows_in=len(service_requests)) as stage_:
+                            file_size = write_service_requests_parquet(service_requests, CHALLENGE_2_PARQUET_OUTPUT)
+                        logger.info(f"Output saved to '{CHALLENGE_2_PARQUET_OUTPUT}' ({file_size} bytes). Time Taken: {stage_.time_elapsed}s")
+
+                    if CHALLENGE_2_WRITE_PARTITIONS:
+                        # copy of the output partitioned by H3 parent cell for spatial queries
+                        with run_stage("write_partitions", rows_in=len(service_requests)) as stage_:
+                            write_partitioned_service_requests(service_requests, CHALLENGE_2_PARTITIONED_OUTPUT)
+                        logger.info(f"Output saved to '{CHALLENGE_2_PARTITIONED_OUTPUT}'. Time Taken: {stage_.time_elapsed}s")
+                        if CHALLENGE_2_VERIFY_PARTITIONS:
+                            verify_partitioned_output(FrameDigest().update(service_requests))
         
-            else:
-                logger.info(f"Computed is not the same as '{SERVICE_REQUEST_HEX_SOURCE}'")
+                else:
+                    logger.info(f"Computed is not the same as '{SERVICE_REQUEST_HEX_SOURCE}'")
 
-        except FileNotFoundError:
-            logger.exception(f"Cannot open: '{SERVICE_REQUEST_HEX_SOURCE}'")
+            except FileNotFoundError:
+                logger.exception(f"Cannot open: '{SERVICE_REQUEST_HEX_SOURCE}'")
+
+    log_s3_client_stats()
             
+def verify_partitioned_output(output_digest):
+#   return True if the rows of CHALLENGE_2_PARTITIONED_OUTPUT, read one file at a
+#   time, have the same order-independent digest as output_digest (a FrameDigest
+#   of the output)
+    with run_stage("verify_partitions") as stage_:
+        partitioned_digest = FrameDigest()
+        for file_name in partitioned_output_files(CHALLENGE_2_PARTITIONED_OUTPUT):
+            partitioned_digest.update(read_service_requests_parquet(file_name, h3_as_string=False))
+    if partitioned_digest.unordered != output_digest.unordered:
+        logger.error(f"'{CHALLENGE_2_PARTITIONED_OUTPUT}' does not hold the same rows as the output. Time Taken: {stage_.time_elapsed}s")
+        return False
+    logger.info(f"Verified '{CHALLENGE_2_PARTITIONED_OUTPUT}': {partitioned_digest.rows} rows. Time Taken: {stage_.time_elapsed}s")
+    return True
+
+def read_column_dtypes(file_name):
+#   return a dtype for each column of the gzipped csv file_name:
+#   float for 'latitude' and 'longitude', text (str) for all other columns
+#   (main_incremental() hashes the text, which does not depend on the chunk)
+    with gzip.open(file_name) as f_:
+        column_names = pd.read_csv(f_, nrows=0).columns
+    return {
+      name: float if name in ('latitude', 'longitude') else str 
+      for name in column_names
+      }
+
+def _merge_dtypes(dtype_a, dtype_b):
+#   return the dtype of a column read as dtype_a in one chunk and dtype_b in another
+    if dtype_a == dtype_b:
+        return dtype_a
+    if all(pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype) 
+           for dtype in (dtype_a, dtype_b)):
+        # e.g. integers in one chunk, and integers with nulls (floats) in another
+        return float
+    return str
+
+def infer_column_dtypes(file_name, chunk_size=STREAMING_CHUNK_SIZE):
+#   return the dtype of each column of the gzipped csv file_name, as main() 
+#   reads it with a single pd.read_csv(): the dtypes pandas infers for each 
+#   chunk are merged over a pass through the file. Non-numeric columns are 
+#   read as text (str).
+#   Reading every chunk with these dtypes writes the same csv as main(), 
+#   whatever the values of a particular chunk.
+    dtypes = {}
+    with run_stage("infer_dtypes") as stage_:
+        with gzip.open(file_name) as f_:
+            for chunk in pd.read_csv(f_, chunksize=chunk_size):
+                for name, dtype in chunk.dtypes.items():
+                    dtypes[name] = dtype if name not in dtypes else _merge_dtypes(dtypes[name], dtype)
+    dtypes = {name: dtype if pd.api.types.is_numeric_dtype(dtype) else str for name, dtype in dtypes.items()}
+    logger.info(f"Column types of '{file_name}' inferred. Time Taken: {stage_.time_elapsed}s")
+    return dtypes
+
+def next_chunk(reader, num_rows):
+#   return the next num_rows rows of a pd.read_csv() chunk reader, None at the end of the file
+    try:
+        return reader.get_chunk(num_rows)
+    except StopIteration:
+        return None
+
+def main_streaming(chunk_size=STREAMING_CHUNK_SIZE, memory_target_mb=STREAMING_MEMORY_TARGET_MB,
+                   min_chunk_size=STREAMING_MIN_CHUNK_SIZE):
+    # -------------------------------------------------------------------------
+    # Step 1.  Retrieves credentials from CREDENTIALS_URL  
+    # Step 2.  Create S3 Client for REGION with retrieved credentials
+    s3_client = set_s3_client()
+
+    # -------------------------------------------------------------------------
+    # Step 3.  Download SERVICE_REQUEST_SOURCE
+    # Step 7.  Download SERVICE_REQUEST_HEX_SOURCE
+    # both files are read side by side, so both are downloaded concurrently
+    # before processing
+    with Prefetcher() as prefetcher:
+        prefetcher.submit(SERVICE_REQUEST_SOURCE, download_service_file, s3_client, SERVICE_REQUEST_SOURCE, "Service data")
+        prefetcher.submit(SERVICE_REQUEST_HEX_SOURCE, download_service_file, s3_client, SERVICE_REQUEST_HEX_SOURCE, "Validation data")
+        is_service_data_downloded = prefetcher.result(SERVICE_REQUEST_SOURCE)
+        is_validation_downloded = prefetcher.result(SERVICE_REQUEST_HEX_SOURCE)
+        prefetcher.report()
+    if not (is_service_data_downloded and is_validation_downloded):
+        return
+
+    # -------------------------------------------------------------------------
+    # Steps 4 to 8 are done for each chunk of chunk_size rows.
+    # Every chunk is read with the column types main() reads, inferred over a
+    # first pass through the file, so the output is written as main() writes it,
+    # regardless of the dtype pandas would infer for a particular chunk.
+    # The peak RSS of each chunk, H3 indexing workers included, is sampled by
+    # a MemoryMonitor. While a chunk exceeds memory_target_mb the next chunks
+    # are read with half as many rows, down to min_chunk_size.
+    # The output is written to a partial file that only replaces 
+    # CHALLENGE_2_OUTPUT once every chunk has been validated, and likewise
+    # its parquet copy and partitions.
+    partial_output = CHALLENGE_2_OUTPUT + ".partial"
+    parquet_writer = None
+    partition_writer = None
+    if CHALLENGE_2_WRITE_PARQUET:
+        # the typed columnar copy, one row group per chunk
+        parquet_writer = ServiceRequestsParquetWriter(CHALLENGE_2_PARQUET_OUTPUT)
+    output_digest = None
+    if CHALLENGE_2_WRITE_PARTITIONS:
+        # each chunk adds its own files to the partitions
+        partition_writer = PartitionedServiceRequestsWriter(CHALLENGE_2_PARTITIONED_OUTPUT)
+        if CHALLENGE_2_VERIFY_PARTITIONS:
+            output_digest = FrameDigest()
+    diff_report = FrameDiffReport()
+    num_requests    = 0
+    num_lat_errors  = 0
+    num_lon_errors  = 0
+    num_diff_errors = 0
+    is_computed_valid = True
+    stage_time = {'read': 0.0, 'index': 0.0, 'validate': 0.0, 'write': 0.0}
+    peak_rss_mb = None
+    is_memory_target_missed = False
+    memory_monitor = MemoryMonitor()
+    # one pool of H3 indexing workers for all the chunks
+    h3_executor = h3_index_executor(H3_INDEX_NUM_WORKERS) if H3_INDEX_NUM_WORKERS > 1 else None
+    try:
+        source_dtypes = infer_column_dtypes(SERVICE_REQUEST_SOURCE, chunk_size)
+        with gzip.open(SERVICE_REQUEST_HEX_SOURCE) as f_valid:
+            valid_columns = pd.read_csv(f_valid, nrows=0).columns
+        # SERVICE_REQUEST_HEX_SOURCE holds the same requests, and the H3 index as text
+        valid_dtypes = {name: source_dtypes.get(name, str) for name in valid_columns}
+        with gzip.open(SERVICE_REQUEST_SOURCE) as f_source, \
+             gzip.open(SERVICE_REQUEST_HEX_SOURCE) as f_valid:
+            source_reader = pd.read_csv(f_source, dtype=source_dtypes, chunksize=chunk_size)
+            valid_reader  = pd.read_csv(f_valid, dtype=valid_dtypes, chunksize=chunk_size)
+            chunk_number = 0
+            chunk_rows = chunk_size
+            while True:
+                with memory_monitor.window() as chunk_memory:
+                    # read the next chunk from both files
+                    with run_stage("read") as stage_:
+                        service_requests = next_chunk(source_reader, chunk_rows)
+                        valid_requests   = next_chunk(valid_reader, chunk_rows)
+                        stage_.rows_out = 0 if service_requests is None else len(service_requests)
+                    stage_time['read'] += stage_.time_elapsed
+                    if service_requests is None or valid_requests is None:
+                        if service_requests is not None or valid_requests is not None:
+                            logger.error(f"Computed has a different number of rows to '{SERVICE_REQUEST_HEX_SOURCE}'")
+                            is_computed_valid = False
+                        break
+
+                    # Step 4.  Anaylse the chunk for errors
+                    num_requests    += len(service_requests)
+                    lat_is_null      = service_requests['latitude'].isnull()
+                    lon_is_null      = service_requests['longitude'].isnull()
+                    num_lat_errors  += lat_is_null.sum()
+                    num_lon_errors  += lon_is_null.sum()
+                    num_diff_errors += (lat_is_null != lon_is_null).sum()
+
+                    # Step 5.  Determine H3 resolution level 8 hexagon for each service request
+                    # Step 6.  Insert h3_level8_index to dataframe
+                    with run_stage("h3_index", rows_in=len(service_requests)) as stage_:
+                        service_requests[SERVICE_REQUEST_HEX_COLUMN_NAME] = calculate_h3_index_parallel(
+                          service_requests['latitude'].to_numpy(),
+                          service_requests['longitude'].to_numpy(),
+                          8,
+                          H3_INDEX_NUM_WORKERS,
+                          executor=h3_executor,
+                          )
+                        service_requests = service_requests.iloc[:, 1:]
+                    stage_time['index'] += stage_.time_elapsed
+
+                    # Step 8.  Validate the chunk against SERVICE_REQUEST_HEX_SOURCE
+                    with run_stage("validate", rows_in=len(service_requests)) as stage_:
+                        num_mismatches = diff_report.num_mismatches
+                        diff_frames(service_requests, valid_requests, report=diff_report, row_offset=num_requests - len(service_requests))
+                        if not diff_report.is_equal:
+                            if diff_report.num_mismatches > num_mismatches:
+                                logger.error(f"Computed chunk {chunk_number} is not the same as '{SERVICE_REQUEST_HEX_SOURCE}'")
+                            is_computed_valid = False
+                        if output_digest is not None:
+                            output_digest.update(service_requests)
+                    stage_time['validate'] += stage_.time_elapsed
+
+                    # Step 8.  Append the chunk to the partial output
+                    with run_stage("write", rows_in=len(service_requests)) as stage_:
+                        service_requests.to_csv(
+                          partial_output, 
+                          index=False, 
+                          mode="w" if chunk_number == 0 else "a", 
+                          header=chunk_number == 0,
+                          )
+                        if parquet_writer is not None:
+                            parquet_writer.write(service_requests)
+                        if partition_writer is not None:
+                            partition_writer.write(service_requests)
+                    stage_time['write'] += stage_.time_elapsed
+
+                    logger.debug(f"Chunk {chunk_number} processed: {num_requests} service requests")
+                chunk_peak_rss_mb = log_peak_rss(f"chunk {chunk_number} ({len(service_requests)} rows)", 
+                                                 memory_target_mb, chunk_memory.peak_mb)
+                if chunk_memory.peak_mb is not None:
+                    peak_rss_mb = max(peak_rss_mb or 0.0, chunk_peak_rss_mb)
+                    if memory_target_mb is not None and chunk_peak_rss_mb > memory_target_mb:
+                        if chunk_rows > min_chunk_size:
+                            chunk_rows = max(chunk_rows//2, min_chunk_size)
+                            logger.warning(f"Chunk size reduced to {chunk_rows} rows to meet the memory target")
+                        elif not is_memory_target_missed:
+                            is_memory_target_missed = True
+                            logger.error(f"The memory target of {memory_target_mb} MB is exceeded at the minimum chunk size of {min_chunk_size} rows")
+                chunk_number = chunk_number + 1
+
+    except FileNotFoundError:
+        logger.exception(f"Cannot open: '{SERVICE_REQUEST_SOURCE}' or '{SERVICE_REQUEST_HEX_SOURCE}'")
+        is_computed_valid = False
+    finally:
+        memory_monitor.stop()
+        if h3_executor is not None:
+            h3_executor.shutdown()
+
+    diff_report.log("computed dataframe")
+    for stage, time_elapsed in stage_time.items():
+        logger.info(f"Streaming stage '{stage}' completed. Time Taken: {time_elapsed}s")
+    log_peak_rss("streaming pipeline", memory_target_mb, peak_rss_mb)
+
+    # Step 4.  Check the error threshold over all chunks
+    total_errors = max(num_lat_errors,num_lon_errors) + num_diff_errors
+    logger.info(f"Number of service requests: {num_requests}")
+    logger.info(f"Number of service requests with invalid 'latitude' or 'longitude': {total_errors}")
+    if num_requests == 0 or total_errors/num_requests > ERROR_THRESHOLD:
+        logger.error(f"The error percentage is too high: '{total_errors/max(num_requests, 1)}'")
+        is_computed_valid = False
+
+    # Step 8.  Save output
+    if is_computed_valid:
+        os.replace(partial_output, CHALLENGE_2_OUTPUT)
+        logger.info(f"Validated computed dataframe against '{SERVICE_REQUEST_HEX_SOURCE}'")
+        logger.info(f"Output saved to '{CHALLENGE_2_OUTPUT}'")
+        if parquet_writer is not None:
+            # written after the csv, so challenge_5.py sees a current copy
+            with run_stage("write_parquet"):
+                file_size = parquet_writer.close()
+            logger.info(f"Output saved to '{CHALLENGE_2_PARQUET_OUTPUT}' ({file_size} bytes)")
+        if partition_writer is not None:
+            with run_stage("write_partitions"):
+                partition_writer.close()
+            if output_digest is not None:
+                verify_partitioned_output(output_digest)
+    else:
+        logger.info(f"Computed is not the same as '{SERVICE_REQUEST_HEX_SOURCE}'")
+        delete_file(partial_output)
+        if parquet_writer is not None:
+            parquet_writer.abort()
+        if partition_writer is not None:
+            partition_writer.abort()
+
+def main_incremental(chunk_size=STREAMING_CHUNK_SIZE, lookback_days=INCREMENTAL_LOOKBACK_DAYS):
+    # -------------------------------------------------------------------------
+    # Step 1.  Retrieves credentials from CREDENTIALS_URL  
+    # Step 2.  Create S3 Client for REGION with retrieved credentials
+    # Step 3.  Download SERVICE_REQUEST_SOURCE
+    s3_client = set_s3_client()
+    if not download_service_file(s3_client, SERVICE_REQUEST_SOURCE, "Service data"):
+        return
+
+    # -------------------------------------------------------------------------
+    # Steps 4 to 6 are done for the new and changed requests only, found chunk
+    # by chunk against the high-water mark of CHALLENGE_2_PARTITIONED_OUTPUT.
+    # Step 8 (validation) is not done: SERVICE_REQUEST_HEX_SOURCE does not hold
+    # requests newer than the extract it was computed from.
+    # The new files only become part of the output when the manifest is 
+    # replaced, once every chunk has been written.
+    writer = PartitionedServiceRequestsWriter(CHALLENGE_2_PARTITIONED_OUTPUT, append=True)
+    if writer.is_append and not has_incremental_state(writer.manifest):
+        # the store has no row index (written by main() or main_streaming(), or
+        # by an earlier version): appending to it would duplicate its requests
+        logger.warning(f"No incremental state in '{CHALLENGE_2_PARTITIONED_OUTPUT}'. Rebuilding it from the extract.")
+        writer = PartitionedServiceRequestsWriter(CHALLENGE_2_PARTITIONED_OUTPUT)
+    delta = ServiceRequestDelta(CHALLENGE_2_PARTITIONED_OUTPUT, writer.manifest if writer.is_append else None, lookback_days)
+    num_delta      = 0
+    num_lat_errors = 0
+    num_lon_errors = 0
+    num_diff_errors = 0
+    # one pool of H3 indexing workers for all the chunks
+    h3_executor = h3_index_executor(H3_INDEX_NUM_WORKERS) if H3_INDEX_NUM_WORKERS > 1 else None
+    try:
+        source_dtypes = read_column_dtypes(SERVICE_REQUEST_SOURCE)
+        with gzip.open(SERVICE_REQUEST_SOURCE) as f_source:
+            for chunk in pd.read_csv(f_source, dtype=source_dtypes, chunksize=chunk_size):
+                with run_stage("select", rows_in=len(chunk)) as stage_:
+                    service_requests, row_hashes = delta.select(chunk)
+                    stage_.rows_out = len(service_requests)
+                if service_requests.empty:
+                    continue
+
+                # Step 4.  Anaylse the new and changed requests for errors
+                num_delta       += len(service_requests)
+                lat_is_null      = service_requests['latitude'].isnull()
+                lon_is_null      = service_requests['longitude'].isnull()
+                num_lat_errors  += lat_is_null.sum()
+                num_lon_errors  += lon_is_null.sum()
+                num_diff_errors += (lat_is_null != lon_is_null).sum()
+
+                # Step 5.  Determine H3 resolution level 8 hexagon for each service request
+                # Step 6.  Insert h3_level8_index to dataframe
+                with run_stage("h3_index", rows_in=len(service_requests)):
+                    service_requests[SERVICE_REQUEST_HEX_COLUMN_NAME] = calculate_h3_index_parallel(
+                      service_requests['latitude'].to_numpy(),
+                      service_requests['longitude'].to_numpy(),
+                      8,
+                      H3_INDEX_NUM_WORKERS,
+                      executor=h3_executor,
+                      )
+                    service_requests = service_requests.iloc[:, 1:]
+
+                # append the requests to the partitions, recording the file of each request
+                with run_stage("write", rows_in=len(service_requests)):
+                    file_names = [partition_file_name(key, writer.batch) for key in writer.partition_keys(service_requests)]
+                    delta.record(service_requests, row_hashes, file_names)
+                    writer.write(service_requests)
+
+        # requests that changed or are no longer in the extract are removed from
+        # the files written by earlier runs, and the earlier rows of a repeated
+        # key from the files written by this run
+        superseded = delta.superseded()
+        with run_stage("remove", rows_in=sum(len(keys) for keys in superseded.values())):
+            renamed = writer.remove_rows(INCREMENTAL_KEY_COLUMN, superseded)
+        delta.log()
+
+    except FileNotFoundError:
+        logger.exception(f"Cannot open: '{SERVICE_REQUEST_SOURCE}'")
+        writer.abort()
+        return
+    except Exception:
+        writer.abort()
+        raise
+    finally:
+        if h3_executor is not None:
+            h3_executor.shutdown()
+
+    # Step 4.  Check the error threshold over the new and changed requests
+    total_errors = max(num_lat_errors,num_lon_errors) + num_diff_errors
+    logger.info(f"Number of new and changed service requests with invalid 'latitude' or 'longitude': {total_errors}")
+    if num_delta and total_errors/num_delta > ERROR_THRESHOLD:
+        logger.error(f"The error percentage is too high: '{total_errors/num_delta}'")
+        writer.abort()
+        return
+
+    # Save output: the manifest is replaced last. An unchanged extract
+    # rewrites the same manifest, so downstream stages see no change.
+    with run_stage("write_partitions"):
+        if not delta.is_unchanged() or not writer.is_append:
+            delta.commit(writer, renamed)
+        writer.close()
+    log_s3_client_stats()
+
 if __name__ == "__main__":
     # This will delete all cached files and force all downloads
-    delete_cached_files = True    # set to False if cached downloads are used.  
+    # pipeline.py runs the script with --keep-cached-files to reuse them
+    delete_cached_files = "--keep-cached-files" not in sys.argv[1:]
+    # This will process SERVICE_REQUEST_SOURCE in chunks of STREAMING_CHUNK_SIZE rows
+    use_streaming_pipeline = False    # set to True for large request histories
     is_success = True
     if delete_cached_files:
         is_success = delete_file(SERVICE_REQUEST_SOURCE)
         is_success = is_success and delete_file(SERVICE_REQUEST_HEX_SOURCE)
         is_success = is_success and delete_file(CHALLENGE_2_OUTPUT)
+        is_success = is_success and delete_file(CHALLENGE_2_PARQUET_OUTPUT)
+        if not CHALLENGE_2_INCREMENTAL:
+            # the incremental store is kept: it holds the requests of earlier runs
+            is_success = is_success and delete_directory(CHALLENGE_2_PARTITIONED_OUTPUT)
         logger.stop()
         is_success = is_success and delete_file(CHALLENGE_2_LOG)
       
@@ -194,10 +631,32 @@ if __name__ == "__main__":
         sys.tracebacklimit = 0
         logger.add(CHALLENGE_2_LOG, level="DEBUG", rotation="12:00")
     
+        # machine readable report of the time, memory and I/O of each stage
+        start_run_report("challenge_2", CHALLENGE_2_RUN_REPORT, parameters={
+            "use_streaming_pipeline": use_streaming_pipeline,
+            "streaming_chunk_size": STREAMING_CHUNK_SIZE,
+            "h3_index_num_workers": H3_INDEX_NUM_WORKERS,
+            "polygon_join": CHALLENGE_2_POLYGON_JOIN,
+            "write_parquet": CHALLENGE_2_WRITE_PARQUET,
+            "write_partitions": CHALLENGE_2_WRITE_PARTITIONS,
+            "incremental": CHALLENGE_2_INCREMENTAL,
+            "incremental_lookback_days": INCREMENTAL_LOOKBACK_DAYS,
+            "incremental_full_pass_days": INCREMENTAL_FULL_PASS_DAYS,
+            })
+
         logger.info("Starting Challenge #2")
-        main()
-        time_elapsed = timeit.default_timer() - start_time
-        logger.info(f"Challenge #2 Completed. Total Time Taken: {time_elapsed}s")     
+        try:
+            if CHALLENGE_2_INCREMENTAL:
+                main_incremental()
+            elif use_streaming_pipeline:
+                main_streaming()
+            else:
+                main()
+            time_elapsed = timeit.default_timer() - start_time
+            logger.info(f"Challenge #2 Completed. Total Time Taken: {time_elapsed}s")     
+        finally:
+            # the report of a failed run is saved too, with the errors of its stages
+            finish_run_report()
         logger.stop()
     else:
         logger.error("Please close cached files and rerun.")
\ No newline at end of file
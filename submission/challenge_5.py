@@ -10,16 +10,48 @@
 # Step 6.  Anonymise dataframe and save dataframe to disk
 
 from support_library import(delete_file,
+                            delete_directory,
+                            Prefetcher,
                             REQUIRED_SUBURB,
                             CHALLENGE_2_OUTPUT,
+                            CHALLENGE_2_PARQUET_OUTPUT,
+                            CHALLENGE_2_PARTITIONED_OUTPUT,
+                            CHALLENGE_2_WRITE_PARTITIONS,
+                            CHALLENGE_2_INCREMENTAL,
+                            PARTITION_MANIFEST,
                             CHALLENGE_5_ARCGIS_URL,
                             WIND_DATA_SOURCE,
                             WIND_DATA_OUTPUT,
                             CHALLENGE_5_TMP_WIND_DATA,
+                            CHALLENGE_5_WIND_STATION,
+                            WIND_DATA_STORE_DIR,
                             CHALLENGE_5_TMP_OUTPUT,
                             CHALLENGE_5_OUTPUT, 
+                            CHALLENGE_5_SUBSAMPLE_CACHE,
                             CHALLENGE_5_LOG,
+                            OFFICIAL_SUBURBS_URL,
+                            OFFICIAL_SUBURBS_OUTPUT,
+                            SUBURB_NAME_PROPERTY,
+                            SUBURB_COLUMN_NAME,
+                            CHALLENGE_5_LABEL_SUBURBS,
+                            download_arcgis_layer,
+                            instrument,
+                            run_stage,
+                            start_run_report,
+                            finish_run_report,
+                            CHALLENGE_5_RUN_REPORT,
+                            ANONYMISE_SPATIAL_MODE,
+                            SPATIAL_FILTER_MODE,
                             )
+from columnar_io import(read_service_requests_parquet,
+                        is_parquet_copy_current,
+                        is_partitioned_copy_current,
+                        )
+from subsample_cache import PartitionSubsampleCache
+from spatial_join import PolygonLayerIndex, read_polygon_layer
+from spatial_filter import SpatialFilter
+from wind_store import WindDataStore
+from anonymise import anonymise_timestamps, anonymise_locations
 
 from loguru import logger
 import timeit
@@ -31,28 +63,56 @@ from requests.exceptions import HTTPError
 import matplotlib.pyplot as plt
 import numpy as np 
 import pandas as pd
-from pandas_ods_reader import read_ods
-from datetime import timedelta
-import pyproj
+import zipfile
+import xml.etree.ElementTree as ET
 
   
-def compute_belville_south_centroid():
+@instrument("suburb_layer")
+def load_suburb_layer():
+# Returns the features of all official suburbs, downloaded once from OFFICIAL_SUBURBS_URL
+# and cached in OFFICIAL_SUBURBS_OUTPUT. Returns None if the layer is not available.
+    if os.path.exists(OFFICIAL_SUBURBS_OUTPUT):
+        logger.info(f"Suburb layer file found: '{OFFICIAL_SUBURBS_OUTPUT}'")
+    else:
+        process_start_time = timeit.default_timer()
+        if not download_arcgis_layer(OFFICIAL_SUBURBS_URL, OFFICIAL_SUBURBS_OUTPUT, SUBURB_NAME_PROPERTY):
+            return None
+        time_elapsed = timeit.default_timer() - process_start_time
+        logger.info(f"Suburb layer file downloaded: '{OFFICIAL_SUBURBS_OUTPUT}'. Time Taken: {time_elapsed}s")
+    try:
+        return read_polygon_layer(OFFICIAL_SUBURBS_OUTPUT)
+    except (OSError, ValueError, KeyError):
+        logger.exception(f"Cannot read: '{OFFICIAL_SUBURBS_OUTPUT}'")
+        return None
+
+def load_suburbs_and_centroid():
+# Returns (suburb_features, centroid): the official suburb layer, read once, and
+# the centroid of REQUIRED_SUBURB taken from it. suburb_features is None if the
+# layer is not available; the centroid is then found with CHALLENGE_5_ARCGIS_URL
+    suburb_features = load_suburb_layer()
+    return suburb_features, compute_belville_south_centroid(suburb_features)
+
+@instrument("centroid")
+def compute_belville_south_centroid(suburb_features=None):
 # Function is applied to each row in the dataframe using .apply()
 # All Suburbs are depicted with polygons on the City of Cape Town Corporate GIS Server
 # - https://odp-cctegis.opendata.arcgis.com/datasets/cctegis::official-planning-suburbs/about
 # An arcgis query was made to search fo the polygon for "BELLVILLE SOUTH"
 # The urls for the query is CHALLENGE_5_ARCGIS_URL
+# If suburb_features (from load_suburb_layer()) are given, the polygon is taken
+# from them and no query is made
 
     centroid = np.array([0.0, 0.0])
     # The CHALLENGE_5_ARCGIS_URL url returns a json response for the query with text=BELLVILLE+SOUTH
     try:
         process_start_time = timeit.default_timer()
-        json_response = requests.get(CHALLENGE_5_ARCGIS_URL).json()
+        if suburb_features is None:
+            suburb_features = requests.get(CHALLENGE_5_ARCGIS_URL).json()["features"]
     
         # features for two suburbs are returned: BELLVILLE SOUTH INDUSTRIA and BELLVILLE SOUTH
         # check OFC_SBRB_NAME and extract the coordinates for REQUIRED_SUBURB = "BELLVILLE SOUTH"
         polygon_coords = []
-        for suburb in json_response["features"]:
+        for suburb in suburb_features:
             if suburb["properties"]["OFC_SBRB_NAME"]==REQUIRED_SUBURB:
                 polygon_coords = suburb["geometry"]["coordinates"][0]
         
@@ -95,26 +155,11 @@ def compute_belville_south_centroid():
 
     return centroid
  
-def check_if_within_1_minute_of_centroid(x, centroid_longitude, centroid_latitude):
-# Function is applied to each row in the dataframe using .apply()
-# The last column        x[-1] is 'h3_level8_index'
-# The second last column x[-2] is 'longitude'
-# The third last column  x[-3] is 'latitude'
-# Returns True if coordinate is within 1 minute to the centroid
-    if np.isnan(x[-3]) or np.isnan(x[-2]):
-        return False
-    else:
-        # within 1 minute is interpreted as the 1 minute lat-long grid 
-        # around the centroid.
-        # This is within +/-1 minute in long and within +/-1 minute in lat
-        is_long_within_1_min = abs(centroid_longitude - x[-2]) <= 1/60
-        is_lat_within_1_min  = abs(centroid_latitude - x[-3]) <= 1/60
-        return is_long_within_1_min and is_lat_within_1_min
- 
-def extract_belville_wind_data():
+@instrument("download_wind_data")
+def download_wind_data():
+#   downloads WIND_DATA_SOURCE to WIND_DATA_OUTPUT unless a cached copy is found
+#   return is_wind_data_downloded==True if the file is available on disk
     is_wind_data_downloded = False
-    wind_speed_df = pd.DataFrame([])
-    
     if os.path.exists(WIND_DATA_OUTPUT):
         # this will use cached files to save time required to download.
         logger.info(f"Wind data file found: '{WIND_DATA_OUTPUT}'")
@@ -139,46 +184,24 @@ def extract_belville_wind_data():
             logger.exception(f"Error occurred: {err}")
         except FileNotFoundError:
             logger.exception(f"Cannot read/write: '{WIND_DATA_OUTPUT}'")
-            
+
+    return is_wind_data_downloded
+
+@instrument("wind_data")
+def extract_belville_wind_data(wind_store):
+#   ingests WIND_DATA_OUTPUT into wind_store and returns the CHALLENGE_5_WIND_STATION
+#   readings, or an empty dataframe if the wind data is not available
+    wind_speed_df = pd.DataFrame([])
+    is_wind_data_downloded = download_wind_data()
         
     if is_wind_data_downloded:
         try:
-            process_start_time = timeit.default_timer()
-            wind_speed_df = read_ods(WIND_DATA_OUTPUT)
-            time_elapsed = timeit.default_timer() - process_start_time      
-            logger.info(f"Wind data file read from file: '{WIND_DATA_OUTPUT}'. Time Taken: {time_elapsed}s")
+            # the WIND_DATA_STATIONS columns are read straight from the spreadsheet, 
+            # or from the typed cache of a previous run, and added to the store
+            wind_store.ingest(WIND_DATA_OUTPUT)
+            wind_speed_df = wind_store.station_data(CHALLENGE_5_WIND_STATION)
   
-            # delete header rows and footer rows, leaving only the with wind data
             process_start_time = timeit.default_timer()
-            wind_speed_df = wind_speed_df[4:-8]
-          
-            # delete columns for other stations
-            wind_speed_df.pop('unnamed.1') 
-            wind_speed_df.pop('unnamed.2') 
-            wind_speed_df.pop('unnamed.5') 
-            wind_speed_df.pop('unnamed.6') 
-            wind_speed_df.pop('unnamed.7') 
-            wind_speed_df.pop('unnamed.8') 
-            wind_speed_df.pop('unnamed.9') 
-            wind_speed_df.pop('unnamed.10') 
-            wind_speed_df.pop('unnamed.11') 
-            wind_speed_df.pop('unnamed.12') 
-            wind_speed_df.pop('unnamed.13') 
-            wind_speed_df.pop('unnamed.14') 
-          
-            # rename columns
-            wind_speed_df = wind_speed_df.rename(columns = {
-              'MultiStation:  Periodically: 01/01/2020 00:00-31/12/2020 23:59  Type: AVG 1 Hr.':'date_and_time',
-              'unnamed.3':'wind_direction_deg',
-              'unnamed.4':'wind_speed_m_s',
-              })
-           
-            wind_speed_df['wind_direction_deg'][wind_speed_df['wind_direction_deg']=="<Samp"] = None
-            wind_speed_df['wind_direction_deg'][wind_speed_df['wind_direction_deg']=="NoData"] = None
-            wind_speed_df['wind_speed_m_s'][wind_speed_df['wind_speed_m_s']=="<Samp"] = None
-            wind_speed_df['wind_speed_m_s'][wind_speed_df['wind_speed_m_s']=="NoData"] = None
-            wind_speed_df['wind_speed_m_s'][wind_speed_df['wind_speed_m_s']=="Calm"] = None
-            wind_speed_df['date_and_time']  = wind_speed_df['date_and_time'] + "+02:00"
             wind_speed_df.to_csv(CHALLENGE_5_TMP_WIND_DATA, index=False)
             time_elapsed = timeit.default_timer() - process_start_time      
             logger.info(f"Wind data cleaned and saved to file: '{CHALLENGE_5_TMP_WIND_DATA}'. Time Taken: {time_elapsed}s")
@@ -187,148 +210,165 @@ def extract_belville_wind_data():
             logger.exception(f"Cannot read/write: '{WIND_DATA_OUTPUT}'")
         except PermissionError:
             logger.exception(f"Permission error: '{WIND_DATA_OUTPUT}'") 
+        except (zipfile.BadZipFile, KeyError, ET.ParseError):
+            logger.exception(f"Cannot read spreadsheet: '{WIND_DATA_OUTPUT}'") 
 
     return wind_speed_df
   
   
-def temporal_offset(Hours=6):
-# create a random numnber between -Hours and +Hours
-    return float(np.random.rand(1)*Hours*2 - Hours)
-  
+def main():
+    # Step 1 and the download in Step 4 do not depend on Steps 2 and 3:
+    # start the ArcGIS query and the wind data download in the background
+    with Prefetcher() as prefetcher:
+        if CHALLENGE_5_LABEL_SUBURBS:
+            # all suburb polygons are downloaded and read once: REQUIRED_SUBURB is
+            # taken from them, and they label the service requests in Step 3
+            prefetcher.submit(REQUIRED_SUBURB, load_suburbs_and_centroid)
+        else:
+            prefetcher.submit(REQUIRED_SUBURB, lambda: (None, compute_belville_south_centroid()))
+        prefetcher.submit(WIND_DATA_OUTPUT, download_wind_data)
 
-def anonomise_timestamp(x):
-# Function is applied to each row in the dataframe using .apply()
-# The first column         x[0] is 'creation_timestamp' 
-# The second column        x[1] is 'completion_timestamp'
-   hour_offset0 = temporal_offset()
-   hour_offset1 = temporal_offset()
+        # Step 2.  Load CHALLENGE_2_OUTPUT: sr_hex_joined with the H3 Level 8 indice    
+        is_service_data_downloaded = False
+        suburb_features = None
+        centroid = None
+        try:
+            # the partitioned output is read if challenge_2.py writes it, and it was
+            # written no earlier than the csv: a stale copy is not read
+            is_partitioned = ((CHALLENGE_2_WRITE_PARTITIONS or CHALLENGE_2_INCREMENTAL)
+                              and is_partitioned_copy_current(CHALLENGE_2_PARTITIONED_OUTPUT, CHALLENGE_2_OUTPUT))
+            if not is_partitioned and os.path.exists(os.path.join(CHALLENGE_2_PARTITIONED_OUTPUT, PARTITION_MANIFEST)):
+                logger.warning(f"'{CHALLENGE_2_PARTITIONED_OUTPUT}' is not read: it is older than "
+                               f"'{CHALLENGE_2_OUTPUT}', or challenge_2.py no longer writes it")
+            with run_stage("load") as stage_:
+                if is_partitioned:
+                    # only the partitions intersecting the subsample area are read,
+                    # so the centroid is needed first. The subsample of each partition
+                    # is cached: only the partitions changed since the last run are read
+                    suburb_features, centroid = prefetcher.result(REQUIRED_SUBURB)
+                    source = CHALLENGE_2_PARTITIONED_OUTPUT
+                    sr_hex_joined = PartitionSubsampleCache().subsample(
+                      CHALLENGE_2_PARTITIONED_OUTPUT,
+                      SpatialFilter(centroid[0], centroid[1]),
+                      )
+                elif is_parquet_copy_current(CHALLENGE_2_PARQUET_OUTPUT, CHALLENGE_2_OUTPUT):
+                    # the typed columnar copy avoids re-parsing the csv and its timestamps;
+                    # a copy older than the csv is stale and is not read
+                    source = CHALLENGE_2_PARQUET_OUTPUT
+                    sr_hex_joined = read_service_requests_parquet(CHALLENGE_2_PARQUET_OUTPUT)
+                else:
+                    source = CHALLENGE_2_OUTPUT
+                    with open(CHALLENGE_2_OUTPUT) as f_:
+                        sr_hex_joined = pd.read_csv(f_)
+                stage_.rows_out = len(sr_hex_joined)
 
-   return x[0] + timedelta(hours=hour_offset0), x[1] + timedelta(hours=hour_offset1)
+            logger.info(f"'{source}' loaded. Time Taken: {stage_.time_elapsed}s")
+            is_service_data_downloaded = True
    
+        except FileNotFoundError:
+            logger.exception(f"Cannot read/write: '{CHALLENGE_2_OUTPUT}'")
+        except PermissionError:
+            logger.exception(f"Permission error: '{CHALLENGE_2_OUTPUT}'") 
 
-def spatial_offset(N, range_m=500):
-# create a random numnber between -Hours and +Hours
-    range_random = np.random.rand(N)*range_m*2 - range_m
-    azimuth_random = np.random.rand(N)*180*2 - 180
-    return range_random, azimuth_random
+        # Step 1.  Compute the centroid for belville south 
+        # wait for the prefetched ArcGIS query
+        if centroid is None:
+            suburb_features, centroid = prefetcher.result(REQUIRED_SUBURB)
 
- 
-def main():
-    # Step 1.  Compute the centroid for belville south 
-    centroid = compute_belville_south_centroid()
+        # Step 3.  Create subsample of the CHALLENGE_2_OUTPUT
+        is_merged = False
+        if is_service_data_downloaded and CHALLENGE_5_LABEL_SUBURBS:
+           # label every service request with the official suburb polygon that contains it
+           # (the layer prefetched with the centroid)
+           if suburb_features is not None:
+               with run_stage("label_suburbs", rows_in=len(sr_hex_joined)) as stage_:
+                   suburb_index = PolygonLayerIndex(suburb_features, SUBURB_NAME_PROPERTY)
+                   sr_hex_joined[SUBURB_COLUMN_NAME] = suburb_index.assign(
+                     sr_hex_joined["latitude"].to_numpy(),
+                     sr_hex_joined["longitude"].to_numpy(),
+                     )
+               logger.info(f"Service requests labelled with suburb polygons. Unmatched: {suburb_index.unmatched}. Time Taken: {stage_.time_elapsed}s")
 
-    # Step 2.  Load CHALLENGE_2_OUTPUT: sr_hex_joined with the H3 Level 8 indice    
-    is_service_data_downloaded = False
-    try:
-        process_start_time = timeit.default_timer()
-        with open(CHALLENGE_2_OUTPUT) as f_:
-            sr_hex_joined = pd.read_csv(f_)
-
-        time_elapsed = timeit.default_timer() - process_start_time
-        logger.info(f"'{CHALLENGE_2_OUTPUT}' loaded. Time Taken: {time_elapsed}s")
-        is_service_data_downloaded = True
-   
-    except FileNotFoundError:
-        logger.exception(f"Cannot read/write: '{CHALLENGE_2_OUTPUT}'")
-    except PermissionError:
-        logger.exception(f"Permission error: '{CHALLENGE_2_OUTPUT}'") 
-
-    # Step 3.  Create subsample of the CHALLENGE_2_OUTPUT
-    is_merged = False
-    if is_service_data_downloaded:
-       process_start_time = timeit.default_timer()
-       is_within_1_minute_of_centroid = sr_hex_joined.apply(
-         check_if_within_1_minute_of_centroid, 
-         axis=1, 
-         args=(centroid[0], centroid[1])
-         )
-       sr_hex_joined = sr_hex_joined[is_within_1_minute_of_centroid]
-       time_elapsed = timeit.default_timer() - process_start_time
-       logger.info(f"Subsample created. Time Taken: {time_elapsed}s")
+        if is_service_data_downloaded:
+           # within 1 minute is interpreted as the 1 minute lat-long grid 
+           # around the centroid: within +/-1 minute in long and within +/-1 minute in lat
+           # (SPATIAL_FILTER_MODE="box", SPATIAL_FILTER_TOLERANCE=1, SPATIAL_FILTER_UNIT="minutes")
+           with run_stage("subsample", rows_in=len(sr_hex_joined)) as stage_:
+               spatial_filter = SpatialFilter(centroid[0], centroid[1])
+               is_within_1_minute_of_centroid = spatial_filter.mask(
+                 sr_hex_joined["latitude"].to_numpy(),
+                 sr_hex_joined["longitude"].to_numpy(),
+                 sr_hex_joined["h3_level8_index"].to_numpy() if "h3_level8_index" in sr_hex_joined else None,
+                 )
+               sr_hex_joined = sr_hex_joined[is_within_1_minute_of_centroid]
+               stage_.rows_out = len(sr_hex_joined)
+           logger.info(f"Subsample created. Time Taken: {stage_.time_elapsed}s")
    
     
-       # Step 4.  Download and prepare wind data from WIND_DATA_SOURCE
-       wind_speed_df = extract_belville_wind_data()
-       wind_speed_df["date_and_time"] = pd.to_datetime(wind_speed_df["date_and_time"])
-       wind_speed_df_sorted = wind_speed_df.sort_values(by='date_and_time')
+           # Step 4.  Download and prepare wind data from WIND_DATA_SOURCE
+           # wait for the prefetched download
+           prefetcher.result(WIND_DATA_OUTPUT)
+           prefetcher.report()
+           wind_store = WindDataStore()
+           wind_speed_df = extract_belville_wind_data(wind_store)
   
-       sr_hex_joined["creation_timestamp"] = pd.to_datetime(sr_hex_joined["creation_timestamp"])
-       sr_hex_sorted = sr_hex_joined.sort_values(by='creation_timestamp')
+           sr_hex_joined["creation_timestamp"] = pd.to_datetime(sr_hex_joined["creation_timestamp"])
+           sr_hex_sorted = sr_hex_joined.sort_values(by='creation_timestamp')
 
-       # Step 5.  Join Wind Data from the Bellville South Air Quality Measurement site 
-       process_start_time = timeit.default_timer()
-       sr_hex_merged = pd.merge_asof(
-             sr_hex_sorted,
-             wind_speed_df_sorted,
-             left_on="creation_timestamp",
-             right_on="date_and_time",
-         )
-   
-       time_elapsed = timeit.default_timer() - process_start_time
-       logger.info(f"Subsample merged with wind data. Time Taken: {time_elapsed}s")
-       is_merged = True  
+           # Step 5.  Join Wind Data from the Bellville South Air Quality Measurement site 
+           # the store keeps each station sorted by time: the last reading at or 
+           # before each creation_timestamp is found with a binary search
+           if CHALLENGE_5_WIND_STATION in wind_store.stations():
+               with run_stage("wind_join", rows_in=len(sr_hex_sorted)) as stage_:
+                   sr_hex_merged = wind_store.asof_join(sr_hex_sorted, CHALLENGE_5_WIND_STATION, on="creation_timestamp")
+               logger.info(f"Subsample merged with wind data. Time Taken: {stage_.time_elapsed}s")
+               is_merged = True  
+           else:
+               logger.error(f"No wind data for station: '{CHALLENGE_5_WIND_STATION}'")
        
-       try:
-           sr_hex_merged.to_csv(CHALLENGE_5_TMP_OUTPUT, index=False)
+        if is_merged:
+           try:
+               sr_hex_merged.to_csv(CHALLENGE_5_TMP_OUTPUT, index=False)
            
-       except FileNotFoundError:
-           logger.exception(f"Cannot read/write: '{CHALLENGE_5_TMP_OUTPUT}'")
-       except PermissionError:
-           logger.exception(f"Permission error: '{CHALLENGE_5_TMP_OUTPUT}'") 
+           except FileNotFoundError:
+               logger.exception(f"Cannot read/write: '{CHALLENGE_5_TMP_OUTPUT}'")
+           except PermissionError:
+               logger.exception(f"Permission error: '{CHALLENGE_5_TMP_OUTPUT}'") 
    
-    # Step 6.  Anonymise dataframe and save dataframe to disk
-    if is_merged:
+        # Step 6.  Anonymise dataframe and save dataframe to disk
+        if is_merged:
        
-      process_start_time = timeit.default_timer()
-      # 'reference_number' and 'notification_number' are removed as these may be
-      # be used to trace back to the customer
-      sr_hex_merged.pop('notification_number') 
-      sr_hex_merged.pop('reference_number') 
+          # 'reference_number' and 'notification_number' are removed as these may be
+          # be used to trace back to the customer
+          sr_hex_merged.pop('notification_number') 
+          sr_hex_merged.pop('reference_number') 
       
-      # 'date_and_time' is removed - used to debug/test the merge of data frames
-      sr_hex_merged.pop('date_and_time') 
-
-      sr_hex_merged["creation_timestamp"] = pd.to_datetime(sr_hex_merged["creation_timestamp"])
-      sr_hex_merged["completion_timestamp"] = pd.to_datetime(sr_hex_merged["completion_timestamp"])
-
-      # temporal accuracy to within 6 hours
-      temporal_data = sr_hex_merged.apply(anonomise_timestamp, axis=1)
-      data_creation_timestamp = list()
-      data_completion_timestamp = list()
-      for t in temporal_data:
-          data_creation_timestamp.append(t[0])
-          data_completion_timestamp.append(t[1])
+          # 'date_and_time' is removed - used to debug/test the merge of data frames
+          sr_hex_merged.pop('date_and_time') 
 
-      # location accuracy to within approximately 500m
-      range_random, azimuth_random = spatial_offset(len(sr_hex_merged))
+          with run_stage("anonymise", rows_in=len(sr_hex_merged)) as anonymise_stage:
+              # temporal accuracy to within ANONYMISE_TIME_OFFSET_HOURS (6 hours)
+              anonymise_timestamps(sr_hex_merged)
 
-      input_lat  = sr_hex_merged["latitude"]
-      input_lon  = sr_hex_merged["longitude"]
-      geod = pyproj.Geod(ellps='WGS84')
+              # location accuracy to within approximately ANONYMISE_DISTANCE_M (500m)
+              anonymise_locations(sr_hex_merged)
 
-      lon_random, lat_random, reverse_az_random = geod.fwd(
-        input_lon, 
-        input_lat, 
-        azimuth_random, 
-        range_random,
-        )
-        
-      sr_hex_merged["latitude"] = input_lat
-      sr_hex_merged["longitude"] = input_lon
-
-      try:
-          sr_hex_merged.to_csv(CHALLENGE_5_OUTPUT, index=False)
-          time_elapsed = timeit.default_timer() - process_start_time
-          logger.info(f"Data aonymised and saved: '{CHALLENGE_5_OUTPUT}'. Time Taken: {time_elapsed}s")
+          try:
+              with run_stage("write_csv", rows_in=len(sr_hex_merged)) as stage_:
+                  sr_hex_merged.to_csv(CHALLENGE_5_OUTPUT, index=False)
+              time_elapsed = anonymise_stage.time_elapsed + stage_.time_elapsed
+              logger.info(f"Data aonymised and saved: '{CHALLENGE_5_OUTPUT}'. Time Taken: {time_elapsed}s")
       
-      except FileNotFoundError:
-          logger.exception(f"Cannot read/write: '{CHALLENGE_5_OUTPUT}'")
-      except PermissionError:
-          logger.exception(f"Permission error: '{CHALLENGE_5_OUTPUT}'") 
+          except FileNotFoundError:
+              logger.exception(f"Cannot read/write: '{CHALLENGE_5_OUTPUT}'")
+          except PermissionError:
+              logger.exception(f"Permission error: '{CHALLENGE_5_OUTPUT}'") 
+
           
 if __name__ == "__main__":
     # This will delete all cached files and force all downloads
-    delete_cached_files = True    # set to False if cached downloads are used.  
+    # pipeline.py runs the script with --keep-cached-files to reuse them
+    delete_cached_files = "--keep-cached-files" not in sys.argv[1:]
     is_success = True
     if delete_cached_files:
         is_success = delete_file(WIND_DATA_SOURCE)
@@ -336,6 +376,9 @@ if __name__ == "__main__":
         is_success = is_success and delete_file(CHALLENGE_5_TMP_WIND_DATA)
         is_success = is_success and delete_file(CHALLENGE_5_TMP_OUTPUT)
         is_success = is_success and delete_file(CHALLENGE_5_OUTPUT)
+        is_success = is_success and delete_file(OFFICIAL_SUBURBS_OUTPUT)
+        is_success = is_success and delete_directory(WIND_DATA_STORE_DIR)
+        is_success = is_success and delete_directory(CHALLENGE_5_SUBSAMPLE_CACHE)
         logger.stop()
         is_success = is_success and delete_file(CHALLENGE_5_LOG)
       
@@ -349,10 +392,21 @@ if __name__ == "__main__":
         sys.tracebacklimit = 0
         logger.add(CHALLENGE_5_LOG, level="DEBUG", rotation="12:00")
     
+        # machine readable report of the time, memory and I/O of each stage
+        start_run_report("challenge_5", CHALLENGE_5_RUN_REPORT, parameters={
+            "label_suburbs": CHALLENGE_5_LABEL_SUBURBS,
+            "spatial_filter_mode": SPATIAL_FILTER_MODE,
+            "anonymise_spatial_mode": ANONYMISE_SPATIAL_MODE,
+            })
+
         logger.info("Starting Challenge #5")
-        main()
-        time_elapsed = timeit.default_timer() - start_time
-        logger.info(f"Challenge #5 Completed. Total Time Taken: {time_elapsed}s")     
+        try:
+            main()
+            time_elapsed = timeit.default_timer() - start_time
+            logger.info(f"Challenge #5 Completed. Total Time Taken: {time_elapsed}s")     
+        finally:
+            # the report of a failed run is saved too, with the errors of its stages
+            finish_run_report()
         logger.stop()
     else:
         logger.error("Please close cached files and rerun.")
\ No newline at end of file
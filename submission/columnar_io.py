@@ -0,0 +1,431 @@
+# This module contains the columnar (Parquet) input/output functions used by the
+# scripts submitted for the City of Cape Town - Data Science Unit Code Challenge
+# https://github.com/cityofcapetown/ds_code_challenge
+#
+# CHALLENGE_2_PARQUET_OUTPUT keeps the dtypes of the joined service requests:
+# - SERVICE_REQUEST_TIMESTAMP_COLUMNS are stored as timestamps
+# - SERVICE_REQUEST_CATEGORICAL_COLUMNS are dictionary encoded
+# - SERVICE_REQUEST_HEX_COLUMN_NAME is stored as a uint64
+# so downstream scripts do not re-parse the csv, and can read only the 
+# columns they need from a memory-mapped file.
+#
+# CHALLENGE_2_PARTITIONED_OUTPUT is a directory with the same rows partitioned
+# by the parent H3 cell at PARTITION_RESOLUTION, sorted by H3 index within each
+# file, and a PARTITION_MANIFEST with the row count and bounding box of every
+# partition. Spatial queries read only the partitions that intersect them.
+# Partition files are never modified: appending to the directory adds files,
+# and removing rows rewrites a file under a new name. The manifest lists the
+# current files and is replaced last, so it is the commit point of a change.
+
+from support_library import(SERVICE_REQUEST_HEX_COLUMN_NAME,
+                            SERVICE_REQUEST_TIMESTAMP_COLUMNS,
+                            SERVICE_REQUEST_CATEGORICAL_COLUMNS,
+                            H3_NULL_INDEX,
+                            PARTITION_RESOLUTION,
+                            PARTITION_MANIFEST,
+                            delete_directory,
+                            delete_file,
+                            )
+from h3_indexer import h3_int_to_string, h3_string_to_int, h3_parent_int
+
+from loguru import logger
+import os
+import json
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+
+def service_requests_to_table(service_requests):
+#   return a pyarrow Table of the service_requests dataframe with typed columns
+    columns = {}
+    for name in service_requests.columns:
+        column = service_requests[name]
+        if name == SERVICE_REQUEST_HEX_COLUMN_NAME:
+            columns[name] = pa.array(h3_string_to_int(column.to_numpy()), type=pa.uint64())
+        elif name in SERVICE_REQUEST_TIMESTAMP_COLUMNS:
+            columns[name] = pa.array(pd.to_datetime(column), from_pandas=True)
+        elif name in SERVICE_REQUEST_CATEGORICAL_COLUMNS:
+            # dictionary encode with int32 indices so the schema does not
+            # depend on the number of categories
+            columns[name] = pa.array(column.astype(object), type=pa.string(), from_pandas=True).dictionary_encode()
+        else:
+            columns[name] = pa.array(column, from_pandas=True)
+            if pa.types.is_null(columns[name].type):
+                # an all-null text column keeps the schema of the other batches
+                columns[name] = columns[name].cast(pa.string())
+    return pa.table(columns)
+
+def write_service_requests_parquet(service_requests, file_name):
+#   writes the service_requests dataframe to the parquet file_name
+#   returns the size of the file written in bytes
+    writer = ServiceRequestsParquetWriter(file_name)
+    try:
+        writer.write(service_requests)
+    except Exception:
+        writer.abort()
+        raise
+    return writer.close()
+
+class ServiceRequestsParquetWriter:
+#   Writes service requests to the parquet file_name one batch at a time,
+#   so the chunks of the streaming pipeline can be written as they come.
+#   - every batch is cast to the schema of the first batch
+#   - the batches are written to file_name + ".partial", which replaces
+#     file_name on close(); abort() removes it
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.schema = None
+        self._partial = file_name + ".partial"
+        self._writer = None
+        delete_file(self._partial)
+
+    def write(self, service_requests):
+#       writes one batch of service requests as a row group
+        table = service_requests_to_table(service_requests)
+        if self._writer is None:
+            self.schema = table.schema
+            self._writer = pq.ParquetWriter(self._partial, self.schema)
+        elif not table.schema.equals(self.schema):
+            table = table.cast(self.schema)
+        self._writer.write_table(table)
+
+    def close(self):
+#       replaces file_name with the partial output
+#       returns the size of the file written in bytes
+        if self._writer is None:
+            # no batch written: an empty file without columns
+            pq.write_table(pa.table({}), self._partial)
+        else:
+            self._writer.close()
+        os.replace(self._partial, self.file_name)
+        return os.path.getsize(self.file_name)
+
+    def abort(self):
+#       removes the partial output
+        if self._writer is not None:
+            self._writer.close()
+        delete_file(self._partial)
+
+def is_parquet_copy_current(parquet_file, csv_file):
+#   return True if parquet_file exists and was written no earlier than csv_file
+#   (or csv_file is missing), so it holds the same rows as the csv
+    if not os.path.exists(parquet_file):
+        return False
+    if not os.path.exists(csv_file):
+        return True
+    return os.path.getmtime(parquet_file) >= os.path.getmtime(csv_file)
+
+def is_partitioned_copy_current(directory, csv_file):
+#   return True if the partitioned output directory exists and its manifest was
+#   written no earlier than csv_file (or csv_file is missing)
+    return is_parquet_copy_current(os.path.join(directory, PARTITION_MANIFEST), csv_file)
+
+def read_service_requests_parquet(file_name, columns=None, h3_as_string=True):
+#   return a dataframe read from the parquet file_name
+#   - columns limits the columns read from disk (default: all columns)
+#   - the file is memory mapped rather than read into a buffer
+#   - h3_as_string==True returns SERVICE_REQUEST_HEX_COLUMN_NAME as the 
+#     hexadecimal strings found in the csv output, otherwise as a uint64
+    table = pq.read_table(file_name, columns=columns, memory_map=True)
+    service_requests = table.to_pandas()
+    if h3_as_string and SERVICE_REQUEST_HEX_COLUMN_NAME in service_requests.columns:
+        service_requests[SERVICE_REQUEST_HEX_COLUMN_NAME] = h3_int_to_string(
+            service_requests[SERVICE_REQUEST_HEX_COLUMN_NAME].to_numpy()
+            )
+    return service_requests
+
+
+def bounding_box(longitude, latitude):
+#   return [min_longitude, min_latitude, max_longitude, max_latitude] of the
+#   points with a location, or None if no point has a location
+    is_located = ~(np.isnan(longitude) | np.isnan(latitude))
+    if not is_located.any():
+        return None
+    longitude = longitude[is_located]
+    latitude  = latitude[is_located]
+    return [float(longitude.min()), float(latitude.min()), float(longitude.max()), float(latitude.max())]
+
+def bounding_box_union(a, b):
+#   return the bounding box covering the bounding boxes a and b (either may be None)
+    if a is None or b is None:
+        return a if b is None else b
+    return [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+
+def table_bounding_box(table):
+#   return the bounding box of the 'longitude' and 'latitude' columns of a pyarrow table
+    return bounding_box(table["longitude"].to_numpy().astype(np.float64),
+                        table["latitude"].to_numpy().astype(np.float64))
+
+def bounding_box_intersects(a, b):
+#   return True if the bounding boxes a and b overlap; None never overlaps
+    if a is None or b is None:
+        return False
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def partition_file_name(key, batch):
+#   return the name of the file of partition key written by batch
+    return f"part-{key}-{batch:05d}.parquet"
+
+def _file_batch(file_name):
+    return int(os.path.splitext(file_name)[0].rsplit("-", 1)[1])
+
+class PartitionedServiceRequestsWriter:
+#   Writes service requests to a directory partitioned by the parent H3 cell
+#   of SERVICE_REQUEST_HEX_COLUMN_NAME at resolution.
+#   - each write() adds one parquet file per partition present in the batch,
+#     so the chunks of the streaming pipeline can be written as they come
+#   - rows are sorted by H3 index within each file
+#   - requests without an H3 index form the H3_NULL_INDEX partition; their
+#     bounding box covers any that have coordinates
+#   - every file is cast to the schema of the first file of the directory
+#   - the files are written to directory + ".partial", which replaces the
+#     directory on close(); abort() removes it
+#   - append==True adds to an existing directory instead: the new files are
+#     written next to the current ones and are only listed by the manifest
+#     written on close(); abort() removes them
+    def __init__(self, directory, resolution=PARTITION_RESOLUTION, append=False):
+        self.directory = directory
+        self.is_append = append and os.path.exists(os.path.join(directory, PARTITION_MANIFEST))
+        self.schema = None
+        self._written = []
+        self._dropped = []
+        if self.is_append:
+            self.manifest = read_partition_manifest(directory)
+            self.resolution = self.manifest["resolution"]
+            self._partial = directory
+            files = [entry["file"] for partition in self.manifest["partitions"].values() for entry in partition["files"]]
+            self._batch = self.manifest.get("batches", max((_file_batch(f) for f in files), default=-1) + 1)
+            if files:
+                self.schema = pq.read_schema(os.path.join(directory, files[0]))
+            return
+
+        self.resolution = resolution
+        self._partial = directory + ".partial"
+        delete_directory(self._partial)
+        os.makedirs(self._partial)
+        self._batch = 0
+        self.manifest = {
+            "resolution": resolution,
+            "hex_column": SERVICE_REQUEST_HEX_COLUMN_NAME,
+            "rows": 0,
+            "partitions": {},
+            }
+
+    @property
+    def batch(self):
+#       the number of the next batch, which names the files of the next write()
+        return self._batch
+
+    def reserve_batch(self):
+#       return the number of a new batch, for a file written with write_table()
+        self._batch += 1
+        return self._batch - 1
+
+    def partition_keys(self, service_requests):
+#       return the partition key of each row of service_requests
+        h3_index = h3_string_to_int(service_requests[SERVICE_REQUEST_HEX_COLUMN_NAME].to_numpy())
+        parent = h3_parent_int(h3_index, self.resolution)
+        return np.array([format(int(key), "x") if key else H3_NULL_INDEX for key in parent], dtype=object)
+
+    def write_table(self, file_name, table):
+#       writes a pyarrow table to file_name in the directory being written
+        pq.write_table(table, os.path.join(self._partial, file_name))
+        self._written.append(file_name)
+
+    def drop_file(self, file_name):
+#       deletes file_name of the directory on close(), once the manifest no longer lists it
+        self._dropped.append(file_name)
+
+    def _write_entry(self, key, table):
+#       writes the rows of partition key in table and adds its file to the manifest
+        if self.schema is None:
+            self.schema = table.schema
+        elif not table.schema.equals(self.schema):
+            table = table.cast(self.schema)
+        file_entry = {
+            "file": partition_file_name(key, self._batch),
+            "rows": table.num_rows,
+            "bbox": table_bounding_box(table),
+            }
+        self.write_table(file_entry["file"], table)
+        partition = self.manifest["partitions"].setdefault(key, {"rows": 0, "bbox": None, "files": []})
+        partition["files"].append(file_entry)
+        partition["rows"] += file_entry["rows"]
+        partition["bbox"] = bounding_box_union(partition["bbox"], file_entry["bbox"])
+
+    def write(self, service_requests):
+#       writes one batch of service requests; returns the number of files written
+        h3_index = h3_string_to_int(service_requests[SERVICE_REQUEST_HEX_COLUMN_NAME].to_numpy())
+        parent = h3_parent_int(h3_index, self.resolution)
+        order = np.lexsort((h3_index, parent))
+        parent = parent[order]
+
+        keys, starts = np.unique(parent, return_index=True)
+        bounds = list(starts) + [len(parent)]
+        for key, start, stop in zip(keys, bounds[:-1], bounds[1:]):
+            key = format(int(key), "x") if key else H3_NULL_INDEX
+            self._write_entry(key, service_requests_to_table(service_requests.iloc[order[start:stop]]))
+        self.manifest["rows"] += len(service_requests)
+        self._batch += 1
+        return len(keys)
+
+    def remove_rows(self, key_column, keys_by_file):
+#       removes rows from the files of the directory being written, given as
+#       {file: keys}: the rows of file whose key_column is in keys
+#       each file is rewritten without them under a new name (a batch of its
+#       own, so the files of one partition do not collide), and deleted on close()
+#       returns {file: new file, or None if no row is left}
+        renamed = {}
+        for key in list(self.manifest["partitions"]):
+            partition = self.manifest["partitions"][key]
+            entries = []
+            for entry in partition["files"]:
+                if entry["file"] not in keys_by_file:
+                    entries.append(entry)
+                    continue
+                value_set = pa.array([str(value) for value in keys_by_file[entry["file"]]], type=pa.string())
+                table = pq.read_table(os.path.join(self._partial, entry["file"]))
+                table = table.filter(pc.invert(pc.is_in(table[key_column].cast(pa.string()), value_set=value_set)))
+                self.manifest["rows"] -= entry["rows"] - table.num_rows
+                self.drop_file(entry["file"])
+                renamed[entry["file"]] = None
+                if table.num_rows:
+                    renamed[entry["file"]] = partition_file_name(key, self.reserve_batch())
+                    self.write_table(renamed[entry["file"]], table)
+                    entries.append({"file": renamed[entry["file"]], "rows": table.num_rows, "bbox": table_bounding_box(table)})
+            if not entries:
+                del self.manifest["partitions"][key]
+                continue
+            partition["files"] = entries
+            partition["rows"] = sum(entry["rows"] for entry in entries)
+            partition["bbox"] = None
+            for entry in entries:
+                partition["bbox"] = bounding_box_union(partition["bbox"], entry["bbox"])
+        return renamed
+
+    def close(self):
+#       writes PARTITION_MANIFEST and deletes the dropped files, then replaces
+#       directory with the partial output (in append mode, the manifest only)
+#       returns the number of partitions
+        self.manifest["batches"] = self._batch
+        manifest_file = os.path.join(self._partial, PARTITION_MANIFEST)
+        with open(manifest_file + ".tmp", "w") as f_:
+            json.dump(self.manifest, f_, indent=1)
+        os.replace(manifest_file + ".tmp", manifest_file)
+        for file_name in self._dropped:
+            delete_file(os.path.join(self._partial, file_name))
+        if not self.is_append:
+            delete_directory(self.directory)
+            os.replace(self._partial, self.directory)
+        logger.info(f"Partitioned output saved to '{self.directory}': {self.manifest['rows']} rows in "
+                    f"{len(self.manifest['partitions'])} partitions at H3 resolution {self.resolution}")
+        return len(self.manifest["partitions"])
+
+    def abort(self):
+#       removes the partial output, or in append mode the files written
+        if self.is_append:
+            for file_name in self._written:
+                delete_file(os.path.join(self.directory, file_name))
+        else:
+            delete_directory(self._partial)
+
+def write_partitioned_service_requests(service_requests, directory, resolution=PARTITION_RESOLUTION):
+#   writes the service_requests dataframe partitioned by H3 parent cell to directory
+#   returns the number of partitions
+    writer = PartitionedServiceRequestsWriter(directory, resolution)
+    try:
+        writer.write(service_requests)
+    except Exception:
+        writer.abort()
+        raise
+    return writer.close()
+
+def read_partition_manifest(directory):
+#   return the PARTITION_MANIFEST of the partitioned output directory
+    with open(os.path.join(directory, PARTITION_MANIFEST)) as f_:
+        return json.load(f_)
+
+def partitioned_output_files(directory, bbox=None):
+#   return the files of the partitioned output directory, limited to the
+#   partitions whose bounding box intersects bbox (default: all partitions)
+    manifest = read_partition_manifest(directory)
+    return [
+        os.path.join(directory, entry["file"])
+        for partition in manifest["partitions"].values()
+        if bbox is None or bounding_box_intersects(partition["bbox"], bbox)
+        for entry in partition["files"]
+        ]
+
+def _merge_types(type_a, type_b):
+#   return the type of a column stored as type_a in one file and type_b in another
+    if type_a.equals(type_b) or pa.types.is_null(type_b):
+        return type_a
+    if pa.types.is_null(type_a):
+        return type_b
+    if all(pa.types.is_integer(t) or pa.types.is_floating(t) for t in (type_a, type_b)):
+        return pa.float64()
+    return pa.string()
+
+def concat_partition_tables(tables):
+#   return the pyarrow tables of partition files concatenated. Every file the
+#   writer adds is cast to the schema of the first file of the directory, but 
+#   files written before it did may differ: a column all null in one batch, or 
+#   read as int64 in one batch and double in another. Such tables are cast to 
+#   a merged schema (numbers as double, other mixed types as text) first.
+    if all(table.schema.equals(tables[0].schema) for table in tables[1:]):
+        return pa.concat_tables(tables)
+    fields = {}
+    for table in tables:
+        for field in table.schema:
+            fields[field.name] = field.type if field.name not in fields else _merge_types(fields[field.name], field.type)
+    schema = pa.schema([(name, field_type) for name, field_type in fields.items()])
+    aligned = []
+    for table in tables:
+        columns = []
+        for field in schema:
+            if field.name not in table.column_names:
+                columns.append(pa.nulls(table.num_rows, field.type))
+                continue
+            column = table[field.name]
+            if pa.types.is_dictionary(column.type) and not pa.types.is_dictionary(field.type):
+                column = column.cast(column.type.value_type)
+            columns.append(column.cast(field.type))
+        aligned.append(pa.table(columns, schema=schema))
+    merged = [field.name for field in schema if field not in tables[0].schema]
+    logger.warning(f"Partition files with different schemas: columns {merged} read as {[str(schema.field(name).type) for name in merged]}")
+    return pa.concat_tables(aligned)
+
+def read_partitioned_service_requests(directory, bbox=None, columns=None, h3_as_string=True):
+#   return a dataframe read from the partitioned output directory
+#   - bbox ([min_longitude, min_latitude, max_longitude, max_latitude]) limits
+#     the rows read to the partitions whose bounding box intersects it; the 
+#     caller still applies the exact spatial filter (default: all partitions)
+#   - columns and h3_as_string are as for read_service_requests_parquet()
+    manifest = read_partition_manifest(directory)
+    files = []
+    rows_read = 0
+    for key, partition in manifest["partitions"].items():
+        if bbox is None or bounding_box_intersects(partition["bbox"], bbox):
+            files.extend(os.path.join(directory, entry["file"]) for entry in partition["files"])
+            rows_read += partition["rows"]
+    logger.info(f"Partitions read from '{directory}': {rows_read} of {manifest['rows']} rows")
+
+    if files:
+        table = concat_partition_tables([pq.read_table(f, columns=columns, memory_map=True) for f in files])
+    else:
+        # no partition intersects bbox: an empty dataframe with the columns of the output
+        any_file = next((entry["file"] for partition in manifest["partitions"].values() for entry in partition["files"]), None)
+        if any_file is None:
+            return pd.DataFrame(columns=columns)
+        schema = pq.read_schema(os.path.join(directory, any_file))
+        table = schema.empty_table() if columns is None else schema.empty_table().select(columns)
+    service_requests = table.to_pandas()
+    if h3_as_string and SERVICE_REQUEST_HEX_COLUMN_NAME in service_requests.columns:
+        service_requests[SERVICE_REQUEST_HEX_COLUMN_NAME] = h3_int_to_string(
+            service_requests[SERVICE_REQUEST_HEX_COLUMN_NAME].to_numpy()
+            )
+    return service_requests
@@ -0,0 +1,215 @@
+# This module contains the dataframe validation functions used by the scripts
+# submitted for the City of Cape Town - Data Science Unit Code Challenge
+# https://github.com/cityofcapetown/ds_code_challenge
+#
+# diff_frames() compares two dataframes row by row (by position), one column
+# at a time with vectorised equality:
+# - nulls on both sides are equal (NaN, None and NaT)
+# - floats are equal within FRAME_DIFF_FLOAT_TOLERANCE
+# - timestamps are compared as instants, whatever their time zone
+# Instead of a diff frame it returns a FrameDiffReport with the mismatch count
+# of each column and a sample of the row keys that differ. A report can be
+# updated chunk by chunk, e.g. by the streaming pipeline of challenge_2.
+#
+# FrameDigest hashes the rows of a dataframe, fed in chunks of any size, into
+# digests of fixed blocks of rows and into an order-independent digest of all
+# rows. Two outputs can then be compared from their digests without loading
+# both of them; the order-independent digest also matches outputs whose rows
+# were reordered, such as the partitioned output.
+
+from support_library import(SERVICE_REQUEST_HEX_COLUMN_NAME,
+                            SERVICE_REQUEST_TIMESTAMP_COLUMNS,
+                            FRAME_DIFF_FLOAT_TOLERANCE,
+                            FRAME_DIFF_KEY_COLUMN,
+                            FRAME_DIFF_SAMPLE_SIZE,
+                            FRAME_DIGEST_BLOCK_ROWS,
+                            FRAME_DIGEST_FLOAT_DECIMALS,
+                            )
+from h3_indexer import h3_int_to_string
+
+from loguru import logger
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+ROW_HASH_MULTIPLIER = np.uint64(1000003)
+
+
+def _is_float(values):
+    return pd.api.types.is_float_dtype(values.dtype) or pd.api.types.is_integer_dtype(values.dtype)
+
+def column_mismatch(left, right, float_tolerance=FRAME_DIFF_FLOAT_TOLERANCE):
+#   return a boolean array, True where the values of the series left and right
+#   (of equal length) differ
+    left  = left.reset_index(drop=True)
+    right = right.reset_index(drop=True)
+    if _is_float(left) and _is_float(right):
+        left  = left.to_numpy(dtype=np.float64, na_value=np.nan)
+        right = right.to_numpy(dtype=np.float64, na_value=np.nan)
+        is_equal = np.isclose(left, right, rtol=0, atol=float_tolerance) | (np.isnan(left) & np.isnan(right))
+        return ~is_equal
+    if pd.api.types.is_datetime64_any_dtype(left.dtype) or pd.api.types.is_datetime64_any_dtype(right.dtype):
+        left  = pd.to_datetime(left, utc=True, errors="coerce")
+        right = pd.to_datetime(right, utc=True, errors="coerce")
+    if isinstance(left.dtype, pd.CategoricalDtype):
+        left = left.astype(object)
+    if isinstance(right.dtype, pd.CategoricalDtype):
+        right = right.astype(object)
+    is_null = left.isna().to_numpy() & right.isna().to_numpy()
+    is_equal = (left == right).to_numpy(dtype=bool, na_value=False)
+    return ~(is_equal | is_null)
+
+
+class FrameDiffReport:
+#   Result of diff_frames(), accumulated over one or more chunks of rows.
+#   - mismatches: {column: number of differing rows}
+#   - samples: {column: up to sample_size keys of differing rows}
+#   - missing_columns / extra_columns: columns only in the expected / computed frame
+    def __init__(self, sample_size=FRAME_DIFF_SAMPLE_SIZE):
+        self.sample_size = sample_size
+        self.rows_compared = 0
+        self.rows_left = 0
+        self.rows_right = 0
+        self.mismatches = {}
+        self.samples = {}
+        self.missing_columns = set()
+        self.extra_columns = set()
+
+    @property
+    def is_equal(self):
+        return (not self.missing_columns and not self.extra_columns
+                and self.rows_left == self.rows_right
+                and not any(self.mismatches.values()))
+
+    @property
+    def num_mismatches(self):
+        return sum(self.mismatches.values())
+
+    def add_mismatch(self, column, keys):
+        self.mismatches[column] = self.mismatches.get(column, 0) + len(keys)
+        sample = self.samples.setdefault(column, [])
+        sample.extend(keys[:self.sample_size - len(sample)])
+
+    def log(self, name="computed"):
+#       logs the summary of the report
+        if self.is_equal:
+            logger.info(f"No differences in {self.rows_compared} rows of {name}")
+            return
+        if self.rows_left != self.rows_right:
+            logger.error(f"Number of rows differs: {self.rows_left} in {name}, {self.rows_right} expected")
+        if self.missing_columns:
+            logger.error(f"Columns missing from {name}: {sorted(self.missing_columns)}")
+        if self.extra_columns:
+            logger.error(f"Columns not expected in {name}: {sorted(self.extra_columns)}")
+        for column, count in self.mismatches.items():
+            if count:
+                logger.error(f"Column '{column}' differs in {count} of {self.rows_compared} rows of {name}, "
+                             f"e.g. rows {self.samples[column]}")
+
+
+def diff_frames(left, right, key_column=FRAME_DIFF_KEY_COLUMN, float_tolerance=FRAME_DIFF_FLOAT_TOLERANCE,
+                report=None, row_offset=0):
+#   return a FrameDiffReport of the differences between the computed dataframe
+#   left and the expected dataframe right, compared row by row by position
+#   - key_column identifies the sampled rows; if it is not in left, rows are
+#     identified by their row number (counted from row_offset)
+#   - report accumulates the result of an earlier chunk (default: a new report)
+    if report is None:
+        report = FrameDiffReport()
+    report.missing_columns.update(set(right.columns) - set(left.columns))
+    report.extra_columns.update(set(left.columns) - set(right.columns))
+    report.rows_left  += len(left)
+    report.rows_right += len(right)
+
+    length = min(len(left), len(right))
+    if key_column in left.columns:
+        keys = left[key_column].iloc[:length].to_numpy()
+    else:
+        keys = np.arange(row_offset, row_offset + length)
+    for column in left.columns:
+        if column not in right.columns:
+            continue
+        is_different = column_mismatch(left[column].iloc[:length], right[column].iloc[:length], float_tolerance)
+        report.add_mismatch(column, keys[is_different].tolist())
+    report.rows_compared += length
+    return report
+
+
+def normalise_column(values, name, float_decimals=FRAME_DIGEST_FLOAT_DECIMALS):
+#   return the series values in the form that is hashed by FrameDigest, so that
+#   the same data hashes the same whether it was read from the csv or parquet
+#   outputs, or computed:
+#   - SERVICE_REQUEST_HEX_COLUMN_NAME as hexadecimal strings
+#   - timestamps (and SERVICE_REQUEST_TIMESTAMP_COLUMNS) as UTC int64, NaT as a null
+#   - floats rounded to float_decimals
+#   - other values as objects with None for nulls
+    if name == SERVICE_REQUEST_HEX_COLUMN_NAME and pd.api.types.is_unsigned_integer_dtype(values.dtype):
+        values = pd.Series(h3_int_to_string(values.to_numpy()))
+    if name in SERVICE_REQUEST_TIMESTAMP_COLUMNS or pd.api.types.is_datetime64_any_dtype(values.dtype):
+        timestamps = pd.to_datetime(values, utc=True, errors="coerce")
+        utc_ns = timestamps.dt.tz_localize(None).to_numpy().astype("datetime64[ns]").view(np.int64)
+        return pd.Series(utc_ns.astype(object)).where(timestamps.notna().to_numpy(), None)
+    if pd.api.types.is_float_dtype(values.dtype):
+        return pd.Series(np.round(values.to_numpy(dtype=np.float64), float_decimals))
+    values = pd.Series(values.to_numpy(dtype=object))
+    return values.where(values.notna(), None)
+
+def row_hashes(frame, columns=None, float_decimals=FRAME_DIGEST_FLOAT_DECIMALS):
+#   return a uint64 hash of each row of frame over columns (default: all, in order)
+    hashes = np.zeros(len(frame), dtype=np.uint64)
+    for name in (frame.columns if columns is None else columns):
+        column_hash = pd.util.hash_pandas_object(
+            normalise_column(frame[name], name, float_decimals), index=False).to_numpy()
+        hashes = hashes*ROW_HASH_MULTIPLIER ^ column_hash
+    return hashes
+
+
+class FrameDigest:
+#   Digests of the rows of a dataframe fed to update() in chunks of any size.
+#   - blocks: a SHA-256 digest of each block of block_rows rows, in row order,
+#     independent of the chunk sizes used
+#   - unordered: a digest of the sum and xor of all row hashes and the row
+#     count, independent of the row order
+#   Compare two digests with mismatched_blocks() or unordered ==.
+    def __init__(self, columns=None, block_rows=FRAME_DIGEST_BLOCK_ROWS, float_decimals=FRAME_DIGEST_FLOAT_DECIMALS):
+        self.columns = columns
+        self.block_rows = block_rows
+        self.float_decimals = float_decimals
+        self.rows = 0
+        self.blocks = []
+        self._pending = np.zeros(0, dtype=np.uint64)
+        self._sum = np.uint64(0)
+        self._xor = np.uint64(0)
+
+    def update(self, frame):
+        hashes = row_hashes(frame, self.columns, self.float_decimals)
+        self.rows += len(hashes)
+        with np.errstate(over="ignore"):    # the sum wraps around modulo 2**64
+            self._sum += hashes.sum(dtype=np.uint64)
+        self._xor ^= np.bitwise_xor.reduce(hashes) if len(hashes) else np.uint64(0)
+        pending = np.concatenate([self._pending, hashes])
+        num_full = len(pending)//self.block_rows*self.block_rows
+        for start in range(0, num_full, self.block_rows):
+            self.blocks.append(hashlib.sha256(pending[start:start + self.block_rows].tobytes()).hexdigest())
+        self._pending = pending[num_full:]
+        return self
+
+    def block_digests(self):
+#       return the block digests, including the last partial block
+        if len(self._pending):
+            return self.blocks + [hashlib.sha256(self._pending.tobytes()).hexdigest()]
+        return list(self.blocks)
+
+    @property
+    def unordered(self):
+        return hashlib.sha256(f"{self.rows}:{int(self._sum)}:{int(self._xor)}".encode("utf-8")).hexdigest()
+
+    def mismatched_blocks(self, other):
+#       return the (start, stop) row ranges of the blocks that differ from other
+        mine, theirs = self.block_digests(), other.block_digests()
+        ranges = []
+        for block in range(max(len(mine), len(theirs))):
+            if block >= len(mine) or block >= len(theirs) or mine[block] != theirs[block]:
+                ranges.append((block*self.block_rows, (block + 1)*self.block_rows))
+        return ranges
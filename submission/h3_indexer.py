@@ -0,0 +1,201 @@
+# This module contains the batch H3 indexing engine used by the scripts
+# submitted for the City of Cape Town - Data Science Unit Code Challenge
+# https://github.com/cityofcapetown/ds_code_challenge
+#
+# The row-wise pandas .apply() makes one Python call per service request.
+# The functions below index whole latitude/longitude arrays at once using
+# the vectorised H3 bindings, processing the arrays in fixed-size chunks.
+# calculate_h3_index_parallel() spreads the row ranges over a process pool,
+# sharing the coordinate arrays with the workers through shared memory.
+# The pool is never forked from the calling process (see h3_index_executor()).
+
+from support_library import(H3_INDEX_CHUNK_SIZE,
+                            H3_NULL_INDEX,
+                            H3_INDEX_NUM_WORKERS,
+                            H3_PARALLEL_MIN_ROWS,
+                            )
+
+from loguru import logger
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import multiprocessing
+
+import numpy as np
+import h3
+from h3.unstable import vect as h3_vect
+
+
+def h3_int_to_string(h3_int_index):
+#   return the hexadecimal string representation of uint64 H3 indices
+#   - an index of 0 (no location) is returned as H3_NULL_INDEX
+#   - only the unique indices are formatted; a city has a few thousand hexagons
+#     so this avoids a Python call per service request
+    unique_index, inverse = np.unique(np.asarray(h3_int_index, dtype=np.uint64), return_inverse=True)
+    unique_string = np.array(
+        [format(int(i), "x") if i else H3_NULL_INDEX for i in unique_index],
+        dtype=object,
+        )
+    return unique_string[inverse.reshape(-1)]
+
+def h3_string_to_int(h3_string_index):
+#   return a uint64 array from hexadecimal H3 index strings
+#   - H3_NULL_INDEX, empty and null values are returned as 0
+#   - only the unique indices are parsed, as in h3_int_to_string()
+    unique_string, inverse = np.unique(
+        np.asarray(h3_string_index, dtype=object).astype(str), 
+        return_inverse=True,
+        )
+    unique_index = np.array(
+        [int(i, 16) if i not in ("", "nan", "None", H3_NULL_INDEX) else 0 for i in unique_string],
+        dtype=np.uint64,
+        )
+    return unique_index[inverse.reshape(-1)]
+
+def h3_parent_int(h3_int_index, resolution):
+#   return a uint64 array with the parent at resolution of each uint64 H3 index
+#   - an index of 0 (no location) is returned as 0
+#   - only the unique indices are looked up, as in h3_int_to_string()
+    unique_index, inverse = np.unique(np.asarray(h3_int_index, dtype=np.uint64), return_inverse=True)
+    unique_parent = np.array(
+        [int(h3.h3_to_parent(format(int(i), "x"), resolution), 16) if i else 0 for i in unique_index],
+        dtype=np.uint64,
+        )
+    return unique_parent[inverse.reshape(-1)]
+
+def calculate_h3_index_int(latitude, longitude, resolution=8, chunk_size=H3_INDEX_CHUNK_SIZE):
+#   return a uint64 array with the H3 index for each latitude/longitude pair
+#   - latitude and longitude are array-like and of equal length
+#   - rows with a null (NaN) or zero coordinate are set to 0, matching the
+#     behaviour of challenge_2.calculate_h3_level8_index()
+#   - arrays are indexed chunk_size rows at a time to bound temporary memory
+    latitude  = np.asarray(latitude, dtype=np.float64)
+    longitude = np.asarray(longitude, dtype=np.float64)
+    if latitude.shape != longitude.shape:
+        raise ValueError(f"latitude and longitude lengths differ: {latitude.shape} != {longitude.shape}")
+
+    # mask the rows without a location once for the whole array
+    is_located = ~(np.isnan(latitude) | np.isnan(longitude) | (latitude == 0) | (longitude == 0))
+
+    h3_index = np.zeros(len(latitude), dtype=np.uint64)
+    for start in range(0, len(latitude), chunk_size):
+        stop = start + chunk_size
+        chunk_mask = is_located[start:stop]
+        if chunk_mask.any():
+            h3_index[start:stop][chunk_mask] = h3_vect.geo_to_h3(
+                latitude[start:stop][chunk_mask],
+                longitude[start:stop][chunk_mask],
+                resolution,
+                )
+    return h3_index
+
+def calculate_h3_index(latitude, longitude, resolution=8, chunk_size=H3_INDEX_CHUNK_SIZE):
+#   return an object array with the H3 index string for each latitude/longitude pair
+#   - rows without a location are returned as H3_NULL_INDEX ("0")
+    return h3_int_to_string(
+        calculate_h3_index_int(latitude, longitude, resolution, chunk_size)
+        )
+
+def _attach_shared_array(name, length, dtype):
+#   return (shared_memory, array) attached to an existing shared memory block
+#   - the block is owned, and unlinked, by the parent process
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray((length,), dtype=dtype, buffer=shm.buf)
+
+def _index_shared_row_range(task):
+#   worker function: index rows [start, stop) of the shared coordinate arrays
+#   and write the uint64 result into the shared output array
+    lat_name, lon_name, out_name, length, start, stop, resolution, chunk_size = task
+    blocks = []
+    try:
+        shm, latitude  = _attach_shared_array(lat_name, length, np.float64)
+        blocks.append(shm)
+        shm, longitude = _attach_shared_array(lon_name, length, np.float64)
+        blocks.append(shm)
+        shm, h3_index  = _attach_shared_array(out_name, length, np.uint64)
+        blocks.append(shm)
+        h3_index[start:stop] = calculate_h3_index_int(
+            latitude[start:stop],
+            longitude[start:stop],
+            resolution,
+            chunk_size,
+            )
+        # release the views before the blocks are closed
+        del latitude, longitude, h3_index
+    finally:
+        for shm in blocks:
+            shm.close()
+    return start, stop
+
+def h3_index_executor(num_workers=H3_INDEX_NUM_WORKERS):
+#   return a ProcessPoolExecutor of num_workers processes for calculate_h3_index_parallel()
+#   - the workers are started by a fork server ("spawn" where there is none),
+#     not forked from this process: a fork copies the locks held by the other
+#     threads, e.g. the prefetch threads downloading through the S3 client,
+#     and a worker that inherits a held lock deadlocks
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+    else:
+        context = multiprocessing.get_context("spawn")
+    return ProcessPoolExecutor(max_workers=num_workers, mp_context=context)
+
+def calculate_h3_index_parallel(latitude, longitude, resolution=8,
+                                num_workers=H3_INDEX_NUM_WORKERS,
+                                chunk_size=H3_INDEX_CHUNK_SIZE,
+                                min_rows=H3_PARALLEL_MIN_ROWS,
+                                executor=None):
+#   return an object array with the H3 index string for each latitude/longitude pair
+#   - the rows are split into num_workers contiguous row ranges which are
+#     indexed in a process pool and written back in the original row order
+#   - the coordinates and the result are exchanged through shared memory so
+#     that the arrays are not pickled for each worker
+#   - num_workers <= 1, or fewer than min_rows rows, uses the serial
+#     calculate_h3_index(); both paths return identical output
+#   - executor (from h3_index_executor()) is used, and left running, instead
+#     of a pool started for this call, so a caller indexing many chunks
+#     starts the worker processes once
+    latitude  = np.ascontiguousarray(latitude, dtype=np.float64)
+    longitude = np.ascontiguousarray(longitude, dtype=np.float64)
+    length = len(latitude)
+    if latitude.shape != longitude.shape:
+        raise ValueError(f"latitude and longitude lengths differ: {latitude.shape} != {longitude.shape}")
+
+    num_workers = min(int(num_workers or 1), length)
+    if num_workers <= 1 or length < min_rows:
+        logger.debug(f"H3 index computed serially for {length} rows")
+        return calculate_h3_index(latitude, longitude, resolution, chunk_size)
+
+    blocks = []
+    arrays = {}
+    try:
+        for name, dtype, source in (("latitude", np.float64, latitude),
+                                    ("longitude", np.float64, longitude),
+                                    ("h3_index", np.uint64, None)):
+            shm = shared_memory.SharedMemory(create=True, size=max(length*np.dtype(dtype).itemsize, 1))
+            blocks.append(shm)
+            arrays[name] = np.ndarray((length,), dtype=dtype, buffer=shm.buf)
+            if source is not None:
+                arrays[name][:] = source
+
+        # contiguous row ranges, one per worker
+        bounds = np.linspace(0, length, num_workers + 1, dtype=np.int64)
+        tasks = [
+            (blocks[0].name, blocks[1].name, blocks[2].name, length,
+             int(start), int(stop), resolution, chunk_size)
+            for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start
+            ]
+        pool = h3_index_executor(num_workers) if executor is None else None
+        try:
+            for start, stop in (executor or pool).map(_index_shared_row_range, tasks):
+                logger.debug(f"H3 index computed for rows {start}-{stop}")
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+        h3_index = h3_int_to_string(arrays["h3_index"])
+    finally:
+        # release the views before the blocks are closed
+        arrays.clear()
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+    return h3_index
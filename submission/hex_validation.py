@@ -0,0 +1,129 @@
+# This module contains the validation of extracted H3 hex features used by the
+# scripts submitted for the City of Cape Town - Data Science Unit Code Challenge
+# https://github.com/cityofcapetown/ds_code_challenge
+#
+# Features are matched on their H3 'index' property rather than by position.
+# Each feature is compared by a digest of its canonical JSON; the geometries
+# are only compared coordinate by coordinate when the digests differ.
+# Validation is linear in the number of features.
+# HexFeatureValidator.from_geojson() streams the reference file: only the digest
+# and file location of each reference feature are kept, and a reference feature
+# is read back from the file only when its digest differs.
+
+from support_library import(HEX_GEOMETRY_TOLERANCE,
+                            iter_geojson_features,
+                            read_geojson_feature,
+                            )
+
+from loguru import logger
+import hashlib
+import json
+
+import numpy as np
+
+
+def feature_index(feature):
+#   return the H3 index of a hex feature
+    return feature['properties']['index']
+
+def feature_digest(feature):
+#   return a stable digest of a feature: the SHA-1 of its JSON with sorted keys
+    canonical = json.dumps(feature, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+def geometry_equal(geometry_a, geometry_b, tolerance=HEX_GEOMETRY_TOLERANCE):
+#   return True if two GeoJSON geometries have the same type and coordinates
+#   within tolerance
+    if geometry_a.get('type') != geometry_b.get('type'):
+        return False
+    try:
+        coords_a = np.asarray(geometry_a.get('coordinates'), dtype=np.float64)
+        coords_b = np.asarray(geometry_b.get('coordinates'), dtype=np.float64)
+    except ValueError:
+        # ragged coordinate lists, e.g. polygons with holes
+        return geometry_a.get('coordinates') == geometry_b.get('coordinates')
+    return coords_a.shape == coords_b.shape and np.allclose(coords_a, coords_b, rtol=0, atol=tolerance)
+
+
+class HexFeatureValidator:
+#   Validates extracted hex features against reference features, by H3 index.
+#   - validate(feature) checks one extracted feature as it arrives
+#   - report() logs and returns the missing, extra and changed H3 indices
+#   A feature whose digest differs from the reference is still valid if its 
+#   properties are equal and its geometry is equal within tolerance.
+    def __init__(self, reference_features=(), tolerance=HEX_GEOMETRY_TOLERANCE):
+        self.tolerance = tolerance
+        self._reference = {}
+        self._digests = {}
+        self._file_name = None
+        self._locations = {}
+        for feature in reference_features:
+            index = feature_index(feature)
+            self._reference[index] = feature
+            self._digests[index] = feature_digest(feature)
+        self._seen = set()
+        self.extra = []
+        self.changed = []
+        self.duplicate = []
+
+    @classmethod
+    def from_geojson(cls, file_name, tolerance=HEX_GEOMETRY_TOLERANCE):
+#       return a validator against the features of the GeoJSON file_name, 
+#       read one feature at a time rather than loaded whole
+        validator = cls(tolerance=tolerance)
+        validator._file_name = file_name
+        for feature, offset, size in iter_geojson_features(file_name):
+            index = feature_index(feature)
+            validator._digests[index] = feature_digest(feature)
+            validator._locations[index] = (offset, size)
+        return validator
+
+    def _reference_feature(self, index):
+#       return the reference feature with H3 index, read back from the file if streamed
+        if index in self._reference:
+            return self._reference[index]
+        return read_geojson_feature(self._file_name, *self._locations[index])
+
+    def validate(self, feature):
+#       return True if feature matches the reference feature with the same H3 index
+        index = feature_index(feature)
+        if index in self._seen:
+            self.duplicate.append(index)
+            return False
+        self._seen.add(index)
+
+        if index not in self._digests:
+            self.extra.append(index)
+            return False
+        if feature_digest(feature) == self._digests[index]:
+            return True
+
+        reference = self._reference_feature(index)
+        if (feature.get('properties') == reference.get('properties') 
+            and geometry_equal(feature.get('geometry', {}), reference.get('geometry', {}), self.tolerance)):
+            return True
+        self.changed.append(index)
+        return False
+
+    def missing(self):
+#       return the reference H3 indices that have not been validated
+        return [index for index in self._digests if index not in self._seen]
+
+    def report(self, max_logged=10):
+#       logs and returns a summary of the validation
+        report = {
+            "validated": len(self._seen) - len(self.extra) - len(self.changed),
+            "missing": self.missing(),
+            "extra": self.extra,
+            "changed": self.changed,
+            "duplicate": self.duplicate,
+            }
+        logger.info(f"Validated hex features: {report['validated']} of {len(self._digests)}")
+        for name in ("missing", "extra", "changed", "duplicate"):
+            if report[name]:
+                logger.error(f"{name.capitalize()} hex features: {len(report[name])}, e.g. {report[name][:max_logged]}")
+        return report
+
+    def is_valid(self):
+#       return True if every reference feature was extracted unchanged, once
+        return not (self.extra or self.changed or self.duplicate) and len(self._seen) == len(self._digests)
@@ -0,0 +1,224 @@
+# This module contains the incremental ingestion used by challenge_2.py for the
+# City of Cape Town - Data Science Unit Code Challenge
+# https://github.com/cityofcapetown/ds_code_challenge
+#
+# The manifest of CHALLENGE_2_PARTITIONED_OUTPUT records a high-water mark (the
+# latest INCREMENTAL_TIMESTAMP_COLUMN ingested) and a row index: the key,
+# timestamp, row hash and partition file of every request in the store,
+# including the requests without a timestamp. Each new extract of the service
+# requests is compared with it:
+# - requests in the store created more than INCREMENTAL_LOOKBACK_DAYS before
+#   the high-water mark are taken as unchanged, and are not hashed
+# - the other requests (created since, without a timestamp, or not in the
+#   store) are hashed and compared with the row index: new and changed
+#   requests form the delta
+# - requests in the store that are no longer in the extract are removed
+# - a key repeated in the extract keeps its last row, as does a key stored more
+#   than once (by a run before duplicates were handled)
+# - every INCREMENTAL_FULL_PASS_DAYS a full pass hashes every request, so a
+#   change to an older request is picked up too
+# The delta is indexed and appended to the store, and the files holding changed
+# or removed requests are rewritten without them (PartitionedServiceRequestsWriter
+# with append=True). The manifest is replaced last, so a failed run leaves the
+# store as it was.
+
+from support_library import(INCREMENTAL_TIMESTAMP_COLUMN,
+                            INCREMENTAL_KEY_COLUMN,
+                            INCREMENTAL_LOOKBACK_DAYS,
+                            INCREMENTAL_FULL_PASS_DAYS,
+                            )
+from frame_diff import row_hashes
+
+from loguru import logger
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+ROW_INDEX_COLUMNS = ["key", "timestamp", "row_hash", "file"]
+
+
+def has_incremental_state(manifest):
+#   return True if the manifest of a partitioned output holds the row index of
+#   the incremental ingestion; a store written by main() or main_streaming(),
+#   or before the row index covered every request, does not
+    return "row_index" in (manifest or {}).get("incremental", {})
+
+def read_row_index(directory, manifest):
+#   return the row index of the partitioned output directory as a dataframe
+#   with ROW_INDEX_COLUMNS, empty if the output has no incremental state
+    file_name = (manifest or {}).get("incremental", {}).get("row_index")
+    if file_name is None:
+        return pd.DataFrame({
+            "key": pd.Series(dtype=object),
+            "timestamp": pd.Series(dtype="datetime64[ns, UTC]"),
+            "row_hash": pd.Series(dtype=np.uint64),
+            "file": pd.Series(dtype=object),
+            })
+    row_index = pq.read_table(os.path.join(directory, file_name)).to_pandas()
+    row_index["key"] = row_index["key"].astype(object)
+    row_index["file"] = row_index["file"].astype(object)
+    return row_index
+
+
+class ServiceRequestDelta:
+#   Selects the new and changed service requests of an extract, fed to select()
+#   in chunks, against the incremental state of a partitioned output.
+#   - manifest is the manifest of the partitioned output directory, None for
+#     a new output: every request is then new
+#   - the chunks are read with every column but 'latitude' and 'longitude' as
+#     text, so a request hashes the same whatever dtypes pandas would infer
+#   - the first column (the row number of the extract) is not hashed
+#   - now (default: the current time) decides if a full pass is due
+    def __init__(self, directory, manifest=None, lookback_days=INCREMENTAL_LOOKBACK_DAYS,
+                 full_pass_days=INCREMENTAL_FULL_PASS_DAYS, key_column=INCREMENTAL_KEY_COLUMN,
+                 timestamp_column=INCREMENTAL_TIMESTAMP_COLUMN, now=None):
+        state = (manifest or {}).get("incremental", {})
+        self.key_column = key_column
+        self.timestamp_column = timestamp_column
+        self.lookback = pd.Timedelta(days=lookback_days)
+        self.full_pass_days = full_pass_days
+        self.row_index = read_row_index(directory, manifest)
+        self.index_file = state.get("row_index")
+        self.high_water_mark = None
+        self.since = None
+        if state.get("high_water_mark") is not None:
+            self.high_water_mark = pd.Timestamp(state["high_water_mark"])
+            self.since = self.high_water_mark - self.lookback
+
+        # a new store hashes every request, which counts as a full pass
+        now = pd.Timestamp.now(tz="UTC") if now is None else pd.Timestamp(now)
+        last_full_pass = state.get("last_full_pass")
+        self.is_full_pass = (last_full_pass is None
+                             or now - pd.Timestamp(last_full_pass) >= pd.Timedelta(days=full_pass_days))
+        self.last_full_pass = now.isoformat() if self.is_full_pass else last_full_pass
+
+        # the earlier rows of a key stored more than once are superseded, the
+        # keys are looked up among the last ones
+        is_duplicate = self.row_index["key"].duplicated(keep="last").to_numpy()
+        self._unique = np.flatnonzero(~is_duplicate)
+        self._index_keys = pd.Index(self.row_index["key"].to_numpy()[self._unique])
+        self._index_hashes = self.row_index["row_hash"].to_numpy(dtype=np.uint64)
+        self._is_seen = is_duplicate.copy()
+        self._is_changed = is_duplicate.copy()
+        self._is_superseded = None
+        self._delta = []
+        self._delta_keys = set()
+        self.latest = self.high_water_mark
+        self.num_rows = 0
+        self.num_skipped = 0
+        self.num_undated = 0
+        self.num_new = 0
+        self.num_changed = 0
+        self.num_removed = 0
+        self.num_duplicates = 0
+
+    def select(self, chunk):
+#       return the new and changed requests of chunk, and their row hashes
+        timestamps = pd.to_datetime(chunk[self.timestamp_column], utc=True, errors="coerce")
+        is_dated = timestamps.notna().to_numpy()
+        self.num_rows += len(chunk)
+        self.num_undated += int((~is_dated).sum())
+        if is_dated.any():
+            latest = timestamps[is_dated].max()
+            self.latest = latest if self.latest is None else max(self.latest, latest)
+
+        # every request of the extract is looked up, so removals are found
+        # whatever their age; only the candidates are hashed
+        keys = chunk[self.key_column].astype(str).to_numpy(dtype=object)
+        position = self._index_keys.get_indexer(keys)
+        position[position >= 0] = self._unique[position[position >= 0]]
+        self._is_seen[position[position >= 0]] = True
+
+        # a key repeated in the chunk keeps its last row; a key already in the
+        # delta of an earlier chunk is written again, replacing that row
+        is_last = ~pd.Series(keys).duplicated(keep="last").to_numpy()
+        is_repeated = pd.Series(keys).isin(self._delta_keys).to_numpy()
+        self.num_duplicates += int((~is_last | is_repeated).sum())
+        is_candidate = np.ones(len(chunk), dtype=bool)
+        if self.since is not None and not self.is_full_pass:
+            is_candidate = ~is_dated | (timestamps >= self.since).to_numpy() | (position < 0) | is_repeated
+        is_candidate &= is_last
+        self.num_skipped += int((~is_candidate & is_last).sum())
+
+        candidates = chunk[is_candidate]
+        position = position[is_candidate]
+        is_repeated = is_repeated[is_candidate]
+        hashes = row_hashes(candidates, candidates.columns[1:])
+        is_new = position < 0
+        previous = np.zeros(len(candidates), dtype=np.uint64)
+        previous[~is_new] = self._index_hashes[position[~is_new]]
+        is_changed = ~is_new & (previous != hashes)
+        self.num_new += int((is_new & ~is_repeated).sum())
+        self.num_changed += int((is_changed & ~is_repeated).sum())
+        is_delta = is_new | is_changed | is_repeated
+        self._is_changed[position[is_delta & ~is_new]] = True
+        self._delta_keys.update(keys[is_candidate][is_delta])
+        return candidates[is_delta], hashes[is_delta]
+
+    def record(self, delta, hashes, file_names):
+#       records the requests of delta (as selected) written to file_names (one per row)
+        self._delta.append(pd.DataFrame({
+            "key": delta[self.key_column].astype(str).to_numpy(dtype=object),
+            "timestamp": pd.to_datetime(delta[self.timestamp_column], utc=True, errors="coerce"),
+            "row_hash": hashes,
+            "file": np.asarray(file_names, dtype=object),
+            }).reset_index(drop=True))
+
+    def superseded(self):
+#       return {file: keys}: the requests stored earlier that changed or are no
+#       longer in the extract, and the rows of the delta replaced by a later row
+#       of the same key, by the file holding them
+        is_removed = ~self._is_seen
+        self.num_removed = int(is_removed.sum())
+        self._is_superseded = is_removed | self._is_changed
+        superseded = [self.row_index[self._is_superseded]]
+        if self._delta:
+            delta = pd.concat(self._delta, ignore_index=True)
+            is_replaced = delta["key"].duplicated(keep="last")
+            superseded.append(delta[is_replaced])
+            self._delta = [delta[~is_replaced]]
+        superseded = pd.concat(superseded, ignore_index=True)
+        return {file_name: keys.tolist() for file_name, keys in superseded.groupby("file")["key"]}
+
+    def is_unchanged(self):
+#       return True if the extract adds, changes and removes no request, and no
+#       full pass is to be recorded (call after superseded())
+        return (not self._delta and self.num_removed == 0 and self.latest == self.high_water_mark
+                and not self.is_full_pass)
+
+    def updated_row_index(self, renamed):
+#       return the row index after the delta is written and the superseded
+#       requests removed; renamed maps the rewritten files to their new names
+        row_index = pd.concat([self.row_index[~self._is_superseded]] + self._delta, ignore_index=True)
+        row_index["file"] = [renamed.get(file_name, file_name) for file_name in row_index["file"]]
+        return row_index[ROW_INDEX_COLUMNS].reset_index(drop=True)
+
+    def commit(self, writer, renamed):
+#       writes the row index and the incremental state to the manifest of writer
+        index_file = f"index-{writer.reserve_batch():05d}.parquet"
+        row_index = self.updated_row_index(renamed)
+        writer.write_table(index_file, pa.Table.from_pandas(row_index, preserve_index=False))
+        if self.index_file is not None:
+            writer.drop_file(self.index_file)
+        writer.manifest["incremental"] = {
+            "high_water_mark": None if self.latest is None else self.latest.isoformat(),
+            "lookback_days": self.lookback.days,
+            "full_pass_days": self.full_pass_days,
+            "last_full_pass": self.last_full_pass,
+            "key_column": self.key_column,
+            "timestamp_column": self.timestamp_column,
+            "row_index": index_file,
+            }
+
+    def log(self):
+#       logs the size of the delta
+        if self.is_full_pass and self.index_file is not None:
+            logger.info(f"Full pass: every request is compared (last full pass more than {self.full_pass_days} days ago)")
+        logger.info(f"Service requests in extract: {self.num_rows}. Skipped before {self.since}: {self.num_skipped}, "
+                    f"without {self.timestamp_column}: {self.num_undated}")
+        logger.info(f"Service requests new: {self.num_new}, changed: {self.num_changed}, "
+                    f"removed: {self.num_removed}. High-water mark: {self.latest}")
+        if self.num_duplicates:
+            logger.warning(f"Service requests with a repeated {self.key_column}: {self.num_duplicates}. The last row of each key is kept")
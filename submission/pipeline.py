@@ -0,0 +1,466 @@
+# This script runs the scripts submitted for the City of Cape Town - Data Science
+# Unit Code Challenge as a pipeline, re-running only the stages that changed
+# https://github.com/cityofcapetown/ds_code_challenge
+#
+# Step 1.  Declare the stages (the challenge scripts), their outputs, the outputs
+#          of other stages they read and their remote inputs (S3 objects and URLs)
+# Step 2.  Check the version (ETag, Last-Modified) of the remote inputs
+# Step 3.  Run the stages in dependency order, a stage as soon as the stages it
+#          depends on have completed: challenge_1 and challenge_2 run concurrently
+# Step 4.  Save the fingerprint and outputs of each completed stage to PIPELINE_STATE_FILE
+#
+# A stage is fingerprinted by:
+# - its code: the script and the local modules it imports, as parsed (comments
+#   and formatting do not count). The constants of support_library.py are left
+#   out of its code and counted as parameters instead.
+# - its parameters: the values of the support_library constants the code uses
+# - its inputs: the content digests of the outputs of the stages it depends on
+# - its remote inputs: the ETag of each S3 object, the validators of each URL
+# A stage is skipped if its fingerprint matches the last successful run and its
+# outputs are unchanged on disk. Digests of unchanged files (same size and
+# modification time) are reused, so a rerun with nothing to do takes seconds.
+# A stage that reruns but writes identical outputs does not rerun the stages
+# that depend on it.
+#
+# The scripts run as subprocesses with --keep-cached-files, so their downloads
+# are reused; the local copy of a remote input that changed is deleted first.
+
+from support_library import(set_s3_client,
+                            file_digest,
+                            delete_file,
+                            run_stage,
+                            start_run_report,
+                            finish_run_report,
+                            BUCKET_NAME,
+                            CITY_HEX_POLYGONS_8_10_SOURCE,
+                            CITY_HEX_POLYGONS_8_SOURCE,
+                            CHALLENGE_1_RESOLUTIONS,
+                            SERVICE_REQUEST_SOURCE,
+                            SERVICE_REQUEST_HEX_SOURCE,
+                            CHALLENGE_2_OUTPUT,
+                            CHALLENGE_2_PARQUET_OUTPUT,
+                            CHALLENGE_2_WRITE_PARQUET,
+                            CHALLENGE_2_PARTITIONED_OUTPUT,
+                            CHALLENGE_2_WRITE_PARTITIONS,
+                            CHALLENGE_2_POLYGON_JOIN,
+                            CHALLENGE_2_INCREMENTAL,
+                            WIND_DATA_SOURCE,
+                            WIND_DATA_OUTPUT,
+                            WIND_DATA_STORE_DIR,
+                            CHALLENGE_5_ARCGIS_URL,
+                            CHALLENGE_5_LABEL_SUBURBS,
+                            OFFICIAL_SUBURBS_URL,
+                            OFFICIAL_SUBURBS_OUTPUT,
+                            CHALLENGE_5_TMP_OUTPUT,
+                            CHALLENGE_5_OUTPUT,
+                            PIPELINE_STATE_FILE,
+                            PIPELINE_MAX_WORKERS,
+                            PIPELINE_HTTP_TIMEOUT,
+                            PIPELINE_LOG,
+                            PIPELINE_RUN_REPORT,
+                            )
+import support_library
+from challenge_1 import resolution_output
+
+from loguru import logger
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timezone
+import os
+import sys
+import ast
+import json
+import time
+import timeit
+import hashlib
+import argparse
+import subprocess
+
+import requests
+import botocore.exceptions
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+SUPPORT_LIBRARY_MODULE = "support_library"
+
+
+class PipelineStage:
+#   A script of the pipeline.
+#   - outputs: the files and directories the script writes
+#   - upstream: the names of the stages whose outputs the script reads
+#   - s3_inputs: {key in BUCKET_NAME: local copy of the object, or None}
+#   - url_inputs: {url: local copy of the download, or None}
+#   - local_inputs: the files and directories the script reads that no stage
+#     writes, e.g. a store the script updates and reads across runs
+    def __init__(self, name, script, outputs, upstream=(), s3_inputs=None, url_inputs=None, local_inputs=()):
+        self.name = name
+        self.script = script
+        self.outputs = list(outputs)
+        self.upstream = list(upstream)
+        self.s3_inputs = s3_inputs or {}
+        self.url_inputs = url_inputs or {}
+        self.local_inputs = list(local_inputs)
+
+def declare_stages():
+    # Step 1.  Declare the stages, their outputs, the outputs of other stages
+    # they read and their remote inputs
+    challenge_2_outputs = [CHALLENGE_2_OUTPUT]
+    if CHALLENGE_2_WRITE_PARQUET:
+        challenge_2_outputs.append(CHALLENGE_2_PARQUET_OUTPUT)
+    if CHALLENGE_2_WRITE_PARTITIONS:
+        challenge_2_outputs.append(CHALLENGE_2_PARTITIONED_OUTPUT)
+    if CHALLENGE_2_INCREMENTAL:
+        # the incremental mode only updates the partitioned output
+        challenge_2_outputs = [CHALLENGE_2_PARTITIONED_OUTPUT]
+    challenge_2_s3_inputs = {
+        SERVICE_REQUEST_SOURCE: SERVICE_REQUEST_SOURCE,
+        SERVICE_REQUEST_HEX_SOURCE: SERVICE_REQUEST_HEX_SOURCE,
+        }
+    if CHALLENGE_2_POLYGON_JOIN:
+        challenge_2_s3_inputs[CITY_HEX_POLYGONS_8_SOURCE] = CITY_HEX_POLYGONS_8_SOURCE
+    # the centroid query is made unless the suburb layer is read; the wind data
+    # is ingested into, and joined from, the wind data store
+    challenge_5_url_inputs = {
+        WIND_DATA_SOURCE: WIND_DATA_OUTPUT,
+        CHALLENGE_5_ARCGIS_URL: None,
+        }
+    if CHALLENGE_5_LABEL_SUBURBS:
+        challenge_5_url_inputs[OFFICIAL_SUBURBS_URL] = OFFICIAL_SUBURBS_OUTPUT
+
+    return [
+        PipelineStage(
+            "challenge_1", "challenge_1.py",
+            outputs=[resolution_output(resolution) for resolution in sorted(set(CHALLENGE_1_RESOLUTIONS))],
+            s3_inputs={
+                CITY_HEX_POLYGONS_8_10_SOURCE: None,
+                CITY_HEX_POLYGONS_8_SOURCE: CITY_HEX_POLYGONS_8_SOURCE,
+                },
+            ),
+        PipelineStage(
+            "challenge_2", "challenge_2.py",
+            outputs=challenge_2_outputs,
+            s3_inputs=challenge_2_s3_inputs,
+            ),
+        PipelineStage(
+            "challenge_5", "challenge_5.py",
+            outputs=[CHALLENGE_5_TMP_OUTPUT, CHALLENGE_5_OUTPUT],
+            upstream=["challenge_2"],
+            url_inputs=challenge_5_url_inputs,
+            local_inputs=[WIND_DATA_STORE_DIR],
+            ),
+        ]
+
+
+def _support_library_constants():
+#   return the names of the module level constants of support_library.py
+    return {name for name in vars(support_library) if name.isupper()}
+
+def _is_constant_assignment(node):
+    if isinstance(node, ast.Assign):
+        return all(isinstance(target, ast.Name) and target.id.isupper() for target in node.targets)
+    return isinstance(node, ast.AnnAssign) and isinstance(node.target, ast.Name) and node.target.id.isupper()
+
+def code_fingerprint(script, directory=SCRIPT_DIR):
+#   return ({module file: digest}, {support_library constant: value}) for script
+#   and the local modules it imports, directly or through other local modules
+#   - a module is digested as parsed, so comments and formatting do not count
+#   - the constants of support_library.py are left out of its digest, and
+#     the values of the constants the modules use are returned instead
+    constants = _support_library_constants()
+    code = {}
+    names = set()
+    pending = [script]
+    while pending:
+        file_name = pending.pop()
+        if file_name in code:
+            continue
+        with open(os.path.join(directory, file_name)) as f_:
+            tree = ast.parse(f_.read(), file_name)
+        if file_name == SUPPORT_LIBRARY_MODULE + ".py":
+            tree.body = [node for node in tree.body if not _is_constant_assignment(node)]
+        code[file_name] = hashlib.sha256(ast.dump(tree).encode("utf-8")).hexdigest()
+
+        for node in ast.walk(tree):
+            modules = []
+            if isinstance(node, ast.Name):
+                names.add(node.id)
+            elif isinstance(node, ast.Import):
+                modules = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0:
+                modules = [node.module]
+                names.update(alias.name for alias in node.names)
+            pending.extend(f"{module}.py" for module in modules
+                           if os.path.exists(os.path.join(directory, f"{module}.py")))
+    parameters = {name: json.dumps(getattr(support_library, name), sort_keys=True, default=repr)
+                  for name in sorted(names & constants)}
+    return code, parameters
+
+
+def path_digest(path, digests):
+#   return the SHA-256 digest of the file or directory path, or None if it does not exist
+#   - digests caches {file: {"size", "mtime_ns", "sha256"}}; the digest of a
+#     file with the same size and modification time is reused
+#   - a directory is digested from the relative paths and digests of its files
+    if os.path.isdir(path):
+        digest = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for file_name in sorted(files):
+                file_path = os.path.join(root, file_name)
+                digest.update(f"{os.path.relpath(file_path, path)}:{path_digest(file_path, digests)}\n".encode("utf-8"))
+        return digest.hexdigest()
+    if not os.path.isfile(path):
+        return None
+    stat = os.stat(path)
+    cached = digests.get(path)
+    if cached is None or cached["size"] != stat.st_size or cached["mtime_ns"] != stat.st_mtime_ns:
+        cached = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": file_digest(path)}
+        digests[path] = cached
+    return cached["sha256"]
+
+def path_mtime(path):
+#   return the latest modification time of the file or directory path (and its files)
+    if not os.path.isdir(path):
+        return os.path.getmtime(path)
+    mtimes = [os.path.getmtime(path)]
+    for root, _, files in os.walk(path):
+        mtimes.extend(os.path.getmtime(os.path.join(root, file_name)) for file_name in files)
+    return max(mtimes)
+
+
+def remote_versions(stages, state, offline=False):
+    # Step 2.  Check the version (ETag, Last-Modified) of the remote inputs
+    # return {"s3://bucket/key" or url: version} for the remote inputs of stages
+    # - the version of an input that cannot be checked (offline==True, no
+    #   credentials, connection errors) is taken from the last run, so the
+    #   stages reading it are not rerun because of it
+    recorded = {}
+    for stage_state in state["stages"].values():
+        recorded.update(stage_state.get("components", {}).get("remote", {}))
+
+    versions = {}
+    s3_keys = sorted({key for stage in stages for key in stage.s3_inputs})
+    urls = sorted({url for stage in stages for url in stage.url_inputs})
+    process_start_time = timeit.default_timer()
+    s3_client = None
+    if s3_keys and not offline:
+        try:
+            s3_client = set_s3_client()
+        except Exception:
+            logger.exception("Cannot create the S3 client. Using the S3 object versions of the last run.")
+    for key in s3_keys:
+        name = f"s3://{BUCKET_NAME}/{key}"
+        versions[name] = recorded.get(name)
+        if s3_client is None:
+            continue
+        try:
+            versions[name] = s3_client.head_object(Bucket=BUCKET_NAME, Key=key)["ETag"].strip('"')
+        except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError):
+            logger.exception(f"Cannot check: '{name}'. Using the version of the last run.")
+    for url in urls:
+        versions[url] = recorded.get(url)
+        if offline:
+            continue
+        try:
+            response = requests.head(url, allow_redirects=True, timeout=PIPELINE_HTTP_TIMEOUT)
+            response.raise_for_status()
+            validators = [response.headers.get(header) for header in ("ETag", "Last-Modified", "Content-Length")]
+            if any(validators):
+                versions[url] = "/".join(validator or "" for validator in validators)
+            else:
+                logger.warning(f"No ETag or Last-Modified for: '{url}'. Using the version of the last run.")
+        except requests.exceptions.RequestException:
+            logger.exception(f"Cannot check: '{url}'. Using the version of the last run.")
+    time_elapsed = timeit.default_timer() - process_start_time
+    logger.info(f"Remote inputs checked: {len(versions)}. Time Taken: {time_elapsed}s")
+    return versions
+
+def stage_components(stage, stages, versions, digests):
+#   return the fingerprint components of stage: code, parameters, inputs and remote
+    code, parameters = code_fingerprint(stage.script)
+    inputs = {path: path_digest(path, digests) for name in stage.upstream for path in stages[name].outputs}
+    inputs.update({path: path_digest(path, digests) for path in stage.local_inputs})
+    remote = {f"s3://{BUCKET_NAME}/{key}": versions.get(f"s3://{BUCKET_NAME}/{key}") for key in stage.s3_inputs}
+    remote.update({url: versions.get(url) for url in stage.url_inputs})
+    return {"code": code, "parameters": parameters, "inputs": inputs, "remote": remote}
+
+def fingerprint(components):
+    return hashlib.sha256(json.dumps(components, sort_keys=True).encode("utf-8")).hexdigest()
+
+def stale_reasons(stage, components, stage_state, digests):
+#   return why stage must run (an empty list if it is up to date)
+    if stage_state is None:
+        return ["no successful run recorded"]
+    if stage_state["fingerprint"] == fingerprint(components) and stage_state["outputs"] == {
+            path: path_digest(path, digests) for path in stage.outputs}:
+        return []
+    reasons = []
+    for kind, values in components.items():
+        previous = stage_state["components"].get(kind, {})
+        for name in sorted(set(values) | set(previous)):
+            if values.get(name) != previous.get(name):
+                reasons.append(f"{kind} changed: {name}")
+    for path in stage.outputs:
+        if stage_state["outputs"].get(path) != path_digest(path, digests):
+            reasons.append(f"output missing or changed: {path}")
+    return reasons
+
+def read_state(file_name=PIPELINE_STATE_FILE):
+#   return the pipeline state saved by the last run, or an empty state
+    if os.path.exists(file_name):
+        try:
+            with open(file_name) as f_:
+                return json.load(f_)
+        except ValueError:
+            logger.exception(f"Cannot read: '{file_name}'. All stages will run.")
+    return {"stages": {}, "digests": {}}
+
+def save_state(state, file_name=PIPELINE_STATE_FILE):
+#   writes the pipeline state to a temporary file that replaces file_name,
+#   so an interrupted run never leaves a partial state
+    with open(file_name + ".tmp", "w") as f_:
+        json.dump(state, f_, indent=1, sort_keys=True)
+    os.replace(file_name + ".tmp", file_name)
+
+
+def run_script(stage):
+#   runs the script of stage with --keep-cached-files in the current directory
+#   return the exit code of the script and its start time
+    start_time = time.time()
+    with run_stage(stage.name) as stage_:
+        logger.info(f"Running {stage.name}: {stage.script}")
+        completed = subprocess.run([sys.executable, os.path.join(SCRIPT_DIR, stage.script), "--keep-cached-files"])
+    logger.info(f"{stage.name} exited with code {completed.returncode}. Time Taken: {stage_.time_elapsed}s")
+    return completed.returncode, start_time
+
+def prepare_stage(stage, components, stage_state):
+#   deletes the local copies of the remote inputs of stage that changed since
+#   its last run, so the script downloads them again
+    previous = (stage_state or {}).get("components", {}).get("remote", {})
+    local_copies = {f"s3://{BUCKET_NAME}/{key}": local for key, local in stage.s3_inputs.items()}
+    local_copies.update(stage.url_inputs)
+    for name, local in local_copies.items():
+        if local is not None and stage_state is not None and previous.get(name) != components["remote"][name]:
+            logger.info(f"Remote input changed, deleting local copy: '{local}'")
+            delete_file(local)
+
+def complete_stage(stage, components, exit_code, start_time, state):
+#   records the fingerprint and outputs of stage in state if it succeeded
+#   the script must exit with 0 and write every output: a script that fails
+#   leaves the outputs of its last run in place, which must not be recorded
+#   return True if the stage succeeded
+    missing = [path for path in stage.outputs if not os.path.exists(path) or path_mtime(path) < start_time - 1]
+    if exit_code != 0 or missing:
+        logger.error(f"{stage.name} failed: exit code {exit_code}, outputs not written: {missing}")
+        state["stages"].pop(stage.name, None)
+        return False
+    # the local inputs are recorded as the script left them: a store it
+    # updated does not make the next run stale, a store changed since does
+    components["inputs"].update({path: path_digest(path, state["digests"]) for path in stage.local_inputs})
+    state["stages"][stage.name] = {
+        "fingerprint": fingerprint(components),
+        "components": components,
+        "outputs": {path: path_digest(path, state["digests"]) for path in stage.outputs},
+        "completed": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        }
+    return True
+
+
+def run_pipeline(stages, state, force=(), offline=False, dry_run=False, max_workers=PIPELINE_MAX_WORKERS):
+    # Step 3.  Run the stages in dependency order, a stage as soon as the
+    # stages it depends on have completed
+    # return {stage name: "skipped", "ran", "failed", "blocked" or "stale" (dry_run)}
+    stages = {stage.name: stage for stage in stages}
+    versions = remote_versions(stages.values(), state, offline)
+    digests = state["digests"]
+    status = {}
+    running = {}
+    components = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while len(status) < len(stages):
+            ready = [stage for name, stage in stages.items() if name not in status and name not in running.values()
+                     and all(upstream in status for upstream in stage.upstream)]
+            for stage in ready:
+                if any(status[upstream] in ("failed", "blocked") for upstream in stage.upstream):
+                    logger.error(f"{stage.name} not run: a stage it depends on failed")
+                    status[stage.name] = "blocked"
+                    continue
+                components[stage.name] = stage_components(stage, stages, versions, digests)
+                stage_state = state["stages"].get(stage.name)
+                reasons = stale_reasons(stage, components[stage.name], stage_state, digests)
+                if stage.name in force:
+                    reasons.append("forced")
+                if dry_run and any(status[upstream] == "stale" for upstream in stage.upstream):
+                    reasons.append("a stage it depends on is stale")
+                if not reasons:
+                    logger.info(f"{stage.name} is up to date")
+                    status[stage.name] = "skipped"
+                    continue
+                logger.info(f"{stage.name} is stale: {'; '.join(reasons)}")
+                if dry_run:
+                    status[stage.name] = "stale"
+                    continue
+                prepare_stage(stage, components[stage.name], stage_state)
+                running[executor.submit(run_script, stage)] = stage.name
+
+            if not running:
+                if not ready and len(status) < len(stages):
+                    raise ValueError(f"Stages with unknown or circular dependencies: {sorted(set(stages) - set(status))}")
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = stages[running.pop(future)]
+                try:
+                    exit_code, start_time = future.result()
+                except Exception:
+                    logger.exception(f"Cannot run: {stage.script}")
+                    exit_code, start_time = None, None
+                is_success = exit_code is not None and complete_stage(stage, components[stage.name], exit_code, start_time, state)
+                status[stage.name] = "ran" if is_success else "failed"
+                # Step 4.  Save the fingerprint and outputs of each completed stage
+                save_state(state)
+    if not dry_run:
+        # forget the digests of files that no longer exist, e.g. replaced partitions
+        state["digests"] = {path: digest for path, digest in digests.items() if os.path.exists(path)}
+        save_state(state)
+    return status
+
+def main(force=(), offline=False, dry_run=False, max_workers=PIPELINE_MAX_WORKERS):
+    stages = declare_stages()
+    unknown = set(force) - {stage.name for stage in stages}
+    if unknown:
+        logger.error(f"Unknown stages: {sorted(unknown)}")
+        return False
+    state = read_state()
+    status = run_pipeline(stages, state, force, offline, dry_run, max_workers)
+    logger.info(f"Pipeline stages: {status}")
+    return all(result in ("skipped", "ran", "stale") for result in status.values())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the challenge scripts, re-running only the stages that changed.")
+    parser.add_argument("--force", nargs="+", default=[], metavar="STAGE", help="stages to run even if up to date")
+    parser.add_argument("--offline", action="store_true", help="do not check the remote inputs for changes")
+    parser.add_argument("--dry-run", action="store_true", help="report the stale stages without running them")
+    parser.add_argument("--workers", type=int, default=PIPELINE_MAX_WORKERS, help="stages run concurrently")
+    args = parser.parse_args()
+
+    # Start timer
+    start_time = timeit.default_timer()
+
+    # Set logger
+    logger.remove()
+    logger.add(sys.stderr, level="INFO")
+    logger.add(PIPELINE_LOG, level="DEBUG", rotation="12:00")
+
+    start_run_report("pipeline", PIPELINE_RUN_REPORT, parameters={
+        "force": args.force,
+        "offline": args.offline,
+        "dry_run": args.dry_run,
+        "workers": args.workers,
+        })
+    try:
+        is_success = main(args.force, args.offline, args.dry_run, args.workers)
+        time_elapsed = timeit.default_timer() - start_time
+        logger.info(f"Pipeline Completed. Total Time Taken: {time_elapsed}s")
+    finally:
+        # the report of a failed run is saved too, with the errors of its stages
+        finish_run_report()
+    sys.exit(0 if is_success else 1)
@@ -0,0 +1,136 @@
+# This module contains the parallel ScanRange S3 SELECT extractor used by the
+# scripts submitted for the City of Cape Town - Data Science Unit Code Challenge
+# https://github.com/cityofcapetown/ds_code_challenge
+#
+# S3 SELECT only supports ScanRange for CSV and JSON Lines objects, so the
+# GeoJSON hex layer is staged once as a JSON Lines copy (one feature per line).
+# The staged copy is then split into byte ranges which are selected with
+# concurrent requests, and the results are merged back in range order.
+# Staging writes an object, so it needs a bucket the credentials can write to
+# (SCAN_RANGE_STAGING_BUCKET; the public input bucket is read only). With the
+# default SCAN_RANGE_STAGING_BUCKET = None, challenge_1.py logs a warning and
+# uses a single S3 SELECT request instead.
+
+from support_library import(SCAN_RANGE_NUM_RANGES,
+                            SCAN_RANGE_MAX_WORKERS,
+                            )
+
+from loguru import logger
+import timeit
+import os
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import botocore.exceptions
+
+SELECT_STATS_FIELDS = ("BytesScanned", "BytesProcessed", "BytesReturned")
+
+
+def stage_json_lines_copy(s3_client, bucket_name, source_key, staging_key, staging_bucket=None):
+#   stages the features of the GeoJSON object bucket_name/source_key as the 
+#   JSON Lines object staging_bucket/staging_key and returns the size of the
+#   staged object in bytes
+#   - staging_bucket must be writable (default: bucket_name)
+#   - the staged object records the ETag of its source in its metadata, so it
+#     is only rebuilt when the source object changes
+#   - the features are extracted with a single S3 SELECT over the document
+#   Exceptions, e.g. for a client without write access, are raised to the caller.
+    staging_bucket = staging_bucket or bucket_name
+    source_etag = s3_client.head_object(Bucket=bucket_name, Key=source_key)["ETag"].strip('"')
+    try:
+        staged = s3_client.head_object(Bucket=staging_bucket, Key=staging_key)
+        if staged.get("Metadata", {}).get("source-etag") == source_etag:
+            logger.info(f"JSON Lines copy found: '{staging_key}'")
+            return staged["ContentLength"]
+    except botocore.exceptions.ClientError:
+        pass
+
+    process_start_time = timeit.default_timer()
+    response = s3_client.select_object_content(
+        Bucket=bucket_name,
+        Key=source_key,
+        ExpressionType='SQL',
+        Expression="SELECT * from S3Object[*].features[*] s",
+        InputSerialization={"JSON": {"Type": "DOCUMENT"}, "CompressionType": "NONE"},
+        OutputSerialization={'JSON': {}},
+    )
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        staging_file = os.path.join(tmp_dir, "staging.jsonl")
+        with open(staging_file, "wb") as f_:
+            for event in response['Payload']:
+                if 'Records' in event:
+                    f_.write(event['Records']['Payload'])
+        s3_client.upload_file(staging_file, staging_bucket, staging_key,
+                              ExtraArgs={"Metadata": {"source-etag": source_etag}})
+        staged_size = os.path.getsize(staging_file)
+    time_elapsed = timeit.default_timer() - process_start_time
+    logger.info(f"JSON Lines copy staged: '{staging_key}' ({staged_size} bytes). Time Taken: {time_elapsed}s")
+    return staged_size
+
+def scan_ranges(object_size, num_ranges):
+#   return a list of (start, end) inclusive byte ranges covering object_size bytes
+    range_size = max(-(-object_size // num_ranges), 1)
+    return [(start, min(start + range_size, object_size) - 1) for start in range(0, object_size, range_size)]
+
+def _select_scan_range(s3_client, bucket_name, key, expression, scan_range):
+#   return (list of records payloads, stats) of one ScanRange S3 SELECT request
+    response = s3_client.select_object_content(
+        Bucket=bucket_name,
+        Key=key,
+        ExpressionType='SQL',
+        Expression=expression,
+        InputSerialization={"JSON": {"Type": "LINES"}, "CompressionType": "NONE"},
+        OutputSerialization={'JSON': {}},
+        ScanRange={"Start": scan_range[0], "End": scan_range[1]},
+    )
+    payload = []
+    stats = {}
+    for event in response['Payload']:
+        if 'Records' in event:
+            payload.append(event['Records']['Payload'])
+        elif "Stats" in event:
+            stats = event["Stats"]["Details"]
+    return payload, stats
+
+def scan_range_select(s3_client, bucket_name, key, expression, object_size,
+                      num_ranges=SCAN_RANGE_NUM_RANGES, max_workers=SCAN_RANGE_MAX_WORKERS):
+#   yields S3 SELECT events for expression over the JSON Lines object key
+#   - the object is split into num_ranges byte ranges that are selected on a
+#     pool of max_workers threads; S3 returns each record from the range in
+#     which the record starts, so no record is returned twice
+#   - the 'Records' events are yielded in range order, so the output has the
+#     order of a single request, followed by one 'Stats' event with the totals
+#   - at most max_workers ranges are requested ahead of the range being 
+#     yielded, so no more than max_workers + 1 range results are held in 
+#     memory, not the whole layer; the events of a range are yielded as S3
+#     sent them, not joined
+#   The events have the shape of the select_object_content() 'Payload', so
+#   they can be consumed by iter_select_records()
+    process_start_time = timeit.default_timer()
+    ranges = iter(scan_ranges(object_size, num_ranges))
+    num_ranges = 0
+    total_stats = {field: 0 for field in SELECT_STATS_FIELDS}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        window = deque()
+
+        def submit_next():
+            scan_range = next(ranges, None)
+            if scan_range is not None:
+                window.append(executor.submit(_select_scan_range, s3_client, bucket_name, key, expression, scan_range))
+
+        for _ in range(max_workers):
+            submit_next()
+        while window:
+            payloads, stats = window.popleft().result()
+            num_ranges += 1
+            submit_next()
+            for field in SELECT_STATS_FIELDS:
+                total_stats[field] += stats.get(field, 0)
+            for payload in payloads:
+                if payload:
+                    yield {'Records': {'Payload': payload}}
+    time_elapsed = timeit.default_timer() - process_start_time
+    logger.info(f"ScanRange S3 SELECT of {num_ranges} ranges on {max_workers} threads completed. Time Taken: {time_elapsed}s")
+    yield {'Stats': {'Details': total_stats}}
+
@@ -0,0 +1,201 @@
+# This module contains the vectorised spatial filters used by the scripts
+# submitted for the City of Cape Town - Data Science Unit Code Challenge
+# https://github.com/cityofcapetown/ds_code_challenge
+#
+# A SpatialFilter selects the points around a centroid as a NumPy mask
+# instead of a row-wise .apply(). Three modes are supported:
+# - "box":    within +/-tolerance in latitude and in longitude of the centroid
+#             (the 1 minute grid of challenge_5 with the defaults)
+# - "radius": within a great-circle (haversine) distance of the centroid
+# - "k_ring": in the H3 cells within the k-ring covering the tolerance
+# The tolerance is given in arc-minutes or metres. When the H3 index of the
+# points is available (e.g. 'h3_level8_index'), the box and radius modes first
+# keep the points whose cell lies in the k-ring covering the region, and the
+# exact check is only done on those points.
+# filter_centroids() selects the points around many centroids (e.g. all
+# suburbs) with a single sort of the points by latitude.
+
+from support_library import(SPATIAL_FILTER_MODE,
+                            SPATIAL_FILTER_TOLERANCE,
+                            SPATIAL_FILTER_UNIT,
+                            EARTH_RADIUS_M,
+                            H3_NULL_INDEX,
+                            )
+from h3_indexer import calculate_h3_index_int
+
+from loguru import logger
+import math
+
+import numpy as np
+import pandas as pd
+import h3
+
+SPATIAL_FILTER_MODES = ("box", "radius", "k_ring")
+SPATIAL_FILTER_UNITS = ("minutes", "metres")
+
+# length of one degree of latitude on the mean Earth sphere
+METRES_PER_DEGREE = math.pi*EARTH_RADIUS_M/180
+
+
+def haversine_distance_m(latitude, longitude, centroid_latitude, centroid_longitude):
+#   return the great-circle distance in metres from the centroid to each point
+#   - the centroid is a scalar, or arrays with one centroid per point
+#   - null (NaN) coordinates return NaN
+    latitude  = np.radians(np.asarray(latitude, dtype=np.float64))
+    longitude = np.radians(np.asarray(longitude, dtype=np.float64))
+    centroid_latitude  = np.radians(np.asarray(centroid_latitude, dtype=np.float64))
+    centroid_longitude = np.radians(np.asarray(centroid_longitude, dtype=np.float64))
+    a = (np.sin((latitude - centroid_latitude)/2)**2
+         + np.cos(latitude)*np.cos(centroid_latitude)*np.sin((longitude - centroid_longitude)/2)**2)
+    return 2*EARTH_RADIUS_M*np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class SpatialFilter:
+#   Selects the points around a centroid.
+#   - tolerance is in unit ("minutes" or "metres"): the half-width of the box,
+#     or the radius of the circle and of the k-ring
+#   - resolution is the H3 resolution of the h3_index passed to mask()
+#   mask(latitude, longitude, h3_index=None) returns a boolean array, True for
+#   the points within the tolerance; points with a null coordinate are False.
+    def __init__(self, centroid_longitude, centroid_latitude, tolerance=SPATIAL_FILTER_TOLERANCE,
+                 unit=SPATIAL_FILTER_UNIT, mode=SPATIAL_FILTER_MODE, resolution=8):
+        if mode not in SPATIAL_FILTER_MODES:
+            raise ValueError(f"Unknown spatial filter mode: '{mode}'. Expected one of {SPATIAL_FILTER_MODES}")
+        if unit not in SPATIAL_FILTER_UNITS:
+            raise ValueError(f"Unknown spatial filter unit: '{unit}'. Expected one of {SPATIAL_FILTER_UNITS}")
+        self.centroid_longitude = float(centroid_longitude)
+        self.centroid_latitude  = float(centroid_latitude)
+        self.mode = mode
+        self.resolution = resolution
+
+        # the tolerance in degrees of latitude/longitude (box) and in metres (radius, k-ring)
+        cos_latitude = max(math.cos(math.radians(self.centroid_latitude)), 1e-12)
+        if unit == "minutes":
+            self.latitude_tolerance  = tolerance/60
+            self.longitude_tolerance = tolerance/60
+            self.radius_m = tolerance/60*METRES_PER_DEGREE
+        else:
+            self.latitude_tolerance  = tolerance/METRES_PER_DEGREE
+            self.longitude_tolerance = tolerance/(METRES_PER_DEGREE*cos_latitude)
+            self.radius_m = tolerance
+        if mode == "box":
+            # the region reaches its corners, half a diagonal from the centroid
+            self.extent_m = math.hypot(self.latitude_tolerance*METRES_PER_DEGREE,
+                                       self.longitude_tolerance*METRES_PER_DEGREE*cos_latitude)
+        else:
+            self.extent_m = self.radius_m
+        self._cells = None
+
+    def cells(self):
+#       return the uint64 H3 indices of the cells at self.resolution covering the region
+#       - a cell at grid distance k has its centre at least 1.5*k edge lengths
+#         from the centroid cell centre; one extra ring absorbs the distortion
+#         of the H3 grid and points assigned to a neighbouring hex polygon
+        if self._cells is None:
+            edge_m = h3.edge_length(self.resolution, unit="m")
+            k = int(math.ceil((self.extent_m + edge_m)/(1.5*edge_m))) + 1
+            centroid_cell = h3.geo_to_h3(self.centroid_latitude, self.centroid_longitude, self.resolution)
+            self._cells = np.array([int(cell, 16) for cell in h3.k_ring(centroid_cell, k)], dtype=np.uint64)
+            logger.debug(f"Spatial filter k-ring: k={k}, {len(self._cells)} cells at resolution {self.resolution}")
+        return self._cells
+
+    def latitude_extent(self):
+#       return the largest latitude difference in degrees from the centroid to a selected point
+        if self.mode == "box":
+            return self.latitude_tolerance
+        if self.mode == "radius":
+            return self.radius_m/METRES_PER_DEGREE
+        edge_m = h3.edge_length(self.resolution, unit="m")
+        cell_latitude = np.array([h3.h3_to_geo(format(int(cell), "x"))[0] for cell in self.cells()])
+        return float(np.abs(cell_latitude - self.centroid_latitude).max()) + edge_m/METRES_PER_DEGREE
+
+    def bounding_box(self):
+#       return [min_longitude, min_latitude, max_longitude, max_latitude] covering the region
+        latitude_extent = self.latitude_extent()
+        cos_latitude = max(math.cos(math.radians(self.centroid_latitude)), 1e-12)
+        if self.mode == "box":
+            longitude_extent = self.longitude_tolerance
+        elif self.mode == "radius":
+            longitude_extent = math.degrees(math.asin(min(math.sin(self.radius_m/EARTH_RADIUS_M)/cos_latitude, 1.0)))
+        else:
+            edge_m = h3.edge_length(self.resolution, unit="m")
+            cell_longitude = np.array([h3.h3_to_geo(format(int(cell), "x"))[1] for cell in self.cells()])
+            longitude_extent = (float(np.abs(cell_longitude - self.centroid_longitude).max())
+                                + edge_m/(METRES_PER_DEGREE*cos_latitude))
+        return [self.centroid_longitude - longitude_extent, self.centroid_latitude - latitude_extent,
+                self.centroid_longitude + longitude_extent, self.centroid_latitude + latitude_extent]
+
+    def exact_mask(self, latitude, longitude):
+#       return the mask of the box or radius check, without an H3 prefilter
+        latitude  = np.asarray(latitude, dtype=np.float64)
+        longitude = np.asarray(longitude, dtype=np.float64)
+        if self.mode == "radius":
+            return haversine_distance_m(latitude, longitude, self.centroid_latitude, self.centroid_longitude) <= self.radius_m
+        # comparisons with NaN are False, so null coordinates are not selected
+        return ((np.abs(self.centroid_longitude - longitude) <= self.longitude_tolerance)
+                & (np.abs(self.centroid_latitude - latitude) <= self.latitude_tolerance))
+
+    def cell_mask(self, h3_index):
+#       return True for the points whose H3 index (hexadecimal strings or uint64) is in cells()
+        h3_index = np.asarray(h3_index)
+        if h3_index.dtype.kind in "ui":
+            return np.isin(h3_index.astype(np.uint64), self.cells())
+        cell_strings = [format(int(cell), "x") for cell in self.cells()]
+        return pd.Series(h3_index, dtype=object).isin(cell_strings).to_numpy()
+
+    def mask(self, latitude, longitude, h3_index=None):
+#       return a boolean array, True for the points within the tolerance of the centroid
+        latitude  = np.asarray(latitude, dtype=np.float64)
+        longitude = np.asarray(longitude, dtype=np.float64)
+        if self.mode == "k_ring":
+            if h3_index is None:
+                h3_index = calculate_h3_index_int(latitude, longitude, self.resolution)
+            return self.cell_mask(h3_index)
+        if h3_index is None:
+            return self.exact_mask(latitude, longitude)
+
+        # H3 cell prefilter, then the exact check on the candidate points only
+        # - points without an H3 index (outside the hex layer) are always checked
+        is_within = np.zeros(len(latitude), dtype=bool)
+        h3_index = np.asarray(h3_index)
+        if h3_index.dtype.kind in "ui":
+            is_unindexed = h3_index == 0
+        else:
+            is_unindexed = pd.Series(h3_index, dtype=object).isin([H3_NULL_INDEX, "", None]).to_numpy()
+        candidate = np.flatnonzero(self.cell_mask(h3_index) | is_unindexed)
+        is_within[candidate] = self.exact_mask(latitude[candidate], longitude[candidate])
+        logger.debug(f"Spatial filter: {len(candidate)} candidates by H3 cell, {int(is_within.sum())} selected")
+        return is_within
+
+
+def filter_centroids(latitude, longitude, centroids, tolerance=SPATIAL_FILTER_TOLERANCE,
+                     unit=SPATIAL_FILTER_UNIT, mode=SPATIAL_FILTER_MODE, h3_index=None, resolution=8):
+#   return a dict of {name: row indices} of the points around each centroid
+#   - centroids is a dict of {name: (longitude, latitude)}
+#   - the points are sorted by latitude once; each centroid only checks the
+#     points in the latitude band of its region, found with np.searchsorted()
+#   - in k_ring mode the H3 index is computed once (if h3_index is None) and
+#     each centroid checks the points in its band against its cells
+    latitude  = np.asarray(latitude, dtype=np.float64)
+    longitude = np.asarray(longitude, dtype=np.float64)
+    if mode == "k_ring" and h3_index is None:
+        h3_index = calculate_h3_index_int(latitude, longitude, resolution)
+    if h3_index is not None:
+        h3_index = np.asarray(h3_index)
+
+    order = np.argsort(latitude, kind="stable")    # NaN latitudes sort last
+    sorted_latitude = latitude[order]
+    selected = {}
+    for name, (centroid_longitude, centroid_latitude) in centroids.items():
+        spatial_filter = SpatialFilter(centroid_longitude, centroid_latitude, tolerance, unit, mode, resolution)
+        band_degrees = spatial_filter.latitude_extent()
+        start = np.searchsorted(sorted_latitude, centroid_latitude - band_degrees, side="left")
+        stop  = np.searchsorted(sorted_latitude, centroid_latitude + band_degrees, side="right")
+        band = order[start:stop]
+        is_within = spatial_filter.mask(
+            latitude[band],
+            longitude[band],
+            None if h3_index is None else h3_index[band],
+            )
+        selected[name] = np.sort(band[is_within])
+    return selected
@@ -0,0 +1,218 @@
+# This module contains the polygon based spatial joins used by the scripts
+# submitted for the City of Cape Town - Data Science Unit Code Challenge
+# https://github.com/cityofcapetown/ds_code_challenge
+#
+# HexPolygonJoin joins points to the polygons of an H3 hex layer such as
+# CITY_HEX_POLYGONS_8_SOURCE. Each point is assigned by looking up its H3 index
+# in the layer; points whose H3 cell is not in the layer (points on hex edges
+# or outside the city coverage) fall back to a vectorised point-in-polygon
+# test against the layer polygons around the point. Points in no polygon of the
+# layer (outside the city coverage) keep the H3 cell of their location, as
+# calculate_h3_index_int() gives it.
+
+from support_library import H3_INDEX_CHUNK_SIZE
+from h3_indexer import calculate_h3_index_int, h3_int_to_string, h3_string_to_int
+
+from loguru import logger
+import timeit
+import json
+
+import numpy as np
+import h3
+
+
+def points_in_polygon(longitude, latitude, ring):
+#   return a boolean array, True where the point lies inside the polygon ring
+#   - ring is an (N, 2) array of [longitude, latitude] vertices
+#   - uses the even-odd (ray casting) rule, vectorised over the points and
+#     looping over the N edges of the ring
+    longitude = np.asarray(longitude, dtype=np.float64)
+    latitude  = np.asarray(latitude, dtype=np.float64)
+    ring = np.asarray(ring, dtype=np.float64)
+    is_inside = np.zeros(longitude.shape, dtype=bool)
+    x0, y0 = ring[-1]
+    for x1, y1 in ring:
+        crosses = (y1 > latitude) != (y0 > latitude)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            x_cross = (x0 - x1)*(latitude - y1)/(y0 - y1) + x1
+        is_inside ^= crosses & (longitude < x_cross)
+        x0, y0 = x1, y1
+    return is_inside
+
+def read_polygon_layer(file_name):
+#   return the features of a GeoJSON polygon layer
+    with open(file_name) as f_:
+        return json.load(f_)['features']
+
+def feature_polygons(feature):
+#   return the polygons of a Polygon or MultiPolygon feature as a list of
+#   (exterior ring, [hole rings]), the rings as (N, 2) arrays
+    geometry = feature['geometry']
+    if geometry['type'] == 'Polygon':
+        polygons = [geometry['coordinates']]
+    elif geometry['type'] == 'MultiPolygon':
+        polygons = geometry['coordinates']
+    else:
+        return []
+    return [(np.asarray(polygon[0], dtype=np.float64), [np.asarray(hole, dtype=np.float64) for hole in polygon[1:]])
+            for polygon in polygons]
+
+def feature_rings(feature):
+#   return the exterior rings of a Polygon or MultiPolygon feature as (N, 2) arrays
+    return [exterior for exterior, _ in feature_polygons(feature)]
+
+
+class HexPolygonJoin:
+#   Joins points to the polygons of an H3 hex layer, keyed by H3 index.
+#   - assign(latitude, longitude) returns the H3 index of the layer polygon
+#     containing each point; a located point that no polygon contains gets
+#     the H3 cell of its location, and a point without one H3_NULL_INDEX
+#   - unmatched is the number of located points of the last assign() that
+#     matched no polygon of the layer
+    def __init__(self, features, resolution=8):
+        self.resolution = resolution
+        self._rings = {}
+        for feature in features:
+            self._rings[feature['properties']['index']] = feature_rings(feature)
+        self._layer_index = np.sort(h3_string_to_int(list(self._rings.keys())))
+        self.unmatched = 0
+
+    def _fallback(self, latitude, longitude, candidate):
+#       return the layer H3 index (uint64) for points whose H3 cell is not in
+#       the layer, testing the polygons of the layer cells around each cell
+        assigned = np.zeros(len(latitude), dtype=np.uint64)
+        candidate_string = h3_int_to_string(candidate)
+        for cell in np.unique(candidate_string):
+            in_cell = np.flatnonzero(candidate_string == cell)
+            for neighbour in h3.k_ring(cell, 1):
+                if neighbour not in self._rings:
+                    continue
+                unassigned = in_cell[assigned[in_cell] == 0]
+                if len(unassigned) == 0:
+                    break
+                for ring in self._rings[neighbour]:
+                    is_inside = points_in_polygon(longitude[unassigned], latitude[unassigned], ring)
+                    assigned[unassigned[is_inside]] = int(neighbour, 16)
+        return assigned
+
+    def assign_int(self, latitude, longitude, chunk_size=H3_INDEX_CHUNK_SIZE):
+#       return a uint64 array with the layer H3 index for each point (the H3 cell
+#       of the point if unmatched, 0 if it has no location)
+        latitude  = np.asarray(latitude, dtype=np.float64)
+        longitude = np.asarray(longitude, dtype=np.float64)
+        candidate = calculate_h3_index_int(latitude, longitude, self.resolution, chunk_size)
+        is_located = candidate != 0
+
+        # index lookup: the H3 cell of the point is a polygon of the layer
+        is_matched = np.zeros(len(candidate), dtype=bool)
+        if len(self._layer_index):
+            position = np.minimum(np.searchsorted(self._layer_index, candidate), len(self._layer_index) - 1)
+            is_matched = is_located & (self._layer_index[position] == candidate)
+        assigned = np.where(is_matched, candidate, np.uint64(0))
+
+        # point-in-polygon fallback for the located points that did not match
+        fallback = np.flatnonzero(is_located & ~is_matched)
+        if len(fallback):
+            assigned[fallback] = self._fallback(latitude[fallback], longitude[fallback], candidate[fallback])
+        is_unmatched = is_located & (assigned == 0)
+        assigned[is_unmatched] = candidate[is_unmatched]
+        self.unmatched = int(is_unmatched.sum())
+        logger.debug(f"Hex polygon join: {int(is_matched.sum())} matched by index, "
+                     f"{len(fallback) - self.unmatched} by point-in-polygon, {self.unmatched} unmatched")
+        return assigned
+
+    def assign(self, latitude, longitude, chunk_size=H3_INDEX_CHUNK_SIZE):
+#       return an object array with the layer H3 index string for each point
+        return h3_int_to_string(self.assign_int(latitude, longitude, chunk_size))
+
+
+def join_hex_polygons(latitude, longitude, file_name, resolution=8):
+#   return the H3 index of the polygon in the hex layer file_name containing
+#   each latitude/longitude point (as HexPolygonJoin.assign()), and logs the
+#   number of located points that matched no hex of the layer
+    process_start_time = timeit.default_timer()
+    hex_join = HexPolygonJoin(read_polygon_layer(file_name), resolution)
+    h3_index = hex_join.assign(latitude, longitude)
+    time_elapsed = timeit.default_timer() - process_start_time
+    logger.info(f"Joined points to '{file_name}'. Unmatched: {hex_join.unmatched}. Time Taken: {time_elapsed}s")
+    return h3_index
+
+
+class PolygonLayerIndex:
+#   Labels points with the polygon of a layer (e.g. official suburbs, wards)
+#   that contains them.
+#   - the polygons' bounding boxes are indexed on a regular grid of 
+#     cell_size degrees, so each point is only tested against the polygons
+#     whose bounding boxes overlap its grid cell
+#   - the points of each occupied grid cell are tested together with the 
+#     vectorised points_in_polygon()
+#   - a point inside a hole of a polygon is not in that polygon; it may be in
+#     another polygon of the layer filling the hole (an enclave)
+#   assign(latitude, longitude) returns the label_property of the containing
+#   polygon for each point, or None if no polygon contains it.
+    def __init__(self, features, label_property, cell_size=0.01):
+        self.cell_size = cell_size
+        self._labels = []
+        self._rings = []
+        self._holes = []
+        for feature in features:
+            for ring, holes in feature_polygons(feature):
+                self._labels.append(feature['properties'][label_property])
+                self._rings.append(ring)
+                self._holes.append(holes)
+        self._labels = np.array(self._labels, dtype=object)
+
+        # grid cell -> polygon rings whose bounding box overlaps the cell
+        self._grid = {}
+        for ring_id, ring in enumerate(self._rings):
+            min_x, min_y = np.floor(ring.min(axis=0)/cell_size).astype(np.int64)
+            max_x, max_y = np.floor(ring.max(axis=0)/cell_size).astype(np.int64)
+            for cell_x in range(min_x, max_x + 1):
+                for cell_y in range(min_y, max_y + 1):
+                    self._grid.setdefault((cell_x, cell_y), []).append(ring_id)
+        self.unmatched = 0
+
+    def assign_id(self, latitude, longitude):
+#       return an int array with the ring id containing each point (-1 if none)
+        latitude  = np.asarray(latitude, dtype=np.float64)
+        longitude = np.asarray(longitude, dtype=np.float64)
+        ring_id = np.full(len(latitude), -1, dtype=np.int64)
+        is_located = ~(np.isnan(latitude) | np.isnan(longitude))
+        located = np.flatnonzero(is_located)
+        if len(located) == 0:
+            self.unmatched = 0
+            return ring_id
+
+        cell_x = np.floor(longitude[located]/self.cell_size).astype(np.int64)
+        cell_y = np.floor(latitude[located]/self.cell_size).astype(np.int64)
+        cells, cell_of_point = np.unique(np.stack([cell_x, cell_y], axis=1), axis=0, return_inverse=True)
+        cell_of_point = cell_of_point.reshape(-1)
+        order = np.argsort(cell_of_point, kind="stable")
+        bounds = np.searchsorted(cell_of_point[order], np.arange(len(cells) + 1))
+
+        for cell_number, (x, y) in enumerate(cells):
+            candidates = self._grid.get((int(x), int(y)))
+            if not candidates:
+                continue
+            points = located[order[bounds[cell_number]:bounds[cell_number + 1]]]
+            for candidate in candidates:
+                unassigned = points[ring_id[points] == -1]
+                if len(unassigned) == 0:
+                    break
+                inside = unassigned[points_in_polygon(longitude[unassigned], latitude[unassigned], self._rings[candidate])]
+                for hole in self._holes[candidate]:
+                    inside = inside[~points_in_polygon(longitude[inside], latitude[inside], hole)]
+                ring_id[inside] = candidate
+        self.unmatched = int((ring_id[located] == -1).sum())
+        return ring_id
+
+    def assign(self, latitude, longitude):
+#       return an object array with the label of the polygon containing each point
+        ring_id = self.assign_id(latitude, longitude)
+        labels = np.full(len(ring_id), None, dtype=object)
+        labels[ring_id >= 0] = self._labels[ring_id[ring_id >= 0]]
+        return labels
+
+    def label_features(self, label):
+#       return the exterior rings of the polygons with the given label
+        return [ring for ring, ring_label in zip(self._rings, self._labels) if ring_label == label]
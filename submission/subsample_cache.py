@@ -0,0 +1,124 @@
+# This module contains the per partition cache of the subsample used by challenge_5.py
+# for the City of Cape Town - Data Science Unit Code Challenge
+# https://github.com/cityofcapetown/ds_code_challenge
+#
+# The subsample of CHALLENGE_2_PARTITIONED_OUTPUT is taken from the partitions
+# that intersect the subsample area, and the subsample of each partition is
+# cached in CHALLENGE_5_SUBSAMPLE_CACHE. A partition is identified by the name,
+# size and modification time of its files: partition files are never modified
+# (an append or rewrite adds files with new names), so a partition with the
+# same files as its cached entry has the same rows. After an incremental run of
+# challenge_2 only the partitions it changed are read and filtered again.
+
+from support_library import(CHALLENGE_5_SUBSAMPLE_CACHE,
+                            SERVICE_REQUEST_HEX_COLUMN_NAME,
+                            delete_directory,
+                            delete_file,
+                            )
+from columnar_io import(read_partition_manifest,
+                        read_partitioned_service_requests,
+                        read_service_requests_parquet,
+                        write_service_requests_parquet,
+                        bounding_box_intersects,
+                        )
+
+from loguru import logger
+import os
+import json
+import timeit
+import pandas as pd
+
+SUBSAMPLE_CACHE_INDEX = "index.json"
+
+
+def partition_signature(directory, partition):
+#   return [[file, size, modification time], ...] of the files of a partition
+    signature = []
+    for entry in sorted(partition["files"], key=lambda entry: entry["file"]):
+        stat = os.stat(os.path.join(directory, entry["file"]))
+        signature.append([entry["file"], stat.st_size, stat.st_mtime_ns])
+    return signature
+
+def spatial_filter_signature(spatial_filter):
+#   return the parameters of spatial_filter that decide which requests it selects
+    return [spatial_filter.mode, spatial_filter.resolution, spatial_filter.centroid_longitude,
+            spatial_filter.centroid_latitude, spatial_filter.latitude_tolerance,
+            spatial_filter.longitude_tolerance, spatial_filter.radius_m]
+
+
+class PartitionSubsampleCache:
+#   Cache of the subsample of each partition of a partitioned output.
+#   - subsample(directory, spatial_filter) returns the requests of directory
+#     selected by spatial_filter, read from the cache for unchanged partitions
+#   - the cache is cleared when the spatial filter or the output directory changes
+    def __init__(self, cache_dir=CHALLENGE_5_SUBSAMPLE_CACHE):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+
+    def _read_index(self):
+        index_file = os.path.join(self.cache_dir, SUBSAMPLE_CACHE_INDEX)
+        if os.path.exists(index_file):
+            try:
+                with open(index_file) as f_:
+                    return json.load(f_)
+            except ValueError:
+                logger.exception(f"Cannot read: '{index_file}'. Subsample cache cleared.")
+        return None
+
+    def _write_index(self, index):
+        index_file = os.path.join(self.cache_dir, SUBSAMPLE_CACHE_INDEX)
+        with open(index_file + ".tmp", "w") as f_:
+            json.dump(index, f_, indent=1)
+        os.replace(index_file + ".tmp", index_file)
+
+    def subsample(self, directory, spatial_filter):
+#       return the requests of the partitioned output directory selected by spatial_filter
+        process_start_time = timeit.default_timer()
+        manifest = read_partition_manifest(directory)
+        bbox = spatial_filter.bounding_box()
+        signature = {"directory": os.path.abspath(directory), "filter": spatial_filter_signature(spatial_filter)}
+        index = self._read_index()
+        if index is None or index["signature"] != signature:
+            delete_directory(self.cache_dir)
+            index = {"signature": signature, "partitions": {}}
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        subsamples = []
+        partitions = {}
+        for key, partition in manifest["partitions"].items():
+            if not bounding_box_intersects(partition["bbox"], bbox):
+                continue
+            files = partition_signature(directory, partition)
+            cached = index["partitions"].get(key)
+            cache_file = os.path.join(self.cache_dir, f"{key}.parquet")
+            if cached is not None and cached["files"] == files and os.path.exists(cache_file):
+                self.hits += 1
+                subsample = read_service_requests_parquet(cache_file)
+            else:
+                self.misses += 1
+                service_requests = pd.concat([read_service_requests_parquet(os.path.join(directory, entry["file"]))
+                                              for entry in partition["files"]], ignore_index=True)
+                is_selected = spatial_filter.mask(
+                  service_requests["latitude"].to_numpy(),
+                  service_requests["longitude"].to_numpy(),
+                  service_requests[SERVICE_REQUEST_HEX_COLUMN_NAME].to_numpy()
+                  if SERVICE_REQUEST_HEX_COLUMN_NAME in service_requests else None,
+                  )
+                subsample = service_requests[is_selected].reset_index(drop=True)
+                write_service_requests_parquet(subsample, cache_file)
+            partitions[key] = {"files": files, "rows": len(subsample)}
+            subsamples.append(subsample)
+
+        # partitions no longer in the output, or no longer intersecting, are forgotten
+        for key in set(index["partitions"]) - set(partitions):
+            delete_file(os.path.join(self.cache_dir, f"{key}.parquet"))
+        index["partitions"] = partitions
+        self._write_index(index)
+
+        time_elapsed = timeit.default_timer() - process_start_time
+        logger.info(f"Subsample of '{directory}': {len(partitions)} partitions, cached: {self.hits}, "
+                    f"read: {self.misses}. Time Taken: {time_elapsed}s")
+        if not subsamples:
+            return read_partitioned_service_requests(directory, bbox)
+        return pd.concat(subsamples, ignore_index=True)
@@ -4,38 +4,163 @@
 
 from loguru import logger
 import os
+import sys
+import json
+import re
+import codecs
+import shutil
+import hashlib
+import threading
+import timeit
+import time
+import platform
+import subprocess
+import functools
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
 from requests.exceptions import HTTPError
 import boto3
+import botocore.config
 import botocore.exceptions
+try:
+    # resource is not available on Windows; peak RSS is then not reported
+    import resource
+except ImportError:
+    resource = None
+try:
+    # fcntl is not available on Windows; cached files are then always copied
+    # and downloads are not locked against other processes
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # common constants
 CREDENTIALS_URL = "https://cct-ds-code-challenge-input-data.s3.af-south-1.amazonaws.com/ds_code_challenge_creds.json"
 REGION          = "af-south-1"
 BUCKET_NAME     = "cct-ds-code-challenge-input-data"
 
+CREDENTIALS_TTL_SECONDS   = 3600
+S3_MAX_POOL_CONNECTIONS   = 16
+
+S3_CACHE_ENABLED    = True
+S3_CACHE_DIR        = ".s3_cache"
+S3_CACHE_MAX_BYTES  = 2*1024**3
+
+S3_MULTIPART_THRESHOLD    = 16*1024**2
+S3_MULTIPART_PART_SIZE    = 8*1024**2
+S3_MULTIPART_MAX_WORKERS  = 8
+
+PREFETCH_MAX_WORKERS      = 4
+
 CITY_HEX_POLYGONS_8_10_SOURCE = "city-hex-polygons-8-10.geojson"
 CITY_HEX_POLYGONS_8_SOURCE    = "city-hex-polygons-8.geojson"
 CHALLENGE_1_OUTPUT            = "city-hex-polygons-8_KN.json"
-CHALLENGE_1_TMP_OUTPUT        = "tmp.json"
+CITY_HEX_POLYGONS_8_10_LINES  = "city-hex-polygons-8-10.jsonl"
+CHALLENGE_1_RESOLUTIONS       = [8]
+CHALLENGE_1_SCAN_RANGE_SELECT = False
+SCAN_RANGE_NUM_RANGES         = 16
+SCAN_RANGE_MAX_WORKERS        = 8
+SCAN_RANGE_STAGING_BUCKET     = None      # writable bucket for the JSON Lines copy; BUCKET_NAME is read only
+CHALLENGE_1_RESOLUTION_OUTPUT = "city-hex-polygons-{resolution}_KN.json"
 CHALLENGE_1_LOG               = "challenge_1.log"
+CHALLENGE_1_RUN_REPORT        = "challenge_1.run.json"
+HEX_GEOMETRY_TOLERANCE        = 1e-9
+GEOJSON_BLOCK_SIZE            = 1024**2   # bytes read at a time by iter_geojson_features()
 
 SERVICE_REQUEST_SOURCE                = "sr.csv.gz"
 SERVICE_REQUEST_HEX_SOURCE            = "sr_hex.csv.gz"
 SERVICE_REQUEST_HEX_TRUNCATED_SOURCE  = "sr_hex_truncated.csv"
 SERVICE_REQUEST_HEX_COLUMN_NAME       = "h3_level8_index"
 CHALLENGE_2_OUTPUT                    = "sr_hex_joined_KN.csv"
+CHALLENGE_2_PARQUET_OUTPUT            = "sr_hex_joined_KN.parquet"
+CHALLENGE_2_WRITE_PARQUET             = True
+SERVICE_REQUEST_TIMESTAMP_COLUMNS     = ["creation_timestamp", "completion_timestamp"]
+SERVICE_REQUEST_CATEGORICAL_COLUMNS   = ["directorate", "department", "branch", "section",
+                                         "code_group", "code", "cause_code_group", "cause_code",
+                                         "official_suburb"]
+CHALLENGE_2_PARTITIONED_OUTPUT        = "sr_hex_joined_KN_partitioned"
+CHALLENGE_2_WRITE_PARTITIONS          = False
+PARTITION_RESOLUTION                  = 6
+PARTITION_MANIFEST                    = "manifest.json"
+CHALLENGE_2_VERIFY_PARTITIONS         = True
+CHALLENGE_2_INCREMENTAL               = False   # append new and changed requests to CHALLENGE_2_PARTITIONED_OUTPUT
+INCREMENTAL_TIMESTAMP_COLUMN          = "creation_timestamp"
+INCREMENTAL_KEY_COLUMN                = "notification_number"
+INCREMENTAL_LOOKBACK_DAYS             = 7       # requests created this long before the high-water mark are checked for changes
+INCREMENTAL_FULL_PASS_DAYS            = 30      # every request is checked for changes once in this many days
 CHALLENGE_2_LOG                       = "challenge_2.log"
+CHALLENGE_2_RUN_REPORT                = "challenge_2.run.json"
+CHALLENGE_2_POLYGON_JOIN              = False
 ERROR_THRESHOLD                       = 0.4
+FRAME_DIFF_FLOAT_TOLERANCE            = 1e-9
+FRAME_DIFF_KEY_COLUMN                 = "notification_number"
+FRAME_DIFF_SAMPLE_SIZE                = 10
+FRAME_DIGEST_BLOCK_ROWS               = 100_000
+FRAME_DIGEST_FLOAT_DECIMALS           = 9
+H3_INDEX_CHUNK_SIZE                   = 1_000_000
+H3_NULL_INDEX                         = "0"
+H3_INDEX_NUM_WORKERS                  = os.cpu_count() or 1
+H3_PARALLEL_MIN_ROWS                  = 200_000
+STREAMING_CHUNK_SIZE                  = 250_000
+STREAMING_MIN_CHUNK_SIZE              = 10_000    # the chunk size is halved down to this while a chunk exceeds the memory target
+STREAMING_MEMORY_TARGET_MB            = 1024
+MEMORY_SAMPLE_INTERVAL_S              = 0.05      # RSS sampling interval of MemoryMonitor
 
 CHALLENGE_5_ARCGIS_URL        = "https://citymaps.capetown.gov.za/agsext1/rest/services/Theme_Based/Open_Data_Service/MapServer/75/query?where=&text=BELLVILLE+SOUTH&&featureEncoding=esriDefault&f=geojson"
 REQUIRED_SUBURB               = "BELLVILLE SOUTH"
+OFFICIAL_SUBURBS_URL          = "https://citymaps.capetown.gov.za/agsext1/rest/services/Theme_Based/Open_Data_Service/MapServer/75/query"
+OFFICIAL_SUBURBS_OUTPUT       = "official-planning-suburbs.geojson"
+SUBURB_NAME_PROPERTY          = "OFC_SBRB_NAME"
+SUBURB_COLUMN_NAME            = "suburb_polygon"
+CHALLENGE_5_LABEL_SUBURBS     = False
+SPATIAL_FILTER_MODE           = "box"       # "box", "radius" or "k_ring" (see spatial_filter.py)
+SPATIAL_FILTER_TOLERANCE      = 1
+SPATIAL_FILTER_UNIT           = "minutes"   # "minutes" or "metres"
+EARTH_RADIUS_M                = 6371008.8
+ARCGIS_PAGE_SIZE              = 1000
 WIND_DATA_SOURCE              = "https://www.capetown.gov.za/_layouts/OpenDataPortalHandler/DownloadHandler.ashx?DocumentName=Wind_direction_and_speed_2020.ods&DatasetDocument=https%3A%2F%2Fcityapps.capetown.gov.za%2Fsites%2Fopendatacatalog%2FDocuments%2FWind%2FWind_direction_and_speed_2020.ods"
 WIND_DATA_OUTPUT              = "Wind_direction_and_speed_2020.ods"
+WIND_DATA_COLUMNS             = {3: "wind_direction_deg", 4: "wind_speed_m_s"}   # Bellville South AQM site
+WIND_DATA_TIMESTAMP_FORMAT    = "%d/%m/%Y %H:%M"
+WIND_DATA_UTC_OFFSET          = "+02:00"
+WIND_DATA_MISSING_VALUES      = ["<Samp", "NoData", "Calm"]
+WIND_DATA_CACHE_DIR           = ".wind_cache"
+WIND_DATA_STORE_DIR           = "wind_data_store"
+WIND_DATA_STATIONS            = {"Bellville South": WIND_DATA_COLUMNS}
+CHALLENGE_5_WIND_STATION      = "Bellville South"
 CHALLENGE_5_TMP_WIND_DATA     = "bellville-south-wind_data.csv"
 CHALLENGE_5_TMP_OUTPUT        = "sr_hex_subsample_joined_KN.csv"
 CHALLENGE_5_OUTPUT            = "sr_hex_subsample_anonymised_KN.csv"
+CHALLENGE_5_SUBSAMPLE_CACHE   = ".subsample_cache"  # subsample of each partition of CHALLENGE_2_PARTITIONED_OUTPUT
+ANONYMISE_TIME_OFFSET_HOURS   = 6       # temporal accuracy of the anonymised timestamps
+ANONYMISE_SEED                = None    # set to an int for a reproducible anonymisation
+ANONYMISE_DISTANCE_M          = 500     # location accuracy of the anonymised coordinates
+ANONYMISE_SPATIAL_MODE        = "geodesic"   # "geodesic", "planar" or "h3" (see anonymise.py)
+ANONYMISE_H3_RESOLUTION       = 8
+ANONYMISE_CHUNK_SIZE          = 250_000
 CHALLENGE_5_LOG               = "challenge_5.log"
+CHALLENGE_5_RUN_REPORT        = "challenge_5.run.json"
+
+PIPELINE_STATE_FILE           = ".pipeline_state.json"   # fingerprints of the last successful run of each stage
+PIPELINE_MAX_WORKERS          = 2       # challenge_1 and challenge_2 run concurrently
+PIPELINE_HTTP_TIMEOUT         = 30      # seconds, for the HEAD requests of the remote inputs
+PIPELINE_LOG                  = "pipeline.log"
+PIPELINE_RUN_REPORT           = "pipeline.run.json"
+
+RUN_REPORT_HISTORY            = "run_reports.jsonl"   # one line per run report, for comparisons across runs
+
+BENCHMARK_DATA_DIR            = "benchmark_data"
+BENCHMARK_RESULTS_DIR         = "benchmark_results"
+BENCHMARK_ROWS                = [100_000, 1_000_000, 10_000_000]
+BENCHMARK_CENTROID            = (18.6408, -33.9165)   # (longitude, latitude), approximately BELLVILLE SOUTH
+SYNTHETIC_SEED                = 0
+SYNTHETIC_NULL_FRACTION       = 0.2     # fraction of service requests without coordinates
+SYNTHETIC_START               = "2020-01-01"
+SYNTHETIC_END                 = "2021-01-01"
+SYNTHETIC_BBOX                = [18.30, -34.36, 18.95, -33.47]   # [min_longitude, min_latitude, max_longitude, max_latitude]
+SYNTHETIC_WIND_STATIONS       = ["Atlantis", "Bellville South", "Goodwood", "Khayelitsha"]
  
 
 def get_aws_credentials(url):
@@ -67,8 +192,9 @@ def get_aws_credentials(url):
         else:
             try:
                 # extract kets from json stucture
-                access_key = response.json()["s3"]["access_key"]
-                secret_key = response.json()["s3"]["secret_key"]
+                credentials = response.json()["s3"]
+                access_key = credentials["access_key"]
+                secret_key = credentials["secret_key"]
                 logger.info(f"Keys Extracted from url: '{url}'")
             except:
                 logger.exception("Error occurred")
@@ -77,31 +203,438 @@ def get_aws_credentials(url):
           
     return access_key, secret_key
   
-def set_s3_client():
+# process-wide credentials and s3_client shared by every caller of set_s3_client()
+_s3_client_lock   = threading.Lock()
+_credentials_cache = {"keys": None, "expires": 0.0}
+_s3_client_cache   = {"client": None, "keys": None}
+s3_client_stats    = {"credential_fetches": 0, "credential_hits": 0, 
+                      "clients_created": 0, "client_reuses": 0}
+
+def get_cached_aws_credentials(url=CREDENTIALS_URL, ttl=CREDENTIALS_TTL_SECONDS):
+#   return access_key, secret_key from get_aws_credentials(url), fetched at most
+#   once every ttl seconds. Failed fetches (None, None) are not cached.
+    with _s3_client_lock:
+        now = timeit.default_timer()
+        if _credentials_cache["keys"] is not None and now < _credentials_cache["expires"]:
+            s3_client_stats["credential_hits"] += 1
+            return _credentials_cache["keys"]
+
+        access_key, secret_key = get_aws_credentials(url)
+        s3_client_stats["credential_fetches"] += 1
+        if access_key is not None and secret_key is not None:
+            _credentials_cache["keys"] = (access_key, secret_key)
+            _credentials_cache["expires"] = now + ttl
+        return access_key, secret_key
+
+def set_s3_client(max_pool_connections=S3_MAX_POOL_CONNECTIONS):
 #   return s3_client with region and credentials set 
+#   - one s3_client is shared by the whole process, so the credentials request
+#     and the TLS handshakes are paid once rather than once per script
+#   - a new s3_client is only created when the cached credentials change
+#   - max_pool_connections sizes the connection pool shared by the threads 
+#     of the multipart downloads and the prefetcher
 
     #  retrieve aws credentials from CREDENTIALS_URL
-    access_key, secret_key = get_aws_credentials(CREDENTIALS_URL)
+    access_key, secret_key = get_cached_aws_credentials(CREDENTIALS_URL)
     
-    #  create s3_client for REGION with credentials
-    s3_client = boto3.client(
-      "s3",
-      region_name=REGION,
-      aws_access_key_id=access_key,
-      aws_secret_access_key=secret_key)
+    with _s3_client_lock:
+        if _s3_client_cache["client"] is not None and _s3_client_cache["keys"] == (access_key, secret_key):
+            s3_client_stats["client_reuses"] += 1
+            logger.debug(f"S3 client reused. Client stats: {s3_client_stats}")
+            return _s3_client_cache["client"]
+
+        #  create s3_client for REGION with credentials
+        s3_client = boto3.client(
+          "s3",
+          region_name=REGION,
+          aws_access_key_id=access_key,
+          aws_secret_access_key=secret_key,
+          config=botocore.config.Config(max_pool_connections=max_pool_connections))
+
+        _s3_client_cache["client"] = s3_client
+        _s3_client_cache["keys"] = (access_key, secret_key)
+        s3_client_stats["clients_created"] += 1
+        logger.debug(f"S3 client created. Client stats: {s3_client_stats}")
 
     return s3_client
+
+def get_s3_connection_stats(s3_client=None):
+#   return a dict with the number of connections opened and requests sent by
+#   the connection pools of s3_client (default: the shared s3_client)
+#   'reused' is the number of requests that did not need a new connection.
+#   Best effort, for logging only: the counts are read from private attributes
+#   of botocore and urllib3, which may change between versions. None is 
+#   returned if they cannot be read; nothing else depends on the counts.
+    s3_client = s3_client or _s3_client_cache["client"]
+    stats = {"connections": 0, "requests": 0, "reused": 0}
+    try:
+        endpoint = getattr(s3_client, "_endpoint", None)
+        manager = getattr(getattr(endpoint, "http_session", None), "_manager", None)
+        container = getattr(getattr(manager, "pools", None), "_container", None)
+        if container is None:
+            return None
+        for pool in list(container.values()):
+            stats["connections"] += getattr(pool, "num_connections", 0)
+            stats["requests"] += getattr(pool, "num_requests", 0)
+    except Exception:
+        return None
+    stats["reused"] = max(stats["requests"] - stats["connections"], 0)
+    return stats
+
+def log_s3_client_stats():
+#   logs the credential, client and connection reuse statistics
+    connection_stats = get_s3_connection_stats()
+    logger.info(f"S3 client stats: {s3_client_stats}. "
+                f"Connection stats: {'unavailable' if connection_stats is None else connection_stats}")
     
-def download_file_from_s3_client(s3_client, BUCKET_NAME, FILE_NAME):
+def file_digest(file_name, algorithm="sha256"):
+#   return the hexadecimal digest of the content of file_name
+    digest = hashlib.new(algorithm)
+    with open(file_name, "rb") as f_:
+        for block in iter(lambda: f_.read(1024*1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def etag_is_md5(head):
+#   return True if the ETag of a head_object() response is the MD5 of the object:
+#   - multipart ETags depend on the upload part size
+#   - objects encrypted with SSE-KMS or SSE-C have an ETag that is not their MD5
+    return ("-" not in head["ETag"]
+            and not head.get("ServerSideEncryption", "").startswith("aws:kms")
+            and "SSECustomerAlgorithm" not in head)
+
+def _verify_download(file_name, etag, size, is_md5):
+#   return True if file_name has the expected size and, if the ETag is the MD5
+#   of the content (etag_is_md5()), the expected MD5
+    if os.path.getsize(file_name) != size:
+        logger.error(f"Downloaded size {os.path.getsize(file_name)} does not match {size}: '{file_name}'")
+        return False
+    if not is_md5:
+        logger.debug(f"ETag is not an MD5 (multipart or encrypted), verified size only: '{file_name}'")
+        return True
+    md5 = file_digest(file_name, "md5")
+    if md5 != etag:
+        logger.error(f"Downloaded MD5 {md5} does not match ETag {etag}: '{file_name}'")
+        return False
+    return True
+
+def download_file_multipart(s3_client, bucket_name, key, file_name,
+                            part_size=S3_MULTIPART_PART_SIZE,
+                            max_workers=S3_MULTIPART_MAX_WORKERS,
+                            threshold=S3_MULTIPART_THRESHOLD):
+#   downloads bucket_name/key to file_name as concurrent ranged GET requests
+#   - objects smaller than threshold are downloaded with a single request
+#   - parts of part_size bytes are fetched on a pool of max_workers threads 
+#     and written in place into file_name + ".partial"
+#   - completed parts are recorded in file_name + ".partial.json", so an
+#     interrupted download resumes with the missing parts, provided the 
+#     object's ETag and size are unchanged
+#   - the size, and the MD5 where the ETag allows it, are verified before
+#     the partial file is renamed to file_name
+#   Exceptions are raised to the caller. Returns True if the download verified.
+    head = s3_client.head_object(Bucket=bucket_name, Key=key)
+    size = head["ContentLength"]
+    etag = head["ETag"].strip('"')
+    if size < threshold:
+        s3_client.download_file(bucket_name, key, file_name)
+        return True
+
+    partial_file = file_name + ".partial"
+    state_file = partial_file + ".json"
+    state = {"etag": etag, "size": size, "part_size": part_size, "completed": []}
+    try:
+        with open(state_file) as f_:
+            saved_state = json.load(f_)
+        if (all(saved_state.get(k) == state[k] for k in ("etag", "size", "part_size")) 
+            and os.path.getsize(partial_file) == size):
+            state = saved_state
+            logger.info(f"Resuming download of '{key}': {len(state['completed'])} parts completed")
+    except (OSError, ValueError):
+        pass
+    if not state["completed"]:
+        with open(partial_file, "wb") as f_:
+            f_.truncate(size)
+
+    completed = set(state["completed"])
+    parts = [
+        (part_number, start, min(start + part_size, size) - 1)
+        for part_number, start in enumerate(range(0, size, part_size))
+        if part_number not in completed
+        ]
+    state_lock = threading.Lock()
+
+    def fetch_part(part_number, start, end):
+        # IfMatch fails the request if the object changes during the download
+        response = s3_client.get_object(Bucket=bucket_name, Key=key, 
+                                        Range=f"bytes={start}-{end}", IfMatch=head["ETag"])
+        data = response["Body"].read()
+        if len(data) != end - start + 1:
+            raise IOError(f"Part {part_number} of '{key}' is {len(data)} bytes, expected {end - start + 1}")
+        with open(partial_file, "r+b") as f_:
+            f_.seek(start)
+            f_.write(data)
+        return part_number
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(fetch_part, *part) for part in parts]
+        for future in as_completed(futures):
+            part_number = future.result()
+            with state_lock:
+                state["completed"].append(part_number)
+                with open(state_file, "w") as f_:
+                    json.dump(state, f_)
+    logger.debug(f"Downloaded {len(parts)} parts of '{key}' with {max_workers} threads")
+
+    if not _verify_download(partial_file, etag, size, etag_is_md5(head)):
+        delete_file(partial_file)
+        delete_file(state_file)
+        return False
+    os.replace(partial_file, file_name)
+    delete_file(state_file)
+    return True
+
+class Prefetcher:
+#   Starts independent downloads on a thread pool as soon as a run begins,
+#   so that network time overlaps with the CPU work of the main thread.
+#   - submit(name, function, *args) starts function(*args) in the background
+#   - result(name) waits for the download and returns the function's result
+#   - report() logs the download time that overlapped with other work, i.e.
+#     the wall-clock time saved against fetching each input in sequence
+#   - used as a context manager, the pool is shut down when the with block
+#     exits; on an exception the downloads not yet started are cancelled
+    def __init__(self, max_workers=PREFETCH_MAX_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        self._futures = {}
+        self._durations = {}
+        self._waits = {}
+
+    def _timed(self, name, function, args, kwargs):
+        process_start_time = timeit.default_timer()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self._durations[name] = timeit.default_timer() - process_start_time
+
+    def submit(self, name, function, *args, **kwargs):
+        logger.debug(f"Prefetch started: '{name}'")
+        self._futures[name] = self._executor.submit(self._timed, name, function, args, kwargs)
+
+    def result(self, name):
+        process_start_time = timeit.default_timer()
+        result = self._futures[name].result()
+        self._waits[name] = timeit.default_timer() - process_start_time
+        logger.debug(f"Prefetch '{name}' waited for: {self._waits[name]}s")
+        return result
+
+    def report(self):
+#       logs and returns the wall-clock time saved by prefetching in seconds
+        total_duration = sum(self._durations.values())
+        total_wait = sum(self._waits.values())
+        time_saved = total_duration - total_wait
+        logger.info(f"Prefetched {len(self._durations)} inputs in {total_duration}s, waited {total_wait}s. Time Saved: {time_saved}s")
+        return time_saved
+
+    def shutdown(self, cancel=False):
+#       waits for the running downloads; cancel==True drops the ones not started
+        self._executor.shutdown(wait=True, cancel_futures=cancel)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown(cancel=exc_type is not None)
+        return False
+
+# hit and miss counts of the local S3 cache for this process
+s3_cache_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+@contextmanager
+def file_lock(lock_file, blocking=True):
+#   holds an exclusive lock on lock_file for the with block, so the processes
+#   (and threads) writing the same files take turns, e.g. challenge_1 and
+#   challenge_2 run concurrently by pipeline.py
+#   - yields True if the lock is held; blocking==False yields False at once
+#     if another holder has it
+#   - lock_file is deleted on release; a waiter that then holds the lock of
+#     the deleted file opens lock_file again, so two holders never overlap
+#   - without fcntl nothing is locked, and True is yielded
+    if fcntl is None:
+        yield True
+        return
+    while True:
+        f_ = open(lock_file, "a")
+        try:
+            fcntl.flock(f_.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f_.close()
+            yield False
+            return
+        try:
+            if os.path.samestat(os.fstat(f_.fileno()), os.stat(lock_file)):
+                break
+        except FileNotFoundError:
+            pass
+        f_.close()
+    try:
+        yield True
+    finally:
+        delete_file(lock_file)
+        f_.close()
+
+def s3_cache_lock_path(bucket_name, key, cache_dir=S3_CACHE_DIR):
+#   return the lock file of bucket_name/key in the cache, whatever its ETag
+    digest = hashlib.sha256(f"{bucket_name}/{key}".encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, f"{digest}.lock")
+
+def s3_cache_path(bucket_name, key, etag, cache_dir=S3_CACHE_DIR):
+#   return the path of the cached copy of bucket_name/key with the given ETag
+#   the cache is content addressed: a new ETag is stored under a new path
+    digest = hashlib.sha256(f"{bucket_name}/{key}/{etag}".encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, digest)
+
+def _read_s3_cache_entries(cache_dir):
+#   return a list of (path, metadata) for the objects in cache_dir
+    entries = []
+    if not os.path.isdir(cache_dir):
+        return entries
+    for file_name in os.listdir(cache_dir):
+        if not file_name.endswith(".json"):
+            continue
+        path = os.path.join(cache_dir, file_name[:-len(".json")])
+        try:
+            with open(path + ".json") as f_:
+                metadata = json.load(f_)
+        except (OSError, ValueError):
+            continue
+        if os.path.exists(path):
+            entries.append((path, metadata))
+    return entries
+
+def _remove_s3_cache_entry(path):
+    for file_name in (path, path + ".json"):
+        try:
+            os.remove(file_name)
+        except FileNotFoundError:
+            pass
+
+def evict_s3_cache(max_bytes=S3_CACHE_MAX_BYTES, cache_dir=S3_CACHE_DIR, keep=None):
+#   deletes the least recently used cached objects until the cache is no 
+#   larger than max_bytes. Returns the number of objects evicted.
+#   - the modification time of a cached object is updated on each hit
+#   - the cached object at path keep is never evicted, nor an object another
+#     process or thread is downloading or copying (its key is locked)
+    entries = _read_s3_cache_entries(cache_dir)
+    entries.sort(key=lambda entry: os.path.getmtime(entry[0]))
+    total_bytes = sum(os.path.getsize(path) for path, _ in entries)
+    num_evicted = 0
+    for path, metadata in entries:
+        if total_bytes <= max_bytes:
+            break
+        if path == keep:
+            continue
+        with file_lock(s3_cache_lock_path(metadata["bucket"], metadata["key"], cache_dir), blocking=False) as is_locked:
+            if not is_locked or not os.path.exists(path):
+                continue
+            total_bytes -= os.path.getsize(path)
+            _remove_s3_cache_entry(path)
+        num_evicted = num_evicted + 1
+        logger.debug(f"S3 cache evicted: '{metadata['key']}' ({metadata['etag']})")
+    s3_cache_stats["evictions"] += num_evicted
+    return num_evicted
+
+# the FICLONE ioctl of Linux: shares the blocks of a file copy-on-write
+_FICLONE = 0x40049409
+
+def _clone_file(source, destination):
+#   copies source to destination as a reflink (copy-on-write clone) where the
+#   file system supports it (btrfs, xfs), otherwise as a byte copy
+    if fcntl is not None and sys.platform.startswith("linux"):
+        with open(source, "rb") as f_source, open(destination, "wb") as f_destination:
+            try:
+                fcntl.ioctl(f_destination.fileno(), _FICLONE, f_source.fileno())
+                return
+            except OSError:
+                pass
+    shutil.copyfile(source, destination)
+
+def _clone_or_copy(source, destination):
+#   copies the cached file source to the working file destination
+#   - never a hard link: a script writing the working file in place would
+#     otherwise write through to the cached copy
+#   - the copy is made under a temporary name, unique to the process, and 
+#     renamed to destination, so destination is never seen half written
+    partial_file = f"{destination}.{os.getpid()}.tmp"
+    try:
+        _clone_file(source, partial_file)
+        os.replace(partial_file, destination)
+    except Exception:
+        delete_file(partial_file)
+        raise
+
+def download_file_from_s3_cache(s3_client, bucket_name, key, file_name, 
+                                cache_dir=S3_CACHE_DIR, max_bytes=S3_CACHE_MAX_BYTES):
+#   downloads bucket_name/key to file_name through the local S3 cache
+#   - revalidates with a HEAD request: a cached copy is used only if its ETag 
+#     matches the current ETag of the object
+#   - on a miss the object is downloaded into the cache, older versions of 
+#     the same key are removed and the cache is evicted down to max_bytes
+#   - the key is locked from the lookup until the copy is made: a process
+#     asking for a key another process is downloading waits, and then hits
+#   Exceptions are raised to the caller.
+    etag = s3_client.head_object(Bucket=bucket_name, Key=key)["ETag"].strip('"')
+    path = s3_cache_path(bucket_name, key, etag, cache_dir)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with file_lock(s3_cache_lock_path(bucket_name, key, cache_dir)):
+        if os.path.exists(path) and os.path.exists(path + ".json"):
+            s3_cache_stats["hits"] += 1
+            os.utime(path)
+            logger.info(f"S3 cache hit: '{key}' ({etag})")
+        else:
+            s3_cache_stats["misses"] += 1
+            logger.info(f"S3 cache miss: '{key}' ({etag})")
+            for old_path, metadata in _read_s3_cache_entries(cache_dir):
+                if metadata["bucket"] == bucket_name and metadata["key"] == key:
+                    _remove_s3_cache_entry(old_path)
+
+            # download to a temporary name so an interrupted download is never cached
+            # the temporary name depends on the ETag, so a rerun resumes the download
+            if not download_file_multipart(s3_client, bucket_name, key, path + ".tmp"):
+                raise IOError(f"Download of '{key}' failed verification")
+            os.replace(path + ".tmp", path)
+            with open(path + ".json", "w") as f_:
+                json.dump({"bucket": bucket_name, "key": key, "etag": etag, 
+                           "size": os.path.getsize(path)}, f_)
+            evict_s3_cache(max_bytes, cache_dir, keep=path)
+
+        _clone_or_copy(path, file_name)
+    logger.debug(f"S3 cache hits: {s3_cache_stats['hits']}, misses: {s3_cache_stats['misses']}, evictions: {s3_cache_stats['evictions']}")
+
+def download_file_from_s3_client(s3_client, BUCKET_NAME, FILE_NAME, use_cache=S3_CACHE_ENABLED):
 #   downloads file from s3 client
+#   use_cache==True downloads through the local S3 cache in S3_CACHE_DIR
 #   return is_downloaded==True if download succeeded
     is_downloaded = False
     try:
-        s3_client.download_file(
-            BUCKET_NAME, 
-            FILE_NAME, 
-            FILE_NAME
-            )
+        if use_cache:
+            download_file_from_s3_cache(
+                s3_client, 
+                BUCKET_NAME, 
+                FILE_NAME, 
+                FILE_NAME
+                )
+        else:
+            # the partial file and its state are shared by the processes
+            # downloading FILE_NAME: one at a time
+            with file_lock(FILE_NAME + ".lock"):
+                is_verified = download_file_multipart(
+                    s3_client, 
+                    BUCKET_NAME, 
+                    FILE_NAME, 
+                    FILE_NAME
+                    )
+            if not is_verified:
+                raise IOError(f"Download of '{FILE_NAME}' failed verification")
         is_downloaded = True
     
     except botocore.exceptions.EndpointConnectionError:
@@ -112,9 +645,173 @@ def download_file_from_s3_client(s3_client, BUCKET_NAME, FILE_NAME):
     
     except FileNotFoundError:
         logger.exception(f"Cannot write: '{FILE_NAME}'")
+
+    except IOError:
+        logger.exception(f"Download failed: '{FILE_NAME}'")
         
     return is_downloaded
 
+def download_arcgis_layer(url, file_name, out_fields="*", page_size=ARCGIS_PAGE_SIZE):
+#   downloads all the features of an ArcGIS MapServer layer query url as 
+#   GeoJSON (WGS84) to file_name, paging through the layer page_size
+#   features at a time.
+#   The layer is written to a temporary name, unique to the process, and 
+#   renamed to file_name, so file_name is never seen half written.
+#   return is_downloaded==True if download succeeded
+    features = []
+    partial_file = f"{file_name}.{os.getpid()}.tmp"
+    try:
+        while True:
+            response = requests.get(url, params={
+                "where": "1=1",
+                "outFields": out_fields,
+                "outSR": 4326,
+                "f": "geojson",
+                "resultOffset": len(features),
+                "resultRecordCount": page_size,
+                })
+            response.raise_for_status()
+            page = response.json()
+            features.extend(page.get("features", []))
+            is_truncated = page.get("exceededTransferLimit") or page.get("properties", {}).get("exceededTransferLimit")
+            if not is_truncated or not page.get("features"):
+                break
+        with open(partial_file, "w") as f_:
+            json.dump({"type": "FeatureCollection", "features": features}, f_)
+        os.replace(partial_file, file_name)
+        logger.info(f"ArcGIS layer downloaded: '{file_name}', {len(features)} features")
+        return True
+
+    except HTTPError as http_err:
+        logger.exception(f"HTTP error occurred: {http_err}")
+    except requests.exceptions.RequestException as err:
+        logger.exception(f"Error occurred: {err}")
+    except ValueError:
+        logger.exception(f"Invalid ArcGIS response: '{url}'")
+    except OSError:
+        logger.exception(f"Cannot write: '{file_name}'")
+    delete_file(partial_file)
+    return False
+
+def iter_select_records(payload, select_stats=None):
+#   yields each JSON record of an S3 SELECT event stream as the events arrive
+#   - records are delimited by "\n" but a record may be split across the
+#     payloads of consecutive 'Records' events, so the incomplete tail of each 
+#     payload is kept until the rest of the record arrives
+#   - the payloads are split as bytes, so a multi-byte UTF-8 character split 
+#     across events is decoded intact
+#   - 'Stats' events are logged, and copied into the select_stats dict if given
+    buffer = b""
+    for event in payload:
+        if 'Records' in event:
+            buffer += event['Records']['Payload']
+            lines = buffer.split(b"\n")
+            buffer = lines.pop()
+            for line in lines:
+                if line.strip():
+                    yield json.loads(line)
+        elif "Stats" in event:
+            stats = event["Stats"]["Details"]
+            logger.debug(f"AWS S3 SELECT response statistics: {stats}")
+            if select_stats is not None:
+                select_stats.update(stats)
+    if buffer.strip():
+        yield json.loads(buffer)
+
+_NON_WHITESPACE = re.compile(r"\S")
+
+class _JsonStream:
+#   Reads the JSON text of a file one block at a time, decoding one value at 
+#   a time, and keeps the byte offset in the file of the next character.
+    def __init__(self, f_, block_size):
+        self._file = f_
+        self._block_size = block_size
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._json = json.JSONDecoder()
+        self.text = ""
+        self.pos = 0
+        self.offset = 0
+        self.eof = False
+
+    def _read(self):
+#       appends the next block of the file to the text; returns False at the end of the file
+        if self.eof:
+            return False
+        block = self._file.read(self._block_size)
+        self.eof = not block
+        self.text = self.text[self.pos:] + self._decoder.decode(block, final=self.eof)
+        self.pos = 0
+        return not self.eof
+
+    def _advance(self, end):
+        self.offset += len(self.text[self.pos:end].encode("utf-8"))
+        self.pos = end
+
+    def next_char(self):
+#       skips whitespace and returns the next character, "" at the end of the file
+        while True:
+            match = _NON_WHITESPACE.search(self.text, self.pos)
+            if match:
+                self._advance(match.start())
+                return self.text[self.pos]
+            self._advance(len(self.text))
+            if not self._read():
+                return ""
+
+    def consume(self, char):
+#       skips whitespace and the character char, which must come next
+        if self.next_char() != char:
+            raise ValueError(f"Expected '{char}' at byte {self.offset}")
+        self._advance(self.pos + 1)
+
+    def decode(self):
+#       decodes the next JSON value; returns (value, offset, size), in bytes
+        self.next_char()
+        while True:
+            try:
+                value, end = self._json.raw_decode(self.text, self.pos)
+                # a number at the end of the text may continue in the next block
+                if end < len(self.text) or self.eof:
+                    break
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._read()
+        offset = self.offset
+        self._advance(end)
+        return value, offset, self.offset - offset
+
+def iter_geojson_features(file_name, block_size=GEOJSON_BLOCK_SIZE):
+#   yields (feature, offset, size) for each feature of the GeoJSON 
+#   FeatureCollection file_name, reading block_size bytes at a time
+#   - only one feature is held in memory, not the whole collection
+#   - offset and size locate the feature's JSON in the file, in bytes, so it
+#     can be read again with read_geojson_feature()
+#   - the other members of the collection ("type", "crs", ...) are skipped
+    with open(file_name, "rb") as f_:
+        stream = _JsonStream(f_, block_size)
+        stream.consume("{")
+        while stream.next_char() != "}":
+            key, _, _ = stream.decode()
+            stream.consume(":")
+            if key != "features":
+                stream.decode()
+            else:
+                stream.consume("[")
+                while stream.next_char() != "]":
+                    yield stream.decode()
+                    if stream.next_char() == ",":
+                        stream.consume(",")
+                stream.consume("]")
+            if stream.next_char() == ",":
+                stream.consume(",")
+
+def read_geojson_feature(file_name, offset, size):
+#   return the feature of file_name found by iter_geojson_features() at offset
+    with open(file_name, "rb") as f_:
+        f_.seek(offset)
+        return json.loads(f_.read(size))
+
 def delete_file(file_name):
 #   deletes a file on disk. 
 #   returns False if there is a Permission Error
@@ -130,3 +827,397 @@ def delete_file(file_name):
       logger.exception(f"Permission error: '{file_name}'")  
       logger.error(f"Please close file before proceeding: '{file_name}'")    
       return False
+
+def delete_directory(directory):
+#   deletes a directory and its files on disk. 
+#   returns False if there is a Permission Error
+  try:
+      shutil.rmtree(directory)
+      return True
+    
+  except FileNotFoundError:
+      logger.debug(f"Directory not present: '{directory}'")  
+      return True
+  
+  except PermissionError:
+      logger.exception(f"Permission error: '{directory}'")  
+      logger.error(f"Please close files before proceeding: '{directory}'")    
+      return False
+
+def get_peak_rss_mb():
+#   return the peak resident set size (RSS) of this process in MB
+#   returns None if the platform does not report it
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux
+    if sys.platform == "darwin":
+        return peak_rss/(1024*1024)
+    return peak_rss/1024
+
+def log_peak_rss(stage, memory_target_mb=None, peak_rss_mb=None):
+#   logs the peak RSS of stage and returns it in MB
+#   - peak_rss_mb is the peak measured over the stage (see MemoryMonitor); 
+#     if None, the peak RSS of this process over its lifetime is logged
+#   - logs a warning if the peak RSS exceeds memory_target_mb
+    description = "Peak RSS of"
+    if peak_rss_mb is None:
+        description = "Process peak RSS after"
+        peak_rss_mb = get_peak_rss_mb()
+    if peak_rss_mb is None:
+        return None
+    logger.info(f"{description} {stage}: {peak_rss_mb:.1f} MB")
+    if memory_target_mb is not None and peak_rss_mb > memory_target_mb:
+        logger.warning(f"Peak RSS {peak_rss_mb:.1f} MB exceeds the memory target of {memory_target_mb} MB")
+    return peak_rss_mb
+
+
+def get_git_commit():
+#   return the short hash of the git commit of the submission, or None if
+#   it is not run from a git checkout
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, timeout=10,
+            )
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return result.stdout.strip() or None
+
+def read_process_io():
+#   return the I/O counters of this process (all threads) from /proc/self/io:
+#   - rchar/wchar: bytes passed to read and write calls (files, pipes, sockets)
+#   - read_bytes/write_bytes: bytes fetched from and sent to the storage layer
+#   returns None if the platform does not report them (e.g. macOS, Windows)
+    try:
+        with open("/proc/self/io") as f_:
+            return {name: int(value) for name, value in (line.split(":") for line in f_ if ":" in line)}
+    except (OSError, ValueError):
+        return None
+
+def get_rss_mb(pid="self"):
+#   return the current resident set size of process pid (default: this
+#   process) in MB, or None if the platform does not report it
+    try:
+        with open(f"/proc/{pid}/status") as f_:
+            for line in f_:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])/1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def _child_pids(pid):
+#   return the pids of the running child processes of pid, [] if unknown
+    child_pids = []
+    try:
+        for thread_id in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{thread_id}/children") as f_:
+                child_pids.extend(int(child_pid) for child_pid in f_.read().split())
+    except (OSError, ValueError):
+        pass
+    return child_pids
+
+def get_process_tree_rss_mb():
+#   return the current RSS in MB of this process and its descendants (e.g. the
+#   H3 indexing workers and their fork server), or None if the platform does
+#   not report it
+    total_rss_mb = None
+    pending = [os.getpid()]
+    while pending:
+        pid = pending.pop()
+        rss_mb = get_rss_mb(pid)
+        if rss_mb is None:
+            continue
+        total_rss_mb = (total_rss_mb or 0.0) + rss_mb
+        pending.extend(_child_pids(pid))
+    return total_rss_mb
+
+
+class _MemoryWindow:
+#   Handle yielded by MemoryMonitor.window(): peak_mb is the peak RSS sampled in the window
+    def __init__(self):
+        self.peak_mb = None
+
+
+class MemoryMonitor:
+#   Samples the RSS of this process and its child processes every interval 
+#   seconds on a background thread. ru_maxrss (get_peak_rss_mb()) is the peak 
+#   of this process over its lifetime, without its workers; the monitor 
+#   measures the peak of each window of a run instead.
+#   - window() is a context manager yielding a handle whose peak_mb is the peak
+#     RSS sampled from its start to its end; windows may overlap
+#   - peak_mb is None if the platform does not report the RSS of processes
+    def __init__(self, interval=MEMORY_SAMPLE_INTERVAL_S):
+        self.interval = interval
+        self._windows = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def sample(self):
+#       samples the RSS into the open windows and returns it in MB
+        rss_mb = get_process_tree_rss_mb()
+        if rss_mb is not None:
+            with self._lock:
+                for window in self._windows:
+                    window.peak_mb = rss_mb if window.peak_mb is None else max(window.peak_mb, rss_mb)
+        return rss_mb
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.sample()
+
+    @contextmanager
+    def window(self):
+        window = _MemoryWindow()
+        with self._lock:
+            self._windows.append(window)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="memory-monitor", daemon=True)
+                self._thread.start()
+        self.sample()
+        try:
+            yield window
+        finally:
+            self.sample()
+            with self._lock:
+                self._windows.remove(window)
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+def _child_cpu_time():
+#   return the CPU time in seconds of the terminated child processes
+#   (e.g. the H3 indexing workers)
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class StageMetrics:
+#   Totals of one named stage of a run, over all the times it was entered.
+#   - wall_time_s, cpu_time_s (this process, all threads) and child_cpu_time_s
+#   - peak_rss_mb: the peak RSS of the process at the end of the stage, and
+#     peak_rss_increase_mb: how much the stage raised it
+#   - rows_in/rows_out: as set on the stage by the caller (None if never set)
+#   - bytes_read/bytes_written: the rchar/wchar counters of /proc/self/io,
+#     disk_bytes_read/disk_bytes_written: the read_bytes/write_bytes counters.
+#     The counters are process wide, so they include the I/O of the stages of
+#     other threads that ran at the same time, listed in io_shared_with
+    COUNTERS = {"bytes_read": "rchar", "bytes_written": "wchar",
+                "disk_bytes_read": "read_bytes", "disk_bytes_written": "write_bytes"}
+
+    def __init__(self, name, parent, start_offset_s):
+        self.name = name
+        self.parent = parent
+        self.start_offset_s = start_offset_s
+        self.calls = 0
+        self.errors = 0
+        self.wall_time_s = 0.0
+        self.cpu_time_s = 0.0
+        self.child_cpu_time_s = 0.0
+        self.peak_rss_mb = None
+        self.peak_rss_increase_mb = None
+        self.rss_end_mb = None
+        self.rows_in = None
+        self.rows_out = None
+        self.io = {name: None for name in self.COUNTERS}
+        self.io_shared_with = set()
+
+    def to_dict(self):
+        metrics = {name: value for name, value in vars(self).items() if name != "io"}
+        metrics.update(self.io)
+        metrics["io_shared_with"] = sorted(self.io_shared_with)
+        return metrics
+
+
+class _Stage:
+#   Handle yielded by RunReport.stage(): set rows_in and rows_out on it.
+#   time_elapsed is the wall time of the stage in seconds, set when it ends,
+#   for the "Time Taken" log line of the caller.
+    def __init__(self, rows_in=None):
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.time_elapsed = None
+
+
+class RunReport:
+#   Machine readable report of a run of a script, written as JSON to file_name
+#   (e.g. next to the .log file) and appended as one line to history_file.
+#   - stage(name) is a context manager that measures the enclosed block;
+#     stages entered inside a stage are recorded as "parent/name"
+#   - a stage entered repeatedly (e.g. once per chunk) is accumulated into one
+#     StageMetrics, with the number of calls
+#   Stages are nested per thread (stages of prefetch threads are top level);
+#   CPU time, peak RSS and I/O counters are those of the whole process. The
+#   report records this as "io_scope": "process", and each stage lists the
+#   stages of other threads that overlapped it (io_shared_with), as their I/O
+#   is counted in both. Per-thread counters would miss the I/O of the worker
+#   threads a stage starts, e.g. the parts of a multipart download.
+    def __init__(self, name, file_name, history_file=RUN_REPORT_HISTORY, parameters=None):
+        self.name = name
+        self.file_name = file_name
+        self.history_file = history_file
+        self.parameters = dict(parameters or {})
+        self.started = datetime.now(timezone.utc)
+        self._start_time = timeit.default_timer()
+        self._start_cpu_time = time.process_time()
+        self._start_child_cpu_time = _child_cpu_time()
+        self._start_io = read_process_io()
+        self._stages = {}
+        self._running = {}
+        self._lock = threading.Lock()
+        self._thread = threading.local()
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        active = self._thread.__dict__.setdefault("active", [])
+        path = "/".join(active + [name])
+        with self._lock:
+            if path not in self._stages:
+                self._stages[path] = StageMetrics(path, "/".join(active) or None,
+                                                  timeit.default_timer() - self._start_time)
+            metrics = self._stages[path]
+            thread_id = threading.get_ident()
+            for other_thread_id, other in self._running.values():
+                if other_thread_id != thread_id:
+                    metrics.io_shared_with.add(other.name)
+                    other.io_shared_with.add(path)
+            token = object()
+            self._running[token] = (thread_id, metrics)
+        handle = _Stage(rows_in)
+
+        start_peak_rss_mb = get_peak_rss_mb()
+        start_io = read_process_io()
+        start_child_cpu_time = _child_cpu_time()
+        start_cpu_time = time.process_time()
+        start_time = timeit.default_timer()
+        active.append(name)
+        try:
+            yield handle
+        except BaseException:
+            metrics.errors += 1
+            raise
+        finally:
+            active.pop()
+            with self._lock:
+                del self._running[token]
+                self._record(metrics, handle, start_time, start_cpu_time, start_child_cpu_time,
+                             start_io, start_peak_rss_mb)
+
+    def _record(self, metrics, handle, start_time, start_cpu_time, start_child_cpu_time, start_io, start_peak_rss_mb):
+#       adds one call of a stage to its metrics
+        wall_time_s = timeit.default_timer() - start_time
+        cpu_time_s  = time.process_time() - start_cpu_time
+        handle.time_elapsed = wall_time_s
+        metrics.calls += 1
+        metrics.wall_time_s += wall_time_s
+        metrics.cpu_time_s += cpu_time_s
+        metrics.child_cpu_time_s += _child_cpu_time() - start_child_cpu_time
+        end_io = read_process_io()
+        if start_io is not None and end_io is not None:
+            for field, counter in StageMetrics.COUNTERS.items():
+                delta = end_io.get(counter, 0) - start_io.get(counter, 0)
+                metrics.io[field] = (metrics.io[field] or 0) + delta
+        peak_rss_mb = get_peak_rss_mb()
+        if peak_rss_mb is not None and start_peak_rss_mb is not None:
+            metrics.peak_rss_mb = max(metrics.peak_rss_mb or 0.0, peak_rss_mb)
+            metrics.peak_rss_increase_mb = (metrics.peak_rss_increase_mb or 0.0) + peak_rss_mb - start_peak_rss_mb
+        metrics.rss_end_mb = get_rss_mb()
+        for field in ("rows_in", "rows_out"):
+            value = getattr(handle, field)
+            if value is not None:
+                setattr(metrics, field, (getattr(metrics, field) or 0) + int(value))
+
+    def to_dict(self):
+        end_io = read_process_io()
+        io = {}
+        for field, counter in StageMetrics.COUNTERS.items():
+            io[field] = None
+            if self._start_io is not None and end_io is not None:
+                io[field] = end_io.get(counter, 0) - self._start_io.get(counter, 0)
+        return {
+            "name": self.name,
+            "started": self.started.isoformat(),
+            "finished": datetime.now(timezone.utc).isoformat(),
+            "git_commit": get_git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "parameters": self.parameters,
+            "wall_time_s": timeit.default_timer() - self._start_time,
+            "cpu_time_s": time.process_time() - self._start_cpu_time,
+            "child_cpu_time_s": _child_cpu_time() - self._start_child_cpu_time,
+            "peak_rss_mb": get_peak_rss_mb(),
+            "io_scope": "process",
+            **io,
+            "stages": [metrics.to_dict() for metrics in self._stages.values()],
+            }
+
+    def save(self):
+#       writes the report to file_name and appends it to history_file
+#       returns the report as a dict
+        report = self.to_dict()
+        try:
+            with open(self.file_name + ".partial", "w") as f_:
+                json.dump(report, f_, indent=2, default=str)
+            os.replace(self.file_name + ".partial", self.file_name)
+            if self.history_file is not None:
+                with open(self.history_file, "a") as f_:
+                    f_.write(json.dumps(report, default=str) + "\n")
+            logger.info(f"Run report saved to '{self.file_name}': {len(report['stages'])} stages")
+        except OSError:
+            logger.exception(f"Cannot write run report: '{self.file_name}'")
+        return report
+
+
+# the run report of this process, see start_run_report()
+_run_report = {"report": None}
+
+def start_run_report(name, file_name, parameters=None, history_file=RUN_REPORT_HISTORY):
+#   starts the RunReport of this process, used by run_stage() and instrument()
+    _run_report["report"] = RunReport(name, file_name, history_file, parameters)
+    return _run_report["report"]
+
+def get_run_report():
+#   return the RunReport of this process, or None if no report was started
+    return _run_report["report"]
+
+def finish_run_report():
+#   saves and ends the RunReport of this process, returns it as a dict (None if no report was started)
+    report = _run_report["report"]
+    _run_report["report"] = None
+    return None if report is None else report.save()
+
+@contextmanager
+def run_stage(name, rows_in=None):
+#   measures the enclosed block as stage name of the RunReport of this process;
+#   only yields a handle (for rows_in/rows_out, and time_elapsed once the
+#   block ends) if no report was started
+    report = _run_report["report"]
+    if report is None:
+        handle = _Stage(rows_in)
+        start_time = timeit.default_timer()
+        try:
+            yield handle
+        finally:
+            handle.time_elapsed = timeit.default_timer() - start_time
+        return
+    with report.stage(name, rows_in) as stage_:
+        yield stage_
+
+def instrument(name=None):
+#   decorator that runs the decorated function as a run_stage() of name
+#   (default: the function name)
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with run_stage(name or function.__name__):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
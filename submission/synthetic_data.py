@@ -0,0 +1,247 @@
+# This module contains the synthetic data generators used to benchmark the
+# scripts submitted for the City of Cape Town - Data Science Unit Code Challenge
+# https://github.com/cityofcapetown/ds_code_challenge
+#
+# The generators produce offline stand-ins for the inputs of the scripts, of
+# any size and reproducible from a seed:
+# - service requests with the columns of SERVICE_REQUEST_SOURCE, written as
+#   a gzipped csv with the same leading unnamed index column
+# - an H3 hex polygon layer, shaped like CITY_HEX_POLYGONS_8_SOURCE, of the
+#   cells holding the service requests
+# - wind readings of several stations, written as an OpenDocument spreadsheet
+#   laid out like WIND_DATA_OUTPUT (two columns per station, 24:00 timestamps,
+#   missing value codes and summary rows), or as a csv
+# The service request locations are clustered around random centres within
+# SYNTHETIC_BBOX, the first centre being BENCHMARK_CENTROID.
+
+from support_library import(SYNTHETIC_SEED,
+                            SYNTHETIC_NULL_FRACTION,
+                            SYNTHETIC_START,
+                            SYNTHETIC_END,
+                            SYNTHETIC_BBOX,
+                            SYNTHETIC_WIND_STATIONS,
+                            BENCHMARK_CENTROID,
+                            WIND_DATA_TIMESTAMP_FORMAT,
+                            WIND_DATA_MISSING_VALUES,
+                            )
+from h3_indexer import calculate_h3_index_int, h3_int_to_string
+
+import json
+import zipfile
+from xml.sax.saxutils import escape
+
+import numpy as np
+import pandas as pd
+import h3
+
+SYNTHETIC_TIMEZONE = "Africa/Johannesburg"
+SYNTHETIC_NUM_CLUSTERS = 200
+SYNTHETIC_CLUSTER_SPREAD = 0.01    # standard deviation of a cluster in degrees
+
+# number of distinct values of each categorical column
+SYNTHETIC_CATEGORIES = {
+    "directorate": 12,
+    "department": 40,
+    "branch": 100,
+    "section": 250,
+    "code_group": 5,
+    "code": 400,
+    "cause_code_group": 20,
+    "cause_code": 150,
+    "official_suburb": 800,
+    }
+
+ODS_MIMETYPE = "application/vnd.oasis.opendocument.spreadsheet"
+ODS_MANIFEST = """<?xml version="1.0" encoding="UTF-8"?>
+<manifest:manifest xmlns:manifest="urn:oasis:names:tc:opendocument:xmlns:manifest:1.0" manifest:version="1.2">
+ <manifest:file-entry manifest:full-path="/" manifest:media-type="application/vnd.oasis.opendocument.spreadsheet"/>
+ <manifest:file-entry manifest:full-path="content.xml" manifest:media-type="text/xml"/>
+</manifest:manifest>
+"""
+ODS_CONTENT_HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<office:document-content xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0" xmlns:table="urn:oasis:names:tc:opendocument:xmlns:table:1.0" xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0" office:version="1.2">
+<office:body><office:spreadsheet><table:table table:name="Wind">
+"""
+ODS_CONTENT_FOOTER = """</table:table></office:spreadsheet></office:body></office:document-content>
+"""
+
+
+def _zipf_codes(rng, num_categories, num_rows):
+#   return num_rows category codes in [0, num_categories), the first codes
+#   being the most frequent (probability proportional to 1/(code + 1))
+    weights = 1/np.arange(1, num_categories + 1)
+    return rng.choice(num_categories, num_rows, p=weights/weights.sum()).astype(np.int32)
+
+def generate_locations(num_rows, null_fraction=SYNTHETIC_NULL_FRACTION, bbox=SYNTHETIC_BBOX, seed=SYNTHETIC_SEED):
+#   return (latitude, longitude) float64 arrays of num_rows points clustered
+#   around SYNTHETIC_NUM_CLUSTERS centres in bbox, with null_fraction NaN points
+    rng = np.random.default_rng([seed, 1])
+    centre_longitude = rng.uniform(bbox[0], bbox[2], SYNTHETIC_NUM_CLUSTERS)
+    centre_latitude  = rng.uniform(bbox[1], bbox[3], SYNTHETIC_NUM_CLUSTERS)
+    centre_longitude[0], centre_latitude[0] = BENCHMARK_CENTROID
+    cluster = _zipf_codes(rng, SYNTHETIC_NUM_CLUSTERS, num_rows)
+    latitude  = np.clip(centre_latitude[cluster] + rng.normal(0, SYNTHETIC_CLUSTER_SPREAD, num_rows), bbox[1], bbox[3])
+    longitude = np.clip(centre_longitude[cluster] + rng.normal(0, SYNTHETIC_CLUSTER_SPREAD, num_rows), bbox[0], bbox[2])
+    is_null = rng.random(num_rows) < null_fraction
+    latitude[is_null]  = np.nan
+    longitude[is_null] = np.nan
+    return latitude, longitude
+
+def generate_service_requests(num_rows, null_fraction=SYNTHETIC_NULL_FRACTION, start=SYNTHETIC_START,
+                              end=SYNTHETIC_END, bbox=SYNTHETIC_BBOX, seed=SYNTHETIC_SEED):
+#   return a dataframe of num_rows synthetic service requests with the columns
+#   of SERVICE_REQUEST_SOURCE
+#   - creation_timestamp is uniform in [start, end), to the second, in
+#     SYNTHETIC_TIMEZONE; completion_timestamp follows after an exponential
+#     delay (mean 3 days) and is null for 5% of the requests
+#   - categorical columns are pd.Categorical with skewed frequencies;
+#     cause codes are null for 10% of the requests, official_suburb for the
+#     requests without coordinates
+#   - null_fraction of the requests have no latitude/longitude
+    rng = np.random.default_rng([seed, 0])
+    latitude, longitude = generate_locations(num_rows, null_fraction, bbox, seed)
+
+    start_s = pd.Timestamp(start, tz=SYNTHETIC_TIMEZONE).value//10**9
+    end_s   = pd.Timestamp(end, tz=SYNTHETIC_TIMEZONE).value//10**9
+    creation_s = rng.integers(start_s, end_s, num_rows)
+    completion_s = creation_s + rng.exponential(3*24*3600, num_rows).astype(np.int64)
+    creation_timestamp = pd.to_datetime(creation_s, unit="s", utc=True).tz_convert(SYNTHETIC_TIMEZONE)
+    completion_timestamp = pd.Series(pd.to_datetime(completion_s, unit="s", utc=True).tz_convert(SYNTHETIC_TIMEZONE))
+    completion_timestamp[rng.random(num_rows) < 0.05] = pd.NaT
+
+    reference_number = rng.integers(9_100_000_000, 9_200_000_000, num_rows).astype(np.float64)
+    reference_number[rng.random(num_rows) < 0.3] = np.nan
+
+    service_requests = pd.DataFrame({
+        "notification_number": 400_000_000 + rng.permutation(num_rows),
+        "reference_number": reference_number,
+        "creation_timestamp": creation_timestamp,
+        "completion_timestamp": completion_timestamp,
+        })
+    for name, num_categories in SYNTHETIC_CATEGORIES.items():
+        codes = _zipf_codes(rng, num_categories, num_rows)
+        if name in ("cause_code_group", "cause_code"):
+            codes[rng.random(num_rows) < 0.1] = -1
+        elif name == "official_suburb":
+            codes[np.isnan(latitude)] = -1
+        categories = [f"{name.replace('_', ' ').upper()} {code}" for code in range(num_categories)]
+        service_requests[name] = pd.Categorical.from_codes(codes, categories)
+    service_requests["latitude"]  = latitude
+    service_requests["longitude"] = longitude
+    return service_requests
+
+def write_service_requests_csv(service_requests, file_name, compresslevel=6):
+#   writes service_requests like SERVICE_REQUEST_SOURCE: a csv with a leading
+#   unnamed index column, gzipped if file_name ends with ".gz"
+    compression = {"method": "gzip", "compresslevel": compresslevel} if file_name.endswith(".gz") else None
+    service_requests.to_csv(file_name, index=True, compression=compression)
+
+
+def generate_hex_layer(latitude, longitude, resolution=8):
+#   return the GeoJSON features of the H3 cells at resolution holding the
+#   points, with the 'index', 'centroid_lat' and 'centroid_lon' properties of
+#   CITY_HEX_POLYGONS_8_SOURCE
+    cells = np.unique(calculate_h3_index_int(latitude, longitude, resolution))
+    features = []
+    for cell in h3_int_to_string(cells[cells != 0]):
+        centroid_lat, centroid_lon = h3.h3_to_geo(cell)
+        boundary = [list(point) for point in h3.h3_to_geo_boundary(cell, geo_json=True)]
+        features.append({
+            "type": "Feature",
+            "properties": {"index": cell, "centroid_lat": centroid_lat, "centroid_lon": centroid_lon},
+            "geometry": {"type": "Polygon", "coordinates": [boundary]},
+            })
+    return features
+
+def write_hex_layer(features, file_name):
+#   writes the features as a GeoJSON FeatureCollection
+    with open(file_name, "w") as f_:
+        json.dump({"type": "FeatureCollection", "features": features}, f_)
+
+
+def generate_wind_data(start=SYNTHETIC_START, end=SYNTHETIC_END, stations=SYNTHETIC_WIND_STATIONS, seed=SYNTHETIC_SEED):
+#   return (wind_data, columns):
+#   - wind_data: a dataframe of hourly 'date_and_time' (SYNTHETIC_TIMEZONE)
+#     after start up to end, with the float32 '{station}/wind_direction_deg'
+#     and '{station}/wind_speed_m_s' readings of each station
+#   - columns: {station: {column number: field}} of the spreadsheet written by
+#     write_wind_ods(), as in WIND_DATA_STATIONS
+    rng = np.random.default_rng([seed, 2])
+    date_and_time = pd.date_range(pd.Timestamp(start, tz=SYNTHETIC_TIMEZONE) + pd.Timedelta(hours=1),
+                                  pd.Timestamp(end, tz=SYNTHETIC_TIMEZONE), freq="h")
+    wind_data = pd.DataFrame({"date_and_time": date_and_time})
+    columns = {}
+    for number, station in enumerate(stations):
+        # a slowly veering direction and a gamma distributed speed
+        direction = (rng.uniform(0, 360) + np.cumsum(rng.normal(0, 15, len(date_and_time)))) % 360
+        wind_data[f"{station}/wind_direction_deg"] = np.round(direction, 1).astype(np.float32)
+        wind_data[f"{station}/wind_speed_m_s"] = np.round(rng.gamma(2.0, 2.0, len(date_and_time)), 1).astype(np.float32)
+        columns[station] = {1 + 2*number: "wind_direction_deg", 2 + 2*number: "wind_speed_m_s"}
+    return wind_data, columns
+
+def _ods_cell(value):
+#   return the content.xml of a table cell: float values as numeric cells,
+#   None as an empty cell, anything else as text
+    if value is None:
+        return "<table:table-cell/>"
+    if isinstance(value, (float, np.floating)):
+        return f'<table:table-cell office:value-type="float" office:value="{value:g}"/>'
+    return f'<table:table-cell office:value-type="string"><text:p>{escape(str(value))}</text:p></table:table-cell>'
+
+def _ods_row(values):
+    return "<table:table-row>" + "".join(_ods_cell(value) for value in values) + "</table:table-row>\n"
+
+def write_wind_ods(wind_data, columns, file_name, missing_fraction=0.01, seed=SYNTHETIC_SEED):
+#   writes wind_data (see generate_wind_data()) as an OpenDocument spreadsheet
+#   with the layout of WIND_DATA_OUTPUT:
+#   - two header rows: the station names, then the units ("Deg", "m/s")
+#   - one row per timestamp in WIND_DATA_TIMESTAMP_FORMAT, midnight written
+#     as 24:00 of the previous day
+#   - missing_fraction of the readings replaced by WIND_DATA_MISSING_VALUES
+#   - summary rows (minimum, maximum, average) at the end of the sheet
+    rng = np.random.default_rng([seed, 3])
+    num_columns = 1 + max(column for fields in columns.values() for column in fields)
+    station_row = [None]*num_columns
+    unit_row    = ["Date & Time"] + [None]*(num_columns - 1)
+    readings = {}
+    for station, fields in columns.items():
+        for column, field in fields.items():
+            station_row[column] = station
+            unit_row[column] = "Deg" if field == "wind_direction_deg" else "m/s"
+            readings[column] = wind_data[f"{station}/{field}"].to_numpy()
+
+    timestamps = wind_data["date_and_time"]
+    is_midnight = (timestamps.dt.hour == 0).to_numpy()
+    timestamp_text = np.where(
+        is_midnight,
+        (timestamps - pd.Timedelta(days=1)).dt.strftime(WIND_DATA_TIMESTAMP_FORMAT.replace("%H:%M", "24:00")),
+        timestamps.dt.strftime(WIND_DATA_TIMESTAMP_FORMAT),
+        )
+    is_missing = rng.random((len(wind_data), num_columns)) < missing_fraction
+    missing_code = rng.integers(0, len(WIND_DATA_MISSING_VALUES), (len(wind_data), num_columns))
+
+    rows = [_ods_row(station_row), _ods_row(unit_row)]
+    for row in range(len(wind_data)):
+        values = [timestamp_text[row]] + [None]*(num_columns - 1)
+        for column, column_readings in readings.items():
+            if is_missing[row, column]:
+                values[column] = WIND_DATA_MISSING_VALUES[missing_code[row, column]]
+            else:
+                values[column] = float(column_readings[row])
+        rows.append(_ods_row(values))
+    for name, summary in (("Minimum", np.nanmin), ("Maximum", np.nanmax), ("Avg", np.nanmean)):
+        values = [name] + [None]*(num_columns - 1)
+        for column, column_readings in readings.items():
+            values[column] = float(summary(column_readings))
+        rows.append(_ods_row(values))
+
+    with zipfile.ZipFile(file_name, "w") as ods_file:
+        # the mimetype is the first entry, stored uncompressed
+        ods_file.writestr("mimetype", ODS_MIMETYPE, compress_type=zipfile.ZIP_STORED)
+        ods_file.writestr("META-INF/manifest.xml", ODS_MANIFEST, compress_type=zipfile.ZIP_DEFLATED)
+        ods_file.writestr("content.xml", ODS_CONTENT_HEADER + "".join(rows) + ODS_CONTENT_FOOTER,
+                          compress_type=zipfile.ZIP_DEFLATED)
+
+def write_wind_csv(wind_data, file_name):
+#   writes wind_data (see generate_wind_data()) as a csv
+    wind_data.to_csv(file_name, index=False)
@@ -0,0 +1,61 @@
+# The tests import the modules of the submission directory as the scripts do.
+import os
+import sys
+import zipfile
+from xml.sax.saxutils import escape
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+ODS_CONTENT = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+               '<office:document-content xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0" '
+               'xmlns:table="urn:oasis:names:tc:opendocument:xmlns:table:1.0" '
+               'xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0">'
+               '<office:body><office:spreadsheet><table:table table:name="Sheet1">{rows}'
+               '</table:table></office:spreadsheet></office:body></office:document-content>')
+
+
+def ods_cell(value):
+    if value is None:
+        return "<table:table-cell/>"
+    if isinstance(value, float):
+        return f'<table:table-cell office:value-type="float" office:value="{value!r}"/>'
+    return f'<table:table-cell office:value-type="string"><text:p>{escape(value)}</text:p></table:table-cell>'
+
+
+@pytest.fixture
+def wind_ods(tmp_path):
+#   writes a wind spreadsheet with the layout of WIND_DATA_OUTPUT (a station
+#   row, a unit row, hourly rows with midnight as 24:00 of the previous day,
+#   "NoData" readings and the summary rows), and returns (file name, expected
+#   readings, {station: {column number: field}})
+    columns = {"Atlantis": {1: "wind_direction_deg", 2: "wind_speed_m_s"},
+               "Bellville South": {3: "wind_direction_deg", 4: "wind_speed_m_s"}}
+    rng = np.random.default_rng(0)
+    timestamps = pd.date_range("2020-03-01 01:00", "2020-03-10 00:00", freq="h", tz="Etc/GMT-2")
+    wind_data = pd.DataFrame({"date_and_time": timestamps})
+    is_midnight = timestamps.hour == 0
+    rows = [[None, "Atlantis", "Atlantis", "Bellville South", "Bellville South"], ["Date & Time", "Deg", "m/s", "Deg", "m/s"]]
+    rows += [[text] + [None]*4 for text in np.where(is_midnight,
+                                                    (timestamps - pd.Timedelta(days=1)).strftime("%d/%m/%Y 24:00"),
+                                                    timestamps.strftime("%d/%m/%Y %H:%M"))]
+    for station, fields in columns.items():
+        for column, field in fields.items():
+            high = 360 if field == "wind_direction_deg" else 15
+            readings = rng.uniform(0, high, len(timestamps)).round(1).astype(np.float32)
+            readings[column::37] = np.nan
+            wind_data[f"{station}/{field}"] = readings
+            for row, reading in enumerate(readings, start=2):
+                rows[row][column] = "NoData" if np.isnan(reading) else float(reading)
+    rows += [["Minimum", 0.0, 0.0, 0.0, 0.0], ["Maximum", 360.0, 15.0, 360.0, 15.0]]
+
+    file_name = str(tmp_path / "wind.ods")
+    with zipfile.ZipFile(file_name, "w") as ods_file:
+        ods_file.writestr("mimetype", "application/vnd.oasis.opendocument.spreadsheet")
+        ods_file.writestr("content.xml", ODS_CONTENT.format(
+            rows="".join("<table:table-row>" + "".join(ods_cell(value) for value in row) + "</table:table-row>"
+                         for row in rows)))
+    return file_name, wind_data, columns
@@ -0,0 +1,53 @@
+# Tests of the timestamp and location anonymisation of anonymise.py.
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("h3")
+pytest.importorskip("pyproj")
+
+from anonymise import anonymise_timestamps, SpatialAnonymiser
+from spatial_filter import haversine_distance_m
+
+
+def service_requests(num_rows, seed=0):
+#   return a dataframe with the timestamp columns of SERVICE_REQUEST_SOURCE,
+#   some of them null
+    rng = np.random.default_rng(seed)
+    created = pd.Timestamp("2020-01-01", tz="Africa/Johannesburg") + pd.to_timedelta(rng.integers(0, 86400*90, num_rows), unit="s")
+    completed = pd.Series(created + pd.to_timedelta(rng.exponential(3*86400, num_rows).astype(np.int64), unit="s"))
+    completed[rng.random(num_rows) < 0.05] = pd.NaT
+    return pd.DataFrame({"creation_timestamp": created, "completion_timestamp": completed})
+
+
+def test_anonymise_timestamps_within_offset():
+    frame = service_requests(1000, seed=8)
+    original = frame.copy()
+    anonymise_timestamps(frame, hours=6, seed=1)
+    for name in ("creation_timestamp", "completion_timestamp"):
+        offset = (frame[name] - original[name]).dropna()
+        assert (offset.abs() <= pd.Timedelta(hours=6)).all()
+        assert (offset != pd.Timedelta(0)).all()
+        assert (frame[name].isna() == original[name].isna()).all()
+
+    again = original.copy()
+    anonymise_timestamps(again, hours=6, seed=1)
+    pd.testing.assert_frame_equal(again, frame)
+
+
+@pytest.mark.parametrize("mode", ["geodesic", "planar"])
+def test_anonymise_locations_within_distance(mode):
+    rng = np.random.default_rng(9)
+    latitude = rng.uniform(-34.1, -33.8, 2000)
+    longitude = rng.uniform(18.4, 18.8, 2000)
+    latitude[rng.random(2000) < 0.2] = np.nan
+    longitude[np.isnan(latitude)] = np.nan
+    anonymiser = SpatialAnonymiser(mode, distance_m=500, chunk_size=300, seed=2)
+    new_latitude, new_longitude = anonymiser.anonymise(latitude, longitude)
+    assert (np.isnan(new_latitude) == np.isnan(latitude)).all()
+    distance = haversine_distance_m(new_latitude, new_longitude, latitude, longitude)
+    assert np.nanmax(distance) <= 500 + 1
+    assert anonymiser.stats["rows_displaced"] == int((~np.isnan(latitude)).sum())
+
+    again = SpatialAnonymiser(mode, distance_m=500, chunk_size=300, seed=2).anonymise(latitude, longitude)
+    np.testing.assert_array_equal(again[0], new_latitude)
@@ -0,0 +1,59 @@
+# Tests of the paged ArcGIS layer download of support_library.py, with the
+# HTTP requests replaced by canned pages.
+import json
+import os
+
+import pytest
+import requests
+
+import support_library
+from support_library import download_arcgis_layer
+
+
+class Page:
+    def __init__(self, features, truncated):
+        self._page = {"type": "FeatureCollection", "features": features, "exceededTransferLimit": truncated}
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self._page
+
+
+def feature(i):
+    return {"type": "Feature", "properties": {"OFC_SBRB_NAME": f"SUBURB {i}"}, "geometry": None}
+
+
+@pytest.fixture
+def pages(monkeypatch):
+    responses = []
+
+    def get(url, params):
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    monkeypatch.setattr(support_library.requests, "get", get)
+    return responses
+
+
+def test_pages_are_joined(tmp_path, pages):
+    file_name = str(tmp_path / "suburbs.geojson")
+    pages.extend([Page([feature(0), feature(1)], True), Page([feature(2)], False)])
+    assert download_arcgis_layer("https://arcgis/query", file_name, page_size=2)
+    with open(file_name) as f_:
+        assert json.load(f_)["features"] == [feature(0), feature(1), feature(2)]
+    assert os.listdir(tmp_path) == ["suburbs.geojson"]
+
+
+def test_failed_download_keeps_previous_file(tmp_path, pages):
+    file_name = str(tmp_path / "suburbs.geojson")
+    with open(file_name, "w") as f_:
+        f_.write("previous layer")
+    pages.extend([Page([feature(0)], True), requests.exceptions.ConnectionError("reset")])
+    assert not download_arcgis_layer("https://arcgis/query", file_name, page_size=1)
+    with open(file_name) as f_:
+        assert f_.read() == "previous layer"
+    assert os.listdir(tmp_path) == ["suburbs.geojson"]
@@ -0,0 +1,29 @@
+# Test of the offline benchmark of benchmark_pipeline.py on a small synthetic data set.
+import json
+import os
+
+import pytest
+
+pytest.importorskip("h3")
+pytest.importorskip("pyproj")
+
+import benchmark_pipeline
+
+
+def test_benchmark_saves_results_and_history(tmp_path, monkeypatch):
+    monkeypatch.setattr(benchmark_pipeline, "get_git_commit", lambda: "abc123")
+    data_dir = str(tmp_path / "data")
+    results_dir = str(tmp_path / "results")
+    for _ in range(2):
+        benchmark_pipeline.main([2000], data_dir, results_dir, 1, 0.2, "2020-01-01", "2020-01-15", 0)
+
+    history = benchmark_pipeline.read_history(results_dir)
+    assert len(history) == 2
+    result = benchmark_pipeline.read_result(results_dir, "abc123")
+    names = {stage["name"] for stage in result["stages"]}
+    assert {"wind/parse_wind_ods", "rows_2000/h3_index", "rows_2000/hex_join", "rows_2000/subsample",
+            "rows_2000/asof_join", "rows_2000/anonymise_locations"} <= names
+    assert all(stage["wall_time_s"] >= 0 for stage in result["stages"])
+    assert not [name for name in os.listdir(data_dir) if name.startswith("sr-")]
+    with open(os.path.join(results_dir, "abc123.json")) as f_:
+        assert json.load(f_)["parameters"]["rows"] == [2000]
@@ -0,0 +1,51 @@
+# Tests of the streamed extraction of challenge_1.py, on S3 SELECT event
+# streams built in the test.
+import json
+import os
+
+import botocore.exceptions
+import pytest
+
+import challenge_1
+from support_library import CHALLENGE_1_RESOLUTION_OUTPUT
+
+OUTPUT = CHALLENGE_1_RESOLUTION_OUTPUT.format(resolution=9)
+
+
+def records(num_features):
+    return b"".join(json.dumps({"type": "Feature", "properties": {"index": f"{i:x}", "resolution": 9},
+                                "geometry": {"type": "Point", "coordinates": [18.6, -33.9]}}).encode() + b"\n"
+                    for i in range(num_features))
+
+
+@pytest.fixture
+def extract(tmp_path, monkeypatch):
+#   return a function that runs main() for resolution 9 on an event stream
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(challenge_1, "set_s3_client", lambda: None)
+
+    def run(events):
+        monkeypatch.setattr(challenge_1, "select_hex_features", lambda *args: {"Payload": events})
+        challenge_1.main(resolutions=[9], use_scan_range=False)
+    return run
+
+
+def test_streamed_features_are_written(extract, tmp_path):
+    extract([{"Records": {"Payload": records(3)}}, {"End": {}}])
+    assert os.listdir(tmp_path) == [OUTPUT]
+    with open(OUTPUT) as f_:
+        assert len(f_.readlines()) == 3
+
+
+def test_malformed_record_leaves_no_partial_output(extract, tmp_path):
+    with pytest.raises(json.JSONDecodeError):
+        extract([{"Records": {"Payload": records(3) + b'{"type": "Feat'}}, {"End": {}}])
+    assert os.listdir(tmp_path) == []
+
+
+def test_broken_event_stream_leaves_no_partial_output(extract, tmp_path):
+    def events():
+        yield {"Records": {"Payload": records(3)}}
+        raise botocore.exceptions.EventStreamError({"Error": {"Code": "InternalError", "Message": ""}}, "SelectObjectContent")
+    extract(events())
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,89 @@
+# Tests of the parquet and partitioned outputs of columnar_io.py.
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+pytest.importorskip("h3")
+
+from columnar_io import (PartitionedServiceRequestsWriter,
+                         ServiceRequestsParquetWriter,
+                         concat_partition_tables,
+                         is_partitioned_copy_current,
+                         read_partition_manifest,
+                         read_partitioned_service_requests,
+                         read_service_requests_parquet,
+                         )
+from h3_indexer import calculate_h3_index
+from support_library import PARTITION_MANIFEST
+
+
+def service_requests(num_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    latitude = rng.uniform(-34.1, -33.8, num_rows)
+    longitude = rng.uniform(18.4, 18.8, num_rows)
+    latitude[::7] = np.nan
+    longitude[::7] = np.nan
+    return pd.DataFrame({
+        "notification_number": np.arange(num_rows) + seed*num_rows,
+        "creation_timestamp": pd.Timestamp("2020-10-01", tz="Africa/Johannesburg") + pd.to_timedelta(rng.integers(0, 86400*30, num_rows), unit="s"),
+        "department": rng.choice(["Water", "Roads", "Electricity"], num_rows),
+        "latitude": latitude,
+        "longitude": longitude,
+        "h3_level8_index": calculate_h3_index(latitude, longitude, 8),
+        })
+
+
+def test_concat_partition_tables_merges_schemas():
+    first = pa.table({"x": pa.array([1, 2]), "c": pa.array(["a", "b"]).dictionary_encode(), "n": pa.nulls(2)})
+    second = pa.table({"x": pa.array([1.5]), "c": pa.array(["z"]), "n": pa.array(["q"])})
+    table = concat_partition_tables([first, second])
+    assert table.schema.field("x").type == pa.float64()
+    assert table.column("c").to_pylist() == ["a", "b", "z"]
+    assert table.column("n").to_pylist() == [None, None, "q"]
+
+
+def test_partitioned_output_round_trip(tmp_path):
+    directory = str(tmp_path / "partitioned")
+    writer = PartitionedServiceRequestsWriter(directory)
+    batches = [service_requests(500, seed) for seed in range(3)]
+    for batch in batches:
+        writer.write(batch)
+    writer.close()
+
+    read = read_partitioned_service_requests(directory)
+    expected = pd.concat(batches, ignore_index=True)
+    assert read_partition_manifest(directory)["rows"] == len(expected)
+    assert sorted(read["notification_number"]) == sorted(expected["notification_number"])
+    merged = read.merge(expected, on="notification_number", suffixes=("", "_expected"))
+    assert (merged["h3_level8_index"] == merged["h3_level8_index_expected"]).all()
+
+
+def test_parquet_writer_chunks_match_single_write(tmp_path):
+    data = service_requests(1000)
+    file_name = str(tmp_path / "sr.parquet")
+    writer = ServiceRequestsParquetWriter(file_name)
+    for start in range(0, len(data), 300):
+        writer.write(data.iloc[start:start + 300])
+    writer.close()
+    assert pq.ParquetFile(file_name).num_row_groups == 4
+    pd.testing.assert_frame_equal(read_service_requests_parquet(file_name), data, check_dtype=False, check_categorical=False)
+    assert not os.path.exists(file_name + ".partial")
+
+
+def test_partitioned_copy_older_than_csv_is_stale(tmp_path):
+    directory = str(tmp_path / "partitioned")
+    csv_file = str(tmp_path / "sr.csv")
+    assert not is_partitioned_copy_current(directory, csv_file)
+    PartitionedServiceRequestsWriter(directory).close()
+    assert is_partitioned_copy_current(directory, csv_file)
+
+    manifest_time = os.path.getmtime(os.path.join(directory, PARTITION_MANIFEST))
+    service_requests(10).to_csv(csv_file, index=False)
+    os.utime(csv_file, (manifest_time - 1, manifest_time - 1))
+    assert is_partitioned_copy_current(directory, csv_file)
+    os.utime(csv_file, (manifest_time + 1, manifest_time + 1))
+    assert not is_partitioned_copy_current(directory, csv_file)
@@ -0,0 +1,54 @@
+# Tests of the dataframe comparison and digests of frame_diff.py.
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("h3")
+
+from frame_diff import diff_frames, row_hashes, FrameDigest
+
+
+@pytest.fixture
+def frame():
+    return pd.DataFrame({
+        "notification_number": np.arange(100),
+        "creation_timestamp": pd.date_range("2020-01-01", periods=100, freq="h", tz="Africa/Johannesburg"),
+        "latitude": np.linspace(-34.0, -33.9, 100),
+        "code": pd.Categorical(["a", "b"]*50),
+        })
+
+
+def test_diff_frames_reports_mismatches(frame):
+    assert diff_frames(frame, frame.copy()).is_equal
+    computed = frame.copy()
+    computed.loc[[3, 7], "latitude"] += 1e-3
+    computed.loc[5, "code"] = "a"
+    computed["extra"] = 1
+    report = diff_frames(computed, frame)
+    assert not report.is_equal
+    assert report.mismatches["latitude"] == 2
+    assert report.samples["latitude"] == [3, 7]
+    assert report.samples["code"] == [5]
+    assert report.extra_columns == {"extra"}
+
+
+def test_row_hashes_ignore_dtypes(frame):
+    as_text = frame.astype({"code": object})
+    as_text["creation_timestamp"] = frame["creation_timestamp"].dt.tz_convert("UTC")
+    np.testing.assert_array_equal(row_hashes(frame), row_hashes(as_text))
+    changed = frame.copy()
+    changed.loc[10, "latitude"] += 1e-3
+    assert (row_hashes(frame) != row_hashes(changed)).tolist() == [row == 10 for row in range(100)]
+
+
+def test_frame_digest_is_independent_of_chunks(frame):
+    whole = FrameDigest(block_rows=16).update(frame)
+    chunked = FrameDigest(block_rows=16)
+    for start in range(0, len(frame), 7):
+        chunked.update(frame.iloc[start:start + 7])
+    assert whole.block_digests() == chunked.block_digests()
+    assert whole.unordered == FrameDigest(block_rows=16).update(frame.iloc[::-1]).unordered
+
+    changed = frame.copy()
+    changed.loc[40, "code"] = "b"
+    assert whole.mismatched_blocks(FrameDigest(block_rows=16).update(changed)) == [(32, 48)]
@@ -0,0 +1,71 @@
+# Tests of the streamed GeoJSON reader of support_library.py and of the hex
+# feature validation of hex_validation.py.
+import copy
+import json
+
+import pytest
+
+from support_library import iter_geojson_features, read_geojson_feature
+from hex_validation import HexFeatureValidator
+
+
+def hex_feature(i):
+    return {
+        "type": "Feature",
+        "properties": {"index": f"88bc{i:011x}", "centroid_lat": -33.9 + i*1e-3, "name": "Bellville Süd" if i % 2 else ""},
+        "geometry": {"type": "Polygon", "coordinates": [[[18.6 + i*1e-3, -33.9], [18.61, -33.91], [18.6 + i*1e-3, -33.9]]]},
+        }
+
+
+@pytest.fixture
+def features():
+    return [hex_feature(i) for i in range(40)]
+
+
+@pytest.fixture
+def geojson_file(tmp_path, features):
+    file_name = str(tmp_path / "hexes.geojson")
+    with open(file_name, "w", encoding="utf-8") as f_:
+        json.dump({"type": "FeatureCollection", "name": "hexes", "crs": {"type": "name"}, "bbox": 18,
+                   "features": features, "after": [1, 2]}, f_, indent=1, ensure_ascii=False)
+    return file_name
+
+
+@pytest.mark.parametrize("block_size", [1, 5, 64, 1024**2])
+def test_iter_geojson_features(geojson_file, features, block_size):
+    streamed = list(iter_geojson_features(geojson_file, block_size))
+    assert [feature for feature, _, _ in streamed] == features
+    for feature, offset, size in streamed:
+        assert read_geojson_feature(geojson_file, offset, size) == feature
+
+
+def test_iter_geojson_features_truncated(tmp_path):
+    file_name = str(tmp_path / "truncated.geojson")
+    with open(file_name, "w") as f_:
+        f_.write('{"type": "FeatureCollection", "features": [{"type": "Feature"}, {"type": ')
+    with pytest.raises(ValueError):
+        list(iter_geojson_features(file_name, 8))
+
+
+def test_streamed_validator_accepts_same_features(geojson_file, features):
+    validator = HexFeatureValidator.from_geojson(geojson_file)
+    assert all(validator.validate(feature) for feature in features)
+    assert validator.is_valid()
+
+
+def test_streamed_validator_reports_differences(geojson_file, features):
+    validator = HexFeatureValidator.from_geojson(geojson_file)
+    within_tolerance = copy.deepcopy(features[0])
+    within_tolerance["geometry"]["coordinates"][0][0][0] += 1e-12
+    changed = copy.deepcopy(features[1])
+    changed["geometry"]["coordinates"][0][0][0] += 1e-3
+    extra = hex_feature(1000)
+
+    assert validator.validate(within_tolerance)
+    assert not validator.validate(changed)
+    assert not validator.validate(extra)
+    report = validator.report()
+    assert report["changed"] == [features[1]["properties"]["index"]]
+    assert report["extra"] == [extra["properties"]["index"]]
+    assert len(report["missing"]) == len(features) - 2
+    assert not validator.is_valid()
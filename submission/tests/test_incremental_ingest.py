@@ -0,0 +1,165 @@
+# Tests of the incremental ingestion of challenge_2.py and incremental_ingest.py,
+# run offline on synthetic extracts in a temporary directory.
+import functools
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("h3")
+
+import challenge_2
+from support_library import SERVICE_REQUEST_SOURCE, CHALLENGE_2_PARTITIONED_OUTPUT, SERVICE_REQUEST_HEX_COLUMN_NAME
+from columnar_io import(PartitionedServiceRequestsWriter,
+                        read_partition_manifest,
+                        read_partitioned_service_requests,
+                        write_partitioned_service_requests,
+                        )
+from h3_indexer import calculate_h3_index
+from incremental_ingest import ServiceRequestDelta
+from synthetic_data import generate_service_requests, write_service_requests_csv
+
+
+@pytest.fixture
+def ingest(tmp_path, monkeypatch):
+#   return a function that writes an extract as SERVICE_REQUEST_SOURCE, runs
+#   main_incremental() and returns the partitioned output read back
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(challenge_2, "set_s3_client", lambda: None)
+    monkeypatch.setattr(challenge_2, "H3_INDEX_NUM_WORKERS", 1)
+
+    def run(extract, chunk_size=700, now=None):
+        write_service_requests_csv(extract.reset_index(drop=True), SERVICE_REQUEST_SOURCE)
+        monkeypatch.setattr(challenge_2, "ServiceRequestDelta", functools.partial(ServiceRequestDelta, now=now))
+        challenge_2.main_incremental(chunk_size=chunk_size)
+        return read_partitioned_service_requests(CHALLENGE_2_PARTITIONED_OUTPUT)
+    return run
+
+
+def assert_store_holds(store, extract):
+#   the store holds the columns of the extract as text, but 'latitude' and 'longitude'
+    assert len(store) == len(extract)
+    extract = extract.astype({"notification_number": str})
+    assert store["notification_number"].is_unique
+    merged = store.merge(extract, on="notification_number", suffixes=("", "_extract"))
+    assert len(merged) == len(extract)
+    assert (merged["department"].astype(str) == merged["department_extract"].astype(str)).all()
+    np.testing.assert_allclose(merged["latitude"], merged["latitude_extract"], equal_nan=True)
+
+
+def test_incremental_store_follows_extracts(ingest):
+    extract = generate_service_requests(3000, null_fraction=0.05, start="2020-01-01", end="2020-03-01", seed=11)
+    assert_store_holds(ingest(extract), extract)
+
+    # an unchanged extract leaves the store as it is
+    assert_store_holds(ingest(extract), extract)
+
+    # new requests, a changed recent request and a removed recent request
+    recent = extract.index[extract["creation_timestamp"] >= pd.Timestamp("2020-02-28", tz="Africa/Johannesburg")]
+    updated = extract.drop(index=recent[0]).copy()
+    updated.loc[recent[1], "latitude"] += 0.001
+    new = generate_service_requests(200, null_fraction=0.05, start="2020-03-01", end="2020-03-05", seed=12)
+    new["notification_number"] += 10_000_000
+    updated = pd.concat([updated, new], ignore_index=True)
+    assert_store_holds(ingest(updated), updated)
+
+
+def test_remove_rows_from_files_of_one_partition(tmp_path):
+    directory = str(tmp_path / "partitioned")
+    batches = []
+    for seed in range(2):
+        batch = generate_service_requests(200, null_fraction=0, seed=seed)
+        batch["notification_number"] += seed*1000
+        batch[SERVICE_REQUEST_HEX_COLUMN_NAME] = calculate_h3_index(batch["latitude"], batch["longitude"], 8)
+        batches.append(batch)
+    write_partitioned_service_requests(batches[0], directory)
+    writer = PartitionedServiceRequestsWriter(directory, append=True)
+    writer.write(batches[1])
+    writer.close()
+
+    # one request from each file of a partition holding both batches
+    manifest = read_partition_manifest(directory)
+    partitions = [partition for partition in manifest["partitions"].values() if len(partition["files"]) == 2]
+    partition = max(partitions, key=lambda partition: min(entry["rows"] for entry in partition["files"]))
+    assert min(entry["rows"] for entry in partition["files"]) > 1
+    store = read_partitioned_service_requests(directory)
+    keys = {entry["file"]: [pd.read_parquet(f"{directory}/{entry['file']}")["notification_number"].iloc[0]]
+            for entry in partition["files"]}
+    writer = PartitionedServiceRequestsWriter(directory, append=True)
+    renamed = writer.remove_rows("notification_number", keys)
+    writer.close()
+
+    assert len(set(renamed.values())) == 2
+    after = read_partitioned_service_requests(directory)
+    assert len(after) == len(store) - 2
+    removed = {key for file_keys in keys.values() for key in file_keys}
+    assert sorted(after["notification_number"]) == sorted(set(store["notification_number"]) - removed)
+
+
+def test_store_without_incremental_state_is_rebuilt(ingest, tmp_path):
+    extract = generate_service_requests(1500, null_fraction=0.05, seed=13)
+    indexed = extract.copy()
+    indexed[SERVICE_REQUEST_HEX_COLUMN_NAME] = calculate_h3_index(extract["latitude"], extract["longitude"], 8)
+    write_partitioned_service_requests(indexed, str(tmp_path / CHALLENGE_2_PARTITIONED_OUTPUT))
+    assert_store_holds(ingest(extract), extract)
+
+
+def test_full_pass_finds_changes_to_older_requests(ingest):
+    extract = generate_service_requests(1500, null_fraction=0.05, start="2020-01-01", end="2020-03-01", seed=14)
+    now = pd.Timestamp("2021-01-01", tz="UTC")
+    ingest(extract, now=now)
+
+    older = extract.index[(extract["creation_timestamp"] < pd.Timestamp("2020-02-01", tz="Africa/Johannesburg"))
+                          & extract["latitude"].notna()]
+    changed = extract.copy()
+    changed.loc[older[0], "latitude"] += 0.001
+    removed = changed.drop(index=older[1])
+
+    # a removed older request is found on any run, a changed one on a full pass only
+    store = ingest(removed, now=now + pd.Timedelta(days=1))
+    assert len(store) == len(removed)
+    stored = store.loc[store["notification_number"] == str(extract.loc[older[0], "notification_number"]), "latitude"]
+    assert stored.tolist() == [extract.loc[older[0], "latitude"]]
+    assert_store_holds(ingest(removed, now=now + pd.Timedelta(days=31)), removed)
+
+
+def test_undated_requests_are_stored(ingest):
+    extract = generate_service_requests(1500, null_fraction=0.05, seed=15)
+    extract.loc[extract.index[::10], "creation_timestamp"] = pd.NaT
+    assert_store_holds(ingest(extract), extract)
+
+    undated = extract.index[extract["creation_timestamp"].isna() & extract["latitude"].notna()]
+    updated = extract.drop(index=undated[0]).copy()
+    updated.loc[undated[1], "latitude"] += 0.001
+    assert_store_holds(ingest(updated), updated)
+
+
+def test_repeated_keys_keep_their_last_row(ingest):
+    extract = generate_service_requests(1500, null_fraction=0.05, seed=16)
+    later = extract[extract["latitude"].notna()].iloc[[10, 20]].copy()
+    later["latitude"] += 0.001
+    later["department"] = "Updated"
+    # the first key is repeated in its chunk, the second in a later chunk
+    repeated = pd.concat([extract.iloc[:100], later.iloc[:1], extract.iloc[100:], later.iloc[1:]], ignore_index=True)
+    expected = repeated.drop_duplicates("notification_number", keep="last")
+    assert_store_holds(ingest(repeated), expected)
+    assert_store_holds(ingest(repeated), expected)
+
+    # the repeated rows are older than the lookback: a full pass restores them
+    assert_store_holds(ingest(extract, now=pd.Timestamp.now(tz="UTC") + pd.Timedelta(days=31)), extract)
+
+
+def test_key_stored_twice_keeps_its_last_row(tmp_path):
+    row_index = pd.DataFrame({
+        "key": ["1", "2", "1"],
+        "timestamp": pd.to_datetime(["2020-01-01"]*3, utc=True),
+        "row_hash": np.array([1, 2, 3], dtype=np.uint64),
+        "file": ["a", "b", "c"],
+        })
+    row_index.to_parquet(tmp_path / "index.parquet")
+    delta = ServiceRequestDelta(str(tmp_path), {"incremental": {"row_index": "index.parquet"}})
+    chunk = pd.DataFrame({"": [0, 1], "notification_number": ["1", "2"], "creation_timestamp": ["2020-01-02"]*2})
+    selected, _ = delta.select(chunk)
+    assert len(selected) == 2
+    assert delta.superseded() == {"a": ["1"], "b": ["2"], "c": ["1"]}
+    assert delta.num_removed == 0 and delta.num_changed == 2
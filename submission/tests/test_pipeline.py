@@ -0,0 +1,87 @@
+# Tests of the stage fingerprints of pipeline.py.
+import json
+import os
+
+import support_library
+from pipeline import(PipelineStage,
+                     code_fingerprint,
+                     path_digest,
+                     stale_reasons,
+                     complete_stage,
+                     )
+
+
+def write_module(directory, name, source):
+    with open(os.path.join(directory, name), "w") as f_:
+        f_.write(source)
+
+
+def test_code_fingerprint_follows_local_imports(tmp_path):
+    directory = str(tmp_path)
+    write_module(directory, "script.py", "from helper import f\nfrom support_library import BUCKET_NAME\nimport os\nf(BUCKET_NAME)\n")
+    write_module(directory, "helper.py", "def f(x):\n    return x\n")
+    code, parameters = code_fingerprint("script.py", directory)
+    assert sorted(code) == ["helper.py", "script.py"]
+    assert parameters == {"BUCKET_NAME": json.dumps(support_library.BUCKET_NAME)}
+
+    # comments and formatting do not count, code does
+    write_module(directory, "helper.py", "# the identity\ndef f( x ):\n    return x\n")
+    assert code_fingerprint("script.py", directory)[0] == code
+    write_module(directory, "helper.py", "def f(x):\n    return x + 1\n")
+    assert code_fingerprint("script.py", directory)[0]["helper.py"] != code["helper.py"]
+
+
+def test_path_digest_of_files_and_directories(tmp_path):
+    output = tmp_path / "output"
+    output.mkdir()
+    (output / "a.parquet").write_bytes(b"a")
+    (output / "b.parquet").write_bytes(b"b")
+    digests = {}
+    digest = path_digest(str(output), digests)
+    assert len(digests) == 2
+    assert path_digest(str(output), {}) == digest
+    assert path_digest(str(tmp_path / "missing"), digests) is None
+
+    (output / "b.parquet").write_bytes(b"bb")
+    assert path_digest(str(output), digests) != digest
+
+
+def test_stale_reasons(tmp_path):
+    output = str(tmp_path / "out.csv")
+    with open(output, "w") as f_:
+        f_.write("x\n")
+    stage = PipelineStage("stage", "script.py", outputs=[output])
+    components = {"code": {"script.py": "1"}, "parameters": {}, "inputs": {}, "remote": {}}
+    state = {"stages": {}, "digests": {}}
+    assert stale_reasons(stage, components, None, state["digests"]) == ["no successful run recorded"]
+
+    assert complete_stage(stage, components, 0, os.path.getmtime(output), state)
+    assert stale_reasons(stage, components, state["stages"]["stage"], state["digests"]) == []
+    changed = dict(components, code={"script.py": "2"})
+    assert stale_reasons(stage, changed, state["stages"]["stage"], state["digests"]) == ["code changed: script.py"]
+
+    assert not complete_stage(stage, components, 1, os.path.getmtime(output), state)
+    assert "stage" not in state["stages"]
+
+
+def test_local_inputs_are_recorded_after_the_run(tmp_path):
+    output = str(tmp_path / "out.csv")
+    store = tmp_path / "store"
+    store.mkdir()
+    (store / "station.parquet").write_bytes(b"before")
+    stage = PipelineStage("stage", "script.py", outputs=[output], local_inputs=[str(store)])
+    state = {"stages": {}, "digests": {}}
+    components = {"code": {}, "parameters": {}, "remote": {},
+                  "inputs": {str(store): path_digest(str(store), state["digests"])}}
+
+    # the script updates the store it reads
+    (store / "station.parquet").write_bytes(b"after")
+    with open(output, "w") as f_:
+        f_.write("x\n")
+    assert complete_stage(stage, components, 0, os.path.getmtime(output), state)
+    after = dict(components, inputs={str(store): path_digest(str(store), state["digests"])})
+    assert stale_reasons(stage, after, state["stages"]["stage"], state["digests"]) == []
+
+    (store / "station.parquet").write_bytes(b"changed elsewhere")
+    changed = dict(components, inputs={str(store): path_digest(str(store), state["digests"])})
+    assert stale_reasons(stage, changed, state["stages"]["stage"], state["digests"]) == [f"inputs changed: {store}"]
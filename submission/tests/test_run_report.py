@@ -0,0 +1,77 @@
+# Tests of the run reports of support_library.py.
+import json
+import threading
+
+import pytest
+
+from support_library import (finish_run_report,
+                             get_run_report,
+                             run_stage,
+                             start_run_report,
+                             )
+
+
+@pytest.fixture
+def report_file(tmp_path):
+    file_name = str(tmp_path / "run.json")
+    start_run_report("test", file_name, history_file=str(tmp_path / "history.jsonl"))
+    yield file_name
+    finish_run_report()
+
+
+def stages(report):
+    return {stage["name"]: stage for stage in report["stages"]}
+
+
+def test_stage_time_elapsed_without_report():
+    assert get_run_report() is None
+    with run_stage("read") as stage_:
+        pass
+    assert stage_.time_elapsed >= 0
+
+
+def test_stages_are_nested_and_accumulated(report_file):
+    for _ in range(3):
+        with run_stage("chunk", rows_in=10) as stage_:
+            with run_stage("write") as inner_:
+                inner_.rows_out = 5
+    assert stage_.time_elapsed >= inner_.time_elapsed
+    report = stages(finish_run_report())
+    assert report["chunk"]["calls"] == 3
+    assert report["chunk"]["rows_in"] == 30
+    assert report["chunk/write"]["parent"] == "chunk"
+    assert report["chunk/write"]["rows_out"] == 15
+
+
+def test_failed_stage_is_recorded(report_file):
+    with pytest.raises(ValueError):
+        with run_stage("validate"):
+            raise ValueError("mismatch")
+    report = finish_run_report()
+    assert stages(report)["validate"]["errors"] == 1
+    with open(report_file) as f_:
+        assert json.load(f_)["io_scope"] == "process"
+
+
+def test_overlapping_stages_share_io(report_file):
+    started = threading.Event()
+    release = threading.Event()
+
+    def prefetch():
+        with run_stage("download"):
+            started.set()
+            release.wait(5)
+
+    thread = threading.Thread(target=prefetch)
+    thread.start()
+    started.wait(5)
+    with run_stage("read"):
+        pass
+    release.set()
+    thread.join()
+    with run_stage("write"):
+        pass
+    report = stages(finish_run_report())
+    assert report["read"]["io_shared_with"] == ["download"]
+    assert report["download"]["io_shared_with"] == ["read"]
+    assert report["write"]["io_shared_with"] == []
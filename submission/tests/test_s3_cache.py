@@ -0,0 +1,195 @@
+# Tests of the local S3 cache and the multipart download of support_library.py,
+# against an S3 bucket mocked by moto.
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import pytest
+
+moto = pytest.importorskip("moto")
+
+from support_library import (download_file_from_s3_cache,
+                             download_file_multipart,
+                             etag_is_md5,
+                             evict_s3_cache,
+                             file_lock,
+                             s3_cache_lock_path,
+                             get_s3_connection_stats,
+                             s3_cache_path,
+                             s3_cache_stats,
+                             )
+
+BUCKET = "test-bucket"
+KEY = "sr.csv.gz"
+
+
+@pytest.fixture
+def s3_client(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+@pytest.fixture(autouse=True)
+def reset_stats():
+    for name in s3_cache_stats:
+        s3_cache_stats[name] = 0
+
+
+def read(file_name):
+    with open(file_name, "rb") as f_:
+        return f_.read()
+
+
+def test_cache_miss_then_hit(s3_client, tmp_path):
+    s3_client.put_object(Bucket=BUCKET, Key=KEY, Body=b"first version")
+    cache_dir = str(tmp_path / "cache")
+    working_file = str(tmp_path / KEY)
+
+    download_file_from_s3_cache(s3_client, BUCKET, KEY, working_file, cache_dir=cache_dir)
+    os.remove(working_file)
+    download_file_from_s3_cache(s3_client, BUCKET, KEY, working_file, cache_dir=cache_dir)
+
+    assert read(working_file) == b"first version"
+    assert s3_cache_stats["misses"] == 1
+    assert s3_cache_stats["hits"] == 1
+
+
+def test_new_etag_replaces_cached_copy(s3_client, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    working_file = str(tmp_path / KEY)
+    s3_client.put_object(Bucket=BUCKET, Key=KEY, Body=b"first version")
+    download_file_from_s3_cache(s3_client, BUCKET, KEY, working_file, cache_dir=cache_dir)
+    old_etag = s3_client.head_object(Bucket=BUCKET, Key=KEY)["ETag"].strip('"')
+
+    s3_client.put_object(Bucket=BUCKET, Key=KEY, Body=b"second version")
+    download_file_from_s3_cache(s3_client, BUCKET, KEY, working_file, cache_dir=cache_dir)
+
+    assert read(working_file) == b"second version"
+    assert s3_cache_stats["misses"] == 2
+    assert not os.path.exists(s3_cache_path(BUCKET, KEY, old_etag, cache_dir))
+
+
+def test_writing_working_copy_leaves_cache_intact(s3_client, tmp_path):
+    s3_client.put_object(Bucket=BUCKET, Key=KEY, Body=b"cached content")
+    cache_dir = str(tmp_path / "cache")
+    working_file = str(tmp_path / KEY)
+    download_file_from_s3_cache(s3_client, BUCKET, KEY, working_file, cache_dir=cache_dir)
+
+    # a script rewriting its working copy in place
+    with open(working_file, "r+b") as f_:
+        f_.write(b"CHANGED")
+
+    etag = s3_client.head_object(Bucket=BUCKET, Key=KEY)["ETag"].strip('"')
+    assert read(s3_cache_path(BUCKET, KEY, etag, cache_dir)) == b"cached content"
+    download_file_from_s3_cache(s3_client, BUCKET, KEY, working_file, cache_dir=cache_dir)
+    assert read(working_file) == b"cached content"
+    assert [name for name in os.listdir(tmp_path) if name.endswith(".tmp")] == []
+
+
+def test_multipart_download(s3_client, tmp_path):
+    body = os.urandom(10_000)
+    s3_client.put_object(Bucket=BUCKET, Key=KEY, Body=body)
+    working_file = str(tmp_path / KEY)
+
+    assert download_file_multipart(s3_client, BUCKET, KEY, working_file,
+                                   part_size=1024, max_workers=4, threshold=1024)
+    assert read(working_file) == body
+    assert not os.path.exists(working_file + ".partial")
+    assert not os.path.exists(working_file + ".partial.json")
+
+
+def test_multipart_download_resumes(s3_client, tmp_path, monkeypatch):
+    body = os.urandom(4096)
+    s3_client.put_object(Bucket=BUCKET, Key=KEY, Body=body)
+    working_file = str(tmp_path / KEY)
+    get_object = s3_client.get_object
+    requested = []
+
+    def fail_on_last_part(**kwargs):
+        requested.append(kwargs["Range"])
+        if kwargs["Range"] == "bytes=3072-4095":
+            raise IOError("connection reset")
+        return get_object(**kwargs)
+
+    monkeypatch.setattr(s3_client, "get_object", fail_on_last_part)
+    with pytest.raises(IOError):
+        download_file_multipart(s3_client, BUCKET, KEY, working_file,
+                                part_size=1024, max_workers=1, threshold=1024)
+
+    requested.clear()
+    monkeypatch.setattr(s3_client, "get_object", lambda **kwargs: requested.append(kwargs["Range"]) or get_object(**kwargs))
+    assert download_file_multipart(s3_client, BUCKET, KEY, working_file,
+                                   part_size=1024, max_workers=1, threshold=1024)
+    assert requested == ["bytes=3072-4095"]
+    assert read(working_file) == body
+
+
+def test_encrypted_download_skips_the_md5_check(s3_client, tmp_path, monkeypatch):
+    body = os.urandom(4096)
+    s3_client.put_object(Bucket=BUCKET, Key=KEY, Body=body)
+    working_file = str(tmp_path / KEY)
+    get_object = s3_client.get_object
+    etag = s3_client.head_object(Bucket=BUCKET, Key=KEY)["ETag"]
+    monkeypatch.setattr(s3_client, "get_object", lambda **kwargs: get_object(**dict(kwargs, IfMatch=etag)))
+
+    # the ETag of an SSE-KMS object is not the MD5 of its content
+    head = dict(s3_client.head_object(Bucket=BUCKET, Key=KEY), ETag='"' + "0"*32 + '"')
+    monkeypatch.setattr(s3_client, "head_object", lambda **kwargs: head)
+    assert not download_file_multipart(s3_client, BUCKET, KEY, working_file, part_size=1024, threshold=1024)
+    head["ServerSideEncryption"] = "aws:kms"
+    assert download_file_multipart(s3_client, BUCKET, KEY, working_file, part_size=1024, threshold=1024)
+    assert read(working_file) == body
+
+    assert not etag_is_md5({"ETag": '"' + "0"*32 + '"', "SSECustomerAlgorithm": "AES256"})
+    assert not etag_is_md5({"ETag": '"' + "0"*32 + '-2"'})
+
+
+def test_connection_stats_are_best_effort(s3_client):
+    s3_client.put_object(Bucket=BUCKET, Key=KEY, Body=b"content")
+    s3_client.head_object(Bucket=BUCKET, Key=KEY)
+    stats = get_s3_connection_stats(s3_client)
+    assert stats is None or stats["requests"] >= stats["connections"]
+    # a client without the expected internals
+    assert get_s3_connection_stats(object()) is None
+
+
+def test_concurrent_downloads_of_a_key_download_once(s3_client, tmp_path):
+    s3_client.put_object(Bucket=BUCKET, Key=KEY, Body=b"x"*100_000)
+    cache_dir = str(tmp_path / "cache")
+    working_file = str(tmp_path / KEY)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(download_file_from_s3_cache, s3_client, BUCKET, KEY, working_file, cache_dir=cache_dir)
+                   for _ in range(4)]
+        for future in futures:
+            future.result()
+
+    assert read(working_file) == b"x"*100_000
+    assert s3_cache_stats["misses"] == 1
+    assert s3_cache_stats["hits"] == 3
+    assert sorted(os.listdir(tmp_path)) == ["cache", KEY]
+    assert not [name for name in os.listdir(cache_dir) if name.endswith((".lock", ".tmp", ".partial"))]
+
+
+def test_file_lock_is_exclusive(tmp_path):
+    lock_file = str(tmp_path / "a.lock")
+    with file_lock(lock_file) as is_locked:
+        assert is_locked
+        with file_lock(lock_file, blocking=False) as is_locked_again:
+            assert not is_locked_again
+    assert not os.path.exists(lock_file)
+    with file_lock(lock_file, blocking=False) as is_locked:
+        assert is_locked
+
+
+def test_eviction_skips_locked_keys(s3_client, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    for key in ("a", "b"):
+        s3_client.put_object(Bucket=BUCKET, Key=key, Body=b"x"*1000)
+        download_file_from_s3_cache(s3_client, BUCKET, key, str(tmp_path / key), cache_dir=cache_dir)
+    with file_lock(s3_cache_lock_path(BUCKET, "a", cache_dir)):
+        assert evict_s3_cache(0, cache_dir) == 1
+    assert evict_s3_cache(0, cache_dir) == 1
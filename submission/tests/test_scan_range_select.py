@@ -0,0 +1,140 @@
+# Tests of the ScanRange S3 SELECT extractor of scan_range_select.py, run
+# offline against LocalSelectClient.
+import json
+import os
+import re
+
+import botocore.exceptions
+import pytest
+
+from support_library import iter_select_records
+from scan_range_select import (scan_range_select,
+                               scan_ranges,
+                               stage_json_lines_copy,
+                               )
+
+SOURCE_KEY = "hexes.geojson"
+STAGING_KEY = "hexes.jsonl"
+EXPRESSION = "SELECT * FROM S3Object s WHERE s.properties.resolution IN (8, 9)"
+
+
+class LocalSelectClient:
+#   Local stand-in for the S3 client methods used by this module, serving
+#   objects from the files in a local directory. Supported:
+#   - head_object, upload_file, and select_object_content for JSON DOCUMENT
+#     ("S3Object[*].features[*]") and JSON LINES ("S3Object") input
+#   - ScanRange with the S3 semantics: a record is returned by the range in
+#     which its first byte lies
+#   - a WHERE clause of the form s.properties.resolution = N or IN (N, ...)
+    def __init__(self, directory):
+        self.directory = directory
+        self._metadata = {}
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def head_object(self, Bucket, Key):
+        if not os.path.exists(self._path(Key)):
+            raise botocore.exceptions.ClientError(
+                {"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject")
+        size = os.path.getsize(self._path(Key))
+        return {"ContentLength": size, "ETag": f'"{size}-{os.path.getmtime(self._path(Key))}"',
+                "Metadata": self._metadata.get(Key, {})}
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None):
+        with open(Filename, "rb") as f_source, open(self._path(Key), "wb") as f_:
+            f_.write(f_source.read())
+        self._metadata[Key] = (ExtraArgs or {}).get("Metadata", {})
+
+    @staticmethod
+    def _resolution_filter(expression):
+        match = re.search(r"resolution\s*(?:=\s*(\d+)|IN\s*\(([\d,\s]+)\))", expression, re.IGNORECASE)
+        if match is None:
+            return None
+        values = match.group(1) or match.group(2)
+        return {int(value) for value in values.split(",")}
+
+    def select_object_content(self, Bucket, Key, Expression, InputSerialization,
+                              OutputSerialization=None, ExpressionType="SQL", ScanRange=None):
+        with open(self._path(Key), "rb") as f_:
+            data = f_.read()
+        if InputSerialization["JSON"]["Type"] == "DOCUMENT":
+            records = [json.dumps(feature).encode("utf-8") for feature in json.loads(data)["features"]]
+            bytes_scanned = len(data)
+        else:
+            start, end = 0, len(data) - 1
+            if ScanRange is not None:
+                start, end = ScanRange.get("Start", 0), ScanRange.get("End", len(data) - 1)
+            # records are returned by the range in which they start
+            offset = 0
+            records = []
+            for line in data.split(b"\n"):
+                if start <= offset <= end and line.strip():
+                    records.append(line)
+                offset += len(line) + 1
+            bytes_scanned = end - start + 1
+
+        resolutions = self._resolution_filter(Expression)
+        if resolutions is not None:
+            records = [r for r in records if json.loads(r)["properties"]["resolution"] in resolutions]
+        payload = b"".join(record + b"\n" for record in records)
+        stats = {"BytesScanned": bytes_scanned, "BytesProcessed": bytes_scanned, "BytesReturned": len(payload)}
+        return {'Payload': [{'Records': {'Payload': payload}}, {'Stats': {'Details': stats}}, {'End': {}}]}
+
+
+@pytest.fixture
+def features():
+    return [{"type": "Feature", "properties": {"index": f"{i:x}", "resolution": 8 + i % 3},
+             "geometry": {"type": "Point", "coordinates": [18.6, -33.9]}} for i in range(200)]
+
+
+@pytest.fixture
+def client(tmp_path, features):
+    with open(tmp_path / SOURCE_KEY, "w") as f_:
+        json.dump({"type": "FeatureCollection", "features": features}, f_)
+    return LocalSelectClient(str(tmp_path))
+
+
+class CountingClient:
+#   counts the ScanRange requests sent through a client
+    def __init__(self, client):
+        self.client = client
+        self.num_requests = 0
+
+    def select_object_content(self, **kwargs):
+        self.num_requests += 1
+        return self.client.select_object_content(**kwargs)
+
+
+def test_scan_ranges_cover_object():
+    ranges = scan_ranges(1000, 16)
+    assert ranges[0][0] == 0 and ranges[-1][1] == 999
+    assert all(end + 1 == start for (_, end), (start, _) in zip(ranges, ranges[1:]))
+
+
+def test_staged_copy_is_reused(client):
+    size = stage_json_lines_copy(client, "input", SOURCE_KEY, STAGING_KEY, "staging")
+    assert size == client.head_object(Bucket="staging", Key=STAGING_KEY)["ContentLength"]
+    assert stage_json_lines_copy(client, "input", SOURCE_KEY, STAGING_KEY, "staging") == size
+
+
+@pytest.mark.parametrize("num_ranges, max_workers", [(1, 1), (7, 3), (64, 4)])
+def test_scan_range_select_matches_single_request(client, features, num_ranges, max_workers):
+    size = stage_json_lines_copy(client, "input", SOURCE_KEY, STAGING_KEY, "staging")
+    select_stats = {}
+    records = list(iter_select_records(
+        scan_range_select(client, "staging", STAGING_KEY, EXPRESSION, size, num_ranges, max_workers),
+        select_stats,
+        ))
+    assert records == [feature for feature in features if feature["properties"]["resolution"] in (8, 9)]
+    assert select_stats["BytesScanned"] == size
+
+
+def test_scan_range_select_window_is_bounded(client):
+    size = stage_json_lines_copy(client, "input", SOURCE_KEY, STAGING_KEY, "staging")
+    counting_client = CountingClient(client)
+    events = scan_range_select(counting_client, "staging", STAGING_KEY, EXPRESSION, size, num_ranges=32, max_workers=4)
+    next(events)
+    # the first range and at most max_workers ranges ahead of it
+    assert counting_client.num_requests <= 5
+    events.close()
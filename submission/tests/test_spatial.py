@@ -0,0 +1,114 @@
+# Tests of the H3 indexing of h3_indexer.py, the subsample of spatial_filter.py
+# and the polygon joins of spatial_join.py.
+import numpy as np
+import pytest
+
+h3 = pytest.importorskip("h3")
+
+from h3_indexer import(calculate_h3_index,
+                       calculate_h3_index_int,
+                       calculate_h3_index_parallel,
+                       h3_int_to_string,
+                       h3_string_to_int,
+                       )
+from spatial_filter import SpatialFilter, filter_centroids, haversine_distance_m
+from spatial_join import HexPolygonJoin, PolygonLayerIndex, points_in_polygon
+
+CENTROID = (18.6408, -33.9165)   # (longitude, latitude)
+
+
+@pytest.fixture
+def locations():
+#   5000 points around Cape Town, a tenth of them without a location
+    rng = np.random.default_rng(7)
+    latitude = rng.normal(-33.92, 0.05, 5000)
+    longitude = rng.normal(18.62, 0.05, 5000)
+    is_null = rng.random(5000) < 0.1
+    latitude[is_null] = np.nan
+    longitude[is_null] = np.nan
+    return latitude, longitude
+
+
+def test_h3_index_matches_geo_to_h3(locations):
+    latitude, longitude = locations
+    expected = ["0" if np.isnan(lat) else h3.geo_to_h3(lat, lon, 8) for lat, lon in zip(latitude, longitude)]
+    assert calculate_h3_index(latitude, longitude, chunk_size=1000).tolist() == expected
+    assert (calculate_h3_index_int(latitude, longitude)[np.isnan(latitude)] == 0).all()
+
+
+def test_h3_index_round_trip(locations):
+    latitude, longitude = locations
+    h3_index = calculate_h3_index_int(latitude, longitude)
+    assert (h3_string_to_int(h3_int_to_string(h3_index)) == h3_index).all()
+
+
+def test_h3_index_parallel_matches_serial(locations):
+    latitude, longitude = locations
+    serial = calculate_h3_index(latitude, longitude)
+    assert (calculate_h3_index_parallel(latitude, longitude, num_workers=2, min_rows=0) == serial).all()
+
+
+@pytest.mark.parametrize("mode", ["box", "radius"])
+def test_spatial_filter_prefilter_matches_exact(locations, mode):
+    latitude, longitude = locations
+    spatial_filter = SpatialFilter(*CENTROID, tolerance=2, unit="minutes", mode=mode)
+    exact = spatial_filter.mask(latitude, longitude)
+    assert exact.sum() > 0
+    assert (spatial_filter.mask(latitude, longitude, calculate_h3_index_int(latitude, longitude)) == exact).all()
+    if mode == "radius":
+        distance = haversine_distance_m(latitude, longitude, CENTROID[1], CENTROID[0])
+        assert (exact == (distance <= spatial_filter.radius_m)).all()
+
+    selected = filter_centroids(latitude, longitude, {"centroid": CENTROID}, tolerance=2, unit="minutes", mode=mode)
+    assert (selected["centroid"] == np.flatnonzero(exact)).all()
+
+
+def hex_layer(cells):
+#   return the GeoJSON features of the H3 cells, as in CITY_HEX_POLYGONS_8_SOURCE
+    return [{"properties": {"index": cell},
+             "geometry": {"type": "Polygon", "coordinates": [[list(point) for point in h3.h3_to_geo_boundary(cell, geo_json=True)]]}}
+            for cell in cells]
+
+
+def test_hex_polygon_join(locations):
+    latitude, longitude = locations
+    h3_index = calculate_h3_index(latitude, longitude)
+    cells = sorted(set(h3_index) - {"0"})
+    hex_join = HexPolygonJoin(hex_layer(cells[1:]))
+    assigned = hex_join.assign(latitude, longitude)
+    is_covered = h3_index != cells[0]
+    assert (assigned[is_covered] == h3_index[is_covered]).all()
+
+    # the points of the missing cell match a neighbouring polygon, or keep their own cell
+    assert set(assigned[~is_covered]) <= set(h3.k_ring(cells[0], 1))
+    assert hex_join.unmatched == int((assigned == cells[0]).sum()) > 0
+
+
+def test_polygon_layer_index():
+    square = [[18.60, -33.95], [18.70, -33.95], [18.70, -33.85], [18.60, -33.85], [18.60, -33.95]]
+    triangle = [[18.70, -33.95], [18.80, -33.95], [18.70, -33.85], [18.70, -33.95]]
+    features = [
+        {"properties": {"name": "SQUARE"}, "geometry": {"type": "Polygon", "coordinates": [square]}},
+        {"properties": {"name": "TRIANGLE"}, "geometry": {"type": "MultiPolygon", "coordinates": [[triangle]]}},
+        ]
+    index = PolygonLayerIndex(features, "name", cell_size=0.03)
+    latitude = np.array([-33.90, -33.94, -33.86, -33.90, np.nan])
+    longitude = np.array([18.65, 18.71, 18.79, 18.90, 18.65])
+    assert index.assign(latitude, longitude).tolist() == ["SQUARE", "TRIANGLE", None, None, None]
+    assert index.unmatched == 2
+    assert points_in_polygon(longitude[:2], latitude[:2], square).tolist() == [True, False]
+
+
+def test_polygon_layer_index_excludes_holes():
+    square = [[18.60, -33.95], [18.70, -33.95], [18.70, -33.85], [18.60, -33.85], [18.60, -33.95]]
+    enclave = [[18.62, -33.93], [18.64, -33.93], [18.64, -33.91], [18.62, -33.91], [18.62, -33.93]]
+    hole = [[18.66, -33.89], [18.68, -33.89], [18.68, -33.87], [18.66, -33.87], [18.66, -33.89]]
+    features = [
+        {"properties": {"name": "HOLED"}, "geometry": {"type": "Polygon", "coordinates": [square, enclave, hole]}},
+        {"properties": {"name": "ENCLAVE"}, "geometry": {"type": "Polygon", "coordinates": [enclave]}},
+        ]
+    index = PolygonLayerIndex(features, "name", cell_size=0.03)
+    latitude = np.array([-33.92, -33.88, -33.90])
+    longitude = np.array([18.63, 18.67, 18.65])
+    assert index.assign(latitude, longitude).tolist() == ["ENCLAVE", None, "HOLED"]
+    assert index.unmatched == 1
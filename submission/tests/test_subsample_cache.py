@@ -0,0 +1,43 @@
+# Tests of the partition subsample cache of subsample_cache.py.
+import pytest
+
+pytest.importorskip("h3")
+
+from support_library import BENCHMARK_CENTROID, SERVICE_REQUEST_HEX_COLUMN_NAME
+from columnar_io import PartitionedServiceRequestsWriter
+from h3_indexer import calculate_h3_index
+from spatial_filter import SpatialFilter
+from subsample_cache import PartitionSubsampleCache
+from synthetic_data import generate_service_requests
+
+
+def write_partitioned(directory, seed):
+    service_requests = generate_service_requests(3000, seed=seed)
+    service_requests[SERVICE_REQUEST_HEX_COLUMN_NAME] = calculate_h3_index(
+        service_requests["latitude"], service_requests["longitude"], 8)
+    writer = PartitionedServiceRequestsWriter(directory)
+    writer.write(service_requests)
+    writer.close()
+    return service_requests
+
+
+def test_subsample_cache_hits_and_invalidation(tmp_path):
+    directory = str(tmp_path / "partitioned")
+    service_requests = write_partitioned(directory, seed=10)
+    spatial_filter = SpatialFilter(*BENCHMARK_CENTROID, tolerance=3, unit="minutes")
+    is_selected = spatial_filter.mask(service_requests["latitude"], service_requests["longitude"])
+    expected = sorted(service_requests.loc[is_selected, "notification_number"])
+
+    cache = PartitionSubsampleCache(str(tmp_path / "cache"))
+    assert sorted(cache.subsample(directory, spatial_filter)["notification_number"]) == expected
+    assert cache.hits == 0 and cache.misses > 0
+
+    cache = PartitionSubsampleCache(str(tmp_path / "cache"))
+    assert sorted(cache.subsample(directory, spatial_filter)["notification_number"]) == expected
+    assert cache.misses == 0 and cache.hits > 0
+
+    narrower = SpatialFilter(*BENCHMARK_CENTROID, tolerance=1, unit="minutes")
+    cache = PartitionSubsampleCache(str(tmp_path / "cache"))
+    subsample = cache.subsample(directory, narrower)
+    assert cache.hits == 0
+    assert len(subsample) == int(narrower.mask(service_requests["latitude"], service_requests["longitude"]).sum())
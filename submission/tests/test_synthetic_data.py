@@ -0,0 +1,77 @@
+# Tests of the synthetic data generators of synthetic_data.py and of the wind
+# spreadsheet parser of wind_data.py.
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("h3")
+
+from synthetic_data import(generate_service_requests,
+                           write_service_requests_csv,
+                           generate_hex_layer,
+                           generate_wind_data,
+                           write_wind_ods,
+                           )
+from wind_data import read_wind_data, wind_data_cache_path
+from spatial_join import HexPolygonJoin
+from h3_indexer import calculate_h3_index
+
+
+def test_generate_service_requests_is_reproducible():
+    first = generate_service_requests(2000, null_fraction=0.25, seed=3)
+    second = generate_service_requests(2000, null_fraction=0.25, seed=3)
+    pd.testing.assert_frame_equal(first, second)
+    assert first["notification_number"].is_unique
+    is_null = first["latitude"].isna()
+    assert (is_null == first["longitude"].isna()).all()
+    assert 0.2 < is_null.mean() < 0.3
+    assert first.loc[is_null, "official_suburb"].isna().all()
+    assert (first["completion_timestamp"].dropna() >= first.loc[first["completion_timestamp"].notna(), "creation_timestamp"]).all()
+
+
+def test_service_requests_csv_has_index_column(tmp_path):
+    service_requests = generate_service_requests(100, seed=1)
+    file_name = str(tmp_path / "sr.csv.gz")
+    write_service_requests_csv(service_requests, file_name)
+    read = pd.read_csv(file_name)
+    assert read.columns[0] == "Unnamed: 0"
+    assert list(read.columns[1:]) == list(service_requests.columns)
+    assert (read["notification_number"] == service_requests["notification_number"]).all()
+
+
+def test_hex_layer_holds_every_located_point():
+    service_requests = generate_service_requests(3000, seed=2)
+    latitude = service_requests["latitude"].to_numpy()
+    longitude = service_requests["longitude"].to_numpy()
+    features = generate_hex_layer(latitude, longitude)
+    assigned = HexPolygonJoin(features).assign(latitude, longitude)
+    assert (assigned == calculate_h3_index(latitude, longitude, 8)).all()
+
+
+def test_wind_ods_round_trip(tmp_path):
+    wind_data, columns = generate_wind_data("2020-01-01", "2020-01-08", seed=4)
+    file_name = str(tmp_path / "wind.ods")
+    write_wind_ods(wind_data, columns, file_name, missing_fraction=0)
+    for station, fields in columns.items():
+        read = read_wind_data(file_name, fields, cache_dir=None)
+        assert len(read) == len(wind_data)
+        assert (read["date_and_time"].dt.tz_convert("UTC") == wind_data["date_and_time"].dt.tz_convert("UTC")).all()
+        for field in fields.values():
+            np.testing.assert_array_equal(read[field].to_numpy(), wind_data[f"{station}/{field}"].to_numpy())
+
+
+def test_wind_ods_missing_values_and_cache(tmp_path):
+    wind_data, columns = generate_wind_data("2020-01-01", "2020-01-15", seed=5)
+    file_name = str(tmp_path / "wind.ods")
+    write_wind_ods(wind_data, columns, file_name, missing_fraction=0.1, seed=5)
+    fields = columns["Atlantis"]
+    cache_dir = str(tmp_path / "cache")
+    parsed = read_wind_data(file_name, fields, cache_dir=cache_dir)
+    assert len(parsed) == len(wind_data)
+    num_missing = int(parsed[list(fields.values())].isna().to_numpy().sum())
+    assert 0 < num_missing < 0.2*len(parsed)*len(fields)
+
+    cache_file = wind_data_cache_path(file_name, fields, cache_dir)
+    with open(cache_file, "rb") as f_:
+        assert f_.read(4) == b"PAR1"
+    pd.testing.assert_frame_equal(read_wind_data(file_name, fields, cache_dir=cache_dir), parsed)
@@ -0,0 +1,31 @@
+# Tests of the wind spreadsheet reader of wind_data.py, on the spreadsheet of
+# the wind_ods fixture.
+import os
+
+import numpy as np
+import pandas as pd
+
+from wind_data import read_wind_data, wind_data_cache_path
+
+
+def test_read_wind_data(wind_ods):
+    file_name, wind_data, columns = wind_ods
+    for station, fields in columns.items():
+        read = read_wind_data(file_name, fields, cache_dir=None)
+        assert list(read.columns) == ["date_and_time"] + list(fields.values())
+        assert (read["date_and_time"].dt.tz_convert("UTC") == wind_data["date_and_time"].dt.tz_convert("UTC")).all()
+        for field in fields.values():
+            np.testing.assert_array_equal(read[field].to_numpy(), wind_data[f"{station}/{field}"].to_numpy())
+
+
+def test_read_wind_data_from_cache(tmp_path, wind_ods):
+    file_name, _, columns = wind_ods
+    fields = columns["Bellville South"]
+    cache_dir = str(tmp_path / "cache")
+    parsed = read_wind_data(file_name, fields, cache_dir=cache_dir)
+    cache_file = wind_data_cache_path(file_name, fields, cache_dir)
+    with open(cache_file, "rb") as f_:
+        assert f_.read(4) == b"PAR1"
+    pd.testing.assert_frame_equal(read_wind_data(file_name, fields, cache_dir=cache_dir), parsed)
+    assert wind_data_cache_path(file_name, columns["Atlantis"], cache_dir) != cache_file
+    assert not os.path.exists(cache_file + ".tmp")
@@ -0,0 +1,49 @@
+# Tests of the wind data store of wind_store.py, on the spreadsheet of the
+# wind_ods fixture.
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("h3")
+
+from wind_store import WindDataStore, discover_wind_stations
+
+
+def test_discover_wind_stations(wind_ods):
+    file_name, _, columns = wind_ods
+    assert discover_wind_stations(file_name) == columns
+
+
+def test_ingest_and_asof_join(tmp_path, wind_ods):
+    file_name, wind_data, columns = wind_ods
+    store = WindDataStore(str(tmp_path / "store"))
+    assert store.ingest(file_name, columns) == list(columns)
+    assert store.ingest(file_name, columns) == []
+    assert sorted(WindDataStore(str(tmp_path / "store")).stations()) == sorted(columns)
+
+    rng = np.random.default_rng(0)
+    start = wind_data["date_and_time"].min() - pd.Timedelta(hours=2)
+    frame = pd.DataFrame({
+        "creation_timestamp": start + pd.to_timedelta(rng.integers(0, 10*86400, 500), unit="s"),
+        "notification_number": np.arange(500),
+        })
+    frame.loc[::50, "creation_timestamp"] = pd.NaT
+    joined = store.asof_join(frame, "Atlantis", on="creation_timestamp")
+    assert (joined["notification_number"] == frame["notification_number"]).all()
+
+    readings = wind_data[["date_and_time", "Atlantis/wind_speed_m_s"]].rename(
+        columns={"Atlantis/wind_speed_m_s": "expected"})
+    located = frame.dropna().sort_values("creation_timestamp")
+    expected = pd.merge_asof(located, readings, left_on="creation_timestamp", right_on="date_and_time")
+    expected = expected.set_index("notification_number").reindex(frame["notification_number"])
+    np.testing.assert_array_equal(joined["wind_speed_m_s"].to_numpy(), expected["expected"].to_numpy(dtype=np.float32))
+    assert joined.loc[frame["creation_timestamp"].isna(), "date_and_time"].isna().all()
+
+
+def test_ingest_adds_the_stations_not_yet_ingested(tmp_path, wind_ods):
+    file_name, _, columns = wind_ods
+    store = WindDataStore(str(tmp_path / "store"))
+    assert store.ingest(file_name, {"Atlantis": columns["Atlantis"]}) == ["Atlantis"]
+    assert store.ingest(file_name, columns) == ["Bellville South"]
+    assert store.ingest(file_name, None) == []
+    assert sorted(WindDataStore(str(tmp_path / "store")).stations()) == sorted(columns)
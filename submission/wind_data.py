@@ -0,0 +1,157 @@
+# This module contains the wind data reader used by the scripts submitted
+# for the City of Cape Town - Data Science Unit Code Challenge
+# https://github.com/cityofcapetown/ds_code_challenge
+#
+# WIND_DATA_OUTPUT is an OpenDocument spreadsheet with an hourly row per
+# timestamp and two columns (direction, speed) per measurement station.
+# The sheet is read by streaming its content.xml with ElementTree.iterparse,
+# keeping only the timestamp column and the requested station columns.
+# The typed result (datetime64 timestamps, float32 readings) is cached as a
+# parquet file in WIND_DATA_CACHE_DIR, keyed on the SHA-256 of the
+# spreadsheet and the requested columns, so repeat runs skip the parse.
+
+from support_library import(WIND_DATA_OUTPUT,
+                            WIND_DATA_COLUMNS,
+                            WIND_DATA_TIMESTAMP_FORMAT,
+                            WIND_DATA_UTC_OFFSET,
+                            WIND_DATA_MISSING_VALUES,
+                            WIND_DATA_CACHE_DIR,
+                            file_digest,
+                            )
+
+from loguru import logger
+import timeit
+import os
+import json
+import hashlib
+import zipfile
+import xml.etree.ElementTree as ET
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# version of the parsed output, part of the cache key
+WIND_DATA_CACHE_VERSION = 1
+
+ODS_TABLE  = "{urn:oasis:names:tc:opendocument:xmlns:table:1.0}"
+ODS_OFFICE = "{urn:oasis:names:tc:opendocument:xmlns:office:1.0}"
+ODS_TEXT   = "{urn:oasis:names:tc:opendocument:xmlns:text:1.0}"
+
+
+def _cell_value(cell):
+#   return the value of an ODS table cell: a float for numeric cells, a
+#   WIND_DATA_TIMESTAMP_FORMAT string for date cells, otherwise the cell text
+#   (None if the cell is empty)
+    value_type = cell.get(f"{ODS_OFFICE}value-type")
+    if value_type in ("float", "percentage", "currency"):
+        return float(cell.get(f"{ODS_OFFICE}value"))
+    if value_type == "date":
+        return datetime.fromisoformat(cell.get(f"{ODS_OFFICE}date-value")).strftime(WIND_DATA_TIMESTAMP_FORMAT)
+    paragraphs = ["".join(p.itertext()) for p in cell.iter(f"{ODS_TEXT}p")]
+    return "\n".join(paragraphs) if paragraphs else None
+
+def iter_ods_rows(file_name, columns, sheet=0):
+#   yields a list with the values of columns (0-based column numbers) for each
+#   row of the sheet of the spreadsheet file_name
+#   - cells repeated with number-columns-repeated are expanded only up to the
+#     largest requested column
+#   - rows repeated with number-rows-repeated are yielded once per repeat if
+#     they hold a value, and once if they are empty (e.g. the padding rows at
+#     the end of a sheet)
+    columns = list(columns)
+    wanted = set(columns)
+    last_column = max(columns)
+    sheet_number = -1
+    with zipfile.ZipFile(file_name) as ods_file, ods_file.open("content.xml") as f_:
+        for event, element in ET.iterparse(f_, events=("start", "end")):
+            if element.tag == f"{ODS_TABLE}table":
+                if event == "start":
+                    sheet_number += 1
+                elif sheet_number == sheet:
+                    return
+                continue
+            if event != "end" or element.tag != f"{ODS_TABLE}table-row" or sheet_number != sheet:
+                continue
+
+            values = {}
+            column = 0
+            for cell in element:
+                if column > last_column:
+                    break
+                repeat = int(cell.get(f"{ODS_TABLE}number-columns-repeated", 1))
+                if cell.tag == f"{ODS_TABLE}table-cell":
+                    value = _cell_value(cell)
+                    if value is not None:
+                        for c in wanted.intersection(range(column, column + repeat)):
+                            values[c] = value
+                column += repeat
+            row = [values.get(c) for c in columns]
+            repeat = int(element.get(f"{ODS_TABLE}number-rows-repeated", 1)) if values else 1
+            element.clear()
+            for _ in range(repeat):
+                yield row
+
+def parse_wind_data(file_name=WIND_DATA_OUTPUT, columns=WIND_DATA_COLUMNS):
+#   return a dataframe with the 'date_and_time' and the named readings of the
+#   spreadsheet file_name
+#   - columns is a dict of {column number: column name}, e.g. WIND_DATA_COLUMNS
+#   - the data rows are the rows whose first cell is a WIND_DATA_TIMESTAMP_FORMAT
+#     timestamp; the header and footer (summary) rows are dropped
+#   - timestamps are day-first local times at WIND_DATA_UTC_OFFSET, with 24:00
+#     read as 00:00 of the next day
+#   - readings are float32; WIND_DATA_MISSING_VALUES and other text are NaN
+    rows = list(iter_ods_rows(file_name, [0] + list(columns.keys())))
+    timestamp_text = pd.Series([row[0] for row in rows], dtype=object).astype(str)
+    is_24h = timestamp_text.str.endswith("24:00")
+    timestamp_text = timestamp_text.where(~is_24h, timestamp_text.str[:-5] + "00:00")
+    timestamps = pd.to_datetime(
+        timestamp_text + WIND_DATA_UTC_OFFSET,
+        format=WIND_DATA_TIMESTAMP_FORMAT + "%z",
+        errors="coerce",
+        )
+    timestamps = timestamps + pd.to_timedelta(is_24h.astype(int), unit="D")
+    is_data_row = timestamps.notna().to_numpy()
+
+    wind_data = pd.DataFrame({"date_and_time": timestamps[is_data_row].reset_index(drop=True)})
+    for position, name in enumerate(columns.values(), start=1):
+        readings = pd.Series([row[position] for row in rows], dtype=object)[is_data_row]
+        readings = readings.where(~readings.isin(WIND_DATA_MISSING_VALUES))
+        wind_data[name] = pd.to_numeric(readings, errors="coerce").astype(np.float32).to_numpy()
+    return wind_data
+
+def wind_data_cache_path(file_name, columns, cache_dir=WIND_DATA_CACHE_DIR):
+#   return the cache file for the parsed columns of the spreadsheet file_name
+    key = json.dumps([file_digest(file_name), sorted(columns.items()), WIND_DATA_CACHE_VERSION,
+                      WIND_DATA_TIMESTAMP_FORMAT, WIND_DATA_UTC_OFFSET, WIND_DATA_MISSING_VALUES])
+    return os.path.join(cache_dir, f"wind-{hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]}.parquet")
+
+def read_wind_data(file_name=WIND_DATA_OUTPUT, columns=WIND_DATA_COLUMNS, cache_dir=WIND_DATA_CACHE_DIR):
+#   return the dataframe of parse_wind_data(), from the cache if the spreadsheet
+#   was parsed before for the same columns
+#   - cache_dir=None disables the cache
+    process_start_time = timeit.default_timer()
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = wind_data_cache_path(file_name, columns, cache_dir)
+        if os.path.exists(cache_path):
+            wind_data = pq.read_table(cache_path).to_pandas()
+            time_elapsed = timeit.default_timer() - process_start_time
+            logger.info(f"Wind data cache hit: '{cache_path}'. Time Taken: {time_elapsed}s")
+            return wind_data
+
+    wind_data = parse_wind_data(file_name, columns)
+    time_elapsed = timeit.default_timer() - process_start_time
+    logger.info(f"Wind data parsed from '{file_name}': {len(wind_data)} rows. Time Taken: {time_elapsed}s")
+
+    if cache_path is not None:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            pq.write_table(pa.Table.from_pandas(wind_data, preserve_index=False), cache_path + ".tmp")
+            os.replace(cache_path + ".tmp", cache_path)
+            logger.debug(f"Wind data cached: '{cache_path}'")
+        except OSError:
+            logger.exception(f"Cannot write wind data cache: '{cache_path}'")
+    return wind_data
@@ -0,0 +1,228 @@
+# This module contains the wind and air quality time-series store used by the
+# scripts submitted for the City of Cape Town - Data Science Unit Code Challenge
+# https://github.com/cityofcapetown/ds_code_challenge
+#
+# The spreadsheets of WIND_DATA_SOURCE (one per year, with two columns per
+# station) are ingested into WIND_DATA_STORE_DIR as one parquet file per
+# station, holding every year ingested so far sorted by time, with a manifest
+# of the stations and of the source files already ingested.
+# As-of joins look up the last reading at or before each timestamp with
+# np.searchsorted() on the sorted station timestamps, so the store is neither
+# re-sorted nor re-parsed per join.
+
+from support_library import(WIND_DATA_STORE_DIR,
+                            WIND_DATA_STATIONS,
+                            WIND_DATA_UTC_OFFSET,
+                            WIND_DATA_TIMESTAMP_FORMAT,
+                            file_digest,
+                            )
+from wind_data import read_wind_data, iter_ods_rows
+
+from loguru import logger
+import timeit
+import os
+import re
+import json
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+WIND_STORE_MANIFEST = "manifest.json"
+WIND_STORE_TIMESTAMP_COLUMN = "date_and_time"
+
+
+def station_file_name(station):
+#   return the parquet file name of a station in the store
+    return "station-" + re.sub(r"[^0-9a-z]+", "_", station.lower()).strip("_") + ".parquet"
+
+def timestamps_to_utc_ns(timestamps):
+#   return (int64 UTC nanoseconds, is_valid) for a series of timestamps
+#   - naive timestamps are taken as local times at WIND_DATA_UTC_OFFSET
+    timestamps = pd.to_datetime(pd.Series(timestamps))
+    if timestamps.dt.tz is None:
+        timestamps = timestamps.dt.tz_localize(datetime.strptime(WIND_DATA_UTC_OFFSET, "%z").tzinfo)
+    is_valid = timestamps.notna().to_numpy()
+    utc_ns = timestamps.dt.tz_convert("UTC").dt.tz_localize(None).to_numpy().astype("datetime64[ns]").view(np.int64)
+    return np.where(is_valid, utc_ns, 0), is_valid
+
+def discover_wind_stations(file_name, max_columns=64):
+#   return {station: {column number: field}} read from the header rows of the
+#   spreadsheet file_name (the rows above the first timestamp)
+#   - the station header is the header row naming the most columns; a name
+#     applies to the columns up to the next name (merged cells)
+#   - a field is "wind_direction_deg" or "wind_speed_m_s" when a later header
+#     row gives the unit of the column ("Deg", "m/s"), otherwise the columns of
+#     a station are taken as direction then speed, as in WIND_DATA_COLUMNS
+    columns = list(range(max_columns))
+    header = []
+    for row in iter_ods_rows(file_name, columns):
+        try:
+            datetime.strptime(str(row[0]), WIND_DATA_TIMESTAMP_FORMAT)
+            break
+        except ValueError:
+            header.append(row)
+    if not header:
+        return {}
+
+    station_row = max(range(len(header)), key=lambda r: sum(isinstance(v, str) for v in header[r][1:]))
+    stations = {}
+    station = None
+    for column in columns[1:]:
+        if isinstance(header[station_row][column], str) and header[station_row][column].strip():
+            station = header[station_row][column].strip()
+        # skip the columns without a header value, e.g. past the last station
+        if station is None or all(header[r][column] is None for r in range(station_row, len(header))):
+            continue
+        units = " ".join(str(header[r][column]) for r in range(station_row + 1, len(header))
+                         if header[r][column] is not None).lower()
+        fields = stations.setdefault(station, {})
+        if "deg" in units:
+            field = "wind_direction_deg"
+        elif "m/s" in units:
+            field = "wind_speed_m_s"
+        else:
+            field = ("wind_direction_deg", "wind_speed_m_s")[len(fields)] if len(fields) < 2 else f"value_{len(fields)}"
+        fields[column] = field
+    return {name: fields for name, fields in stations.items() if fields}
+
+
+class WindDataStore:
+#   Time-series store of the wind readings of every station and year ingested.
+#   - ingest(file_name, stations) adds the stations of one spreadsheet
+#   - station_data(station) returns the sorted readings of a station
+#   - asof_join(frame, station, on) adds the last reading of station at or
+#     before frame[on] to a copy of frame, like a backward pd.merge_asof(),
+#     without sorting frame
+    def __init__(self, directory=WIND_DATA_STORE_DIR):
+        self.directory = directory
+        self._arrays = {}
+        manifest_file = os.path.join(directory, WIND_STORE_MANIFEST)
+        if os.path.exists(manifest_file):
+            with open(manifest_file) as f_:
+                self.manifest = json.load(f_)
+        else:
+            self.manifest = {"sources": {}, "stations": {}}
+
+    def stations(self):
+        return list(self.manifest["stations"].keys())
+
+    def _write_manifest(self):
+        manifest_file = os.path.join(self.directory, WIND_STORE_MANIFEST)
+        with open(manifest_file + ".tmp", "w") as f_:
+            json.dump(self.manifest, f_, indent=1)
+        os.replace(manifest_file + ".tmp", manifest_file)
+
+    def ingest(self, file_name, stations=WIND_DATA_STATIONS):
+#       adds the readings of stations ({station: {column number: field}}) of the
+#       spreadsheet file_name; stations=None reads them from the header rows
+#       - readings at a timestamp already in the store replace the stored ones
+#       - the stations already ingested from the spreadsheet (same SHA-256)
+#         are skipped, so only the stations added since are read
+#       returns the list of stations updated
+        digest = file_digest(file_name)
+        if stations is None:
+            stations = discover_wind_stations(file_name)
+            logger.info(f"Wind data stations found in '{file_name}': {list(stations.keys())}")
+        ingested = self.manifest["sources"].get(digest, {}).get("stations", [])
+        stations = {station: fields for station, fields in stations.items() if station not in ingested}
+        if not stations:
+            logger.info(f"Wind data already in store: '{file_name}'")
+            return []
+
+        process_start_time = timeit.default_timer()
+        # one parse (or cache read) for all the station columns of the spreadsheet
+        columns = {}
+        for station, fields in stations.items():
+            for column, field in fields.items():
+                columns[column] = f"{station}/{field}"
+        readings = read_wind_data(file_name, columns)
+
+        os.makedirs(self.directory, exist_ok=True)
+        for station, fields in stations.items():
+            new_data = readings[[WIND_STORE_TIMESTAMP_COLUMN] + [f"{station}/{field}" for field in fields.values()]]
+            new_data = new_data.rename(columns={f"{station}/{field}": field for field in fields.values()})
+            if station in self.manifest["stations"]:
+                new_data = pd.concat([self.station_data(station), new_data], ignore_index=True)
+            station_data = (new_data
+                            .drop_duplicates(subset=WIND_STORE_TIMESTAMP_COLUMN, keep="last")
+                            .sort_values(WIND_STORE_TIMESTAMP_COLUMN, kind="stable")
+                            .reset_index(drop=True))
+
+            file_name_station = station_file_name(station)
+            path = os.path.join(self.directory, file_name_station)
+            pq.write_table(pa.Table.from_pandas(station_data, preserve_index=False), path + ".tmp")
+            os.replace(path + ".tmp", path)
+            self.manifest["stations"][station] = {
+                "file": file_name_station,
+                "rows": len(station_data),
+                "start": str(station_data[WIND_STORE_TIMESTAMP_COLUMN].min()),
+                "end": str(station_data[WIND_STORE_TIMESTAMP_COLUMN].max()),
+                "fields": [name for name in station_data.columns if name != WIND_STORE_TIMESTAMP_COLUMN],
+                }
+            self._arrays.pop(station, None)
+
+        self.manifest["sources"][digest] = {"file": os.path.basename(file_name), "stations": ingested + list(stations.keys())}
+        self._write_manifest()
+        time_elapsed = timeit.default_timer() - process_start_time
+        logger.info(f"Wind data ingested from '{file_name}': {len(stations)} stations. Time Taken: {time_elapsed}s")
+        return list(stations.keys())
+
+    def station_data(self, station):
+#       return the readings of station sorted by WIND_STORE_TIMESTAMP_COLUMN
+        if station not in self.manifest["stations"]:
+            raise KeyError(f"Station not in wind data store: '{station}'")
+        path = os.path.join(self.directory, self.manifest["stations"][station]["file"])
+        return pq.read_table(path, memory_map=True).to_pandas()
+
+    def _station_arrays(self, station):
+#       return (sorted int64 UTC nanoseconds, {field: float32 readings}), loaded once per station
+        if station not in self._arrays:
+            station_data = self.station_data(station)
+            utc_ns, _ = timestamps_to_utc_ns(station_data[WIND_STORE_TIMESTAMP_COLUMN])
+            self._arrays[station] = (utc_ns, {
+                field: station_data[field].to_numpy(dtype=np.float32)
+                for field in station_data.columns if field != WIND_STORE_TIMESTAMP_COLUMN
+                })
+        return self._arrays[station]
+
+    def _lookup(self, station, utc_ns, is_valid, tolerance=None):
+#       return the position of the last reading at or before each timestamp (-1 if none)
+        times, _ = self._station_arrays(station)
+        position = np.searchsorted(times, utc_ns, side="right") - 1
+        position[~is_valid] = -1
+        if tolerance is not None:
+            is_stale = (position >= 0) & (utc_ns - times[np.maximum(position, 0)] > pd.Timedelta(tolerance).value)
+            position[is_stale] = -1
+        return position
+
+    def asof_join(self, frame, station, on="creation_timestamp", tolerance=None):
+#       return a copy of frame with WIND_STORE_TIMESTAMP_COLUMN and the readings of
+#       station at or before frame[on] (NaT/NaN if none, or older than tolerance)
+        utc_ns, is_valid = timestamps_to_utc_ns(frame[on])
+        position = self._lookup(station, utc_ns, is_valid, tolerance)
+        return self._join_columns(frame, on, [(station, np.arange(len(frame)), position)])
+
+    def _join_columns(self, frame, on, lookups):
+#       return a copy of frame with the readings found by lookups: a list of
+#       (station, row numbers in frame, position in the station readings)
+        timestamps = np.full(len(frame), np.iinfo(np.int64).min, dtype=np.int64)   # NaT
+        columns = {}
+        for station, rows, position in lookups:
+            times, fields = self._station_arrays(station)
+            is_matched = position >= 0
+            timestamps[rows[is_matched]] = times[position[is_matched]]
+            for field, values in fields.items():
+                column = columns.setdefault(field, np.full(len(frame), np.nan, dtype=np.float32))
+                column[rows[is_matched]] = values[position[is_matched]]
+
+        joined = frame.copy()
+        key_tz = pd.to_datetime(frame[on]).dt.tz
+        matched_time = pd.to_datetime(timestamps.view("datetime64[ns]")).tz_localize("UTC")
+        joined[WIND_STORE_TIMESTAMP_COLUMN] = matched_time.tz_convert(key_tz) if key_tz is not None else matched_time
+        for field, values in columns.items():
+            joined[field] = values
+        return joined
+